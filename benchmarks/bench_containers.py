@@ -0,0 +1,189 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package benchmarks.bench_containers
+
+--------------------------------------------------------------------------------
+
+Benchmark of the per event cost of the containers
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from hpy.utils.data_container import data_container, Field, field_container
+from hpy.utils.container import Container, Map
+
+def make_event(npix, nsamples, rng):
+    """Returns the fields of a synthetic camera event"""
+    return {"event_id": np.uint64(rng.integers(1 << 32)),
+            "trigger_type": np.uint8(rng.integers(3)),
+            "trigger_time_s": np.float64(rng.random()),
+            "trigger_time_qns": np.uint32(rng.integers(1 << 30)),
+            "ped_id": np.uint64(0),
+            "pixel_status": np.ones(npix, dtype=np.uint8),
+            "waveform": rng.integers(0, 4096, (npix, nsamples),
+                                     dtype=np.uint16),
+            "first_capacitor_id": np.arange(npix // 7, dtype=np.uint16),
+            "module_status": np.ones(npix // 7, dtype=np.uint8)}
+
+def per_type(event):
+    """Builds the containers of an event as the writers used to"""
+    for k, v in event.items():
+        dclass = type("DClass", (data_container,), {"data": Field(v)})
+        dclass()
+
+def per_key(event):
+    """Builds the containers of an event with the cached classes"""
+    for k, v in event.items():
+        field_container("data", v)
+
+def event_classes(npix, nsamples):
+    """Returns event containers with copied, factory and fast defaults"""
+    zeros_waveform = np.zeros((npix, nsamples), dtype=np.uint16)
+    zeros_status = np.zeros(npix, dtype=np.uint8)
+
+    class copied(Container):
+        event_id = Field(0)
+        trigger_type = Field(0)
+        trigger_time_s = Field(0.0)
+        pixel_status = Field(zeros_status)
+        waveform = Field(zeros_waveform)
+
+    class factory(Container):
+        event_id = Field(0)
+        trigger_type = Field(0)
+        trigger_time_s = Field(0.0)
+        pixel_status = Field(default_factory=lambda: np.zeros(npix, np.uint8))
+        waveform = Field(default_factory=lambda: np.zeros((npix, nsamples),
+                                                          np.uint16))
+
+    class fast(copied):
+        pass
+    fast.enable_fast_defaults()
+    return copied, factory, fast
+
+def nested_event(npix):
+    """Returns a protozfits-like event with nested containers"""
+    class cdts(Container):
+        timestamp = Field(0)
+        address = Field(0)
+        event_counter = Field(0)
+        trigger_type = Field(0)
+        white_rabbit_status = Field(0)
+
+    class counters(Container):
+        lstcam_cdts_data = Field(cdts())
+        pps_counter = Field(0)
+        clock_counter = Field(0)
+
+    class lstcam(Container):
+        module_status = Field(np.ones(npix // 7, dtype=np.uint8))
+        first_capacitor_id = Field(np.zeros(npix // 7, dtype=np.uint16))
+        cdts_data = Field(counters())
+        extdevices_presence = Field(0)
+
+    class event(Container):
+        event_id = Field(0)
+        trigger_time_s = Field(0.0)
+        waveform = Field(np.zeros(npix, dtype=np.uint16))
+        lstcamevent = Field(lstcam())
+        tel = Field(Map(cdts))
+    return event()
+
+def recursive_flatten(c):
+    """Flattens a container walking it field by field, as it used to be"""
+    d = dict()
+    for key, val in c.items():
+        if isinstance(val, (Container, Map)):
+            d.update({"{}_{}".format(key, k): v
+                      for k, v in recursive_flatten(val).items()})
+        else:
+            d[key] = val
+    return d
+
+def flatten(func, c, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func(c)
+    return (time.perf_counter() - start) / n
+
+def construct(cls, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        cls()
+    return (time.perf_counter() - start) / n
+
+def reset(cls, n):
+    c = cls()
+    start = time.perf_counter()
+    for _ in range(n):
+        c.reset()
+    return (time.perf_counter() - start) / n
+
+def run(func, events):
+    start = time.perf_counter()
+    for event in events:
+        func(event)
+    return (time.perf_counter() - start) / len(events)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("---")[-1])
+    parser.add_argument("-n", "--events", type=int, default=2000)
+    parser.add_argument("--npix", type=int, default=1855)
+    parser.add_argument("--nsamples", type=int, default=40)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    events = [make_event(args.npix, args.nsamples, rng)
+              for _ in range(min(args.events, 100))]
+    events = [events[i % len(events)] for i in range(args.events)]
+    before = run(per_type, events)
+    after = run(per_key, events)
+    print("fields per event  %d"%(len(events[0])))
+    print("type() per field  %8.2f us/event"%(before * 1e6))
+    print("cached classes    %8.2f us/event"%(after * 1e6))
+    print("speedup           %8.1fx"%(before / after))
+
+    print("\nconstruction and reset of a %dx%d event"%(args.npix,
+                                                     args.nsamples))
+    for cls in event_classes(args.npix, args.nsamples):
+        print("%-8s  construct %8.2f us  reset %8.2f us"%(
+            cls.__name__, construct(cls, args.events) * 1e6,
+            reset(cls, args.events) * 1e6))
+
+    event = nested_event(args.npix)
+    event.tel[1].timestamp = 1
+    flat = event.as_dict(recursive=True, flatten=True)
+    buffers = {k: np.empty((1,) + np.shape(v)) for k, v in flat.items()}
+    print("\nflattening of a nested event with %d columns"%(len(flat)))
+    print("field by field    %8.2f us/event"%(
+        flatten(recursive_flatten, event, args.events) * 1e6))
+    print("compiled plan     %8.2f us/event"%(
+        flatten(lambda c: c.as_dict(recursive=True, flatten=True), event,
+                args.events) * 1e6))
+    print("fill buffers      %8.2f us/event"%(
+        flatten(lambda c: c.fill(buffers, 0), event, args.events) * 1e6))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package benchmarks.bench_read
+
+--------------------------------------------------------------------------------
+
+Benchmark of the read patterns of hpy over the layouts of the converted files
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+# The benchmarks run from a checkout of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hpy import hpy
+from hpy.core.h5base import DEFAULT_EXTENSION
+
+from synth_fits import write_fits, load_events, DEFAULT_PIXELS, \
+    DEFAULT_SAMPLES, GAINS
+from bench_write import COMPRESSIONS, LOG_CONFIG, write_cases, environment
+
+## Events read by the random pattern
+DEFAULT_RANDOM_EVENTS = 100
+## Fraction of the run selected by the time window pattern
+DEFAULT_WINDOW = 0.1
+## Warm runs of each pattern
+DEFAULT_REPEAT = 5
+
+class reads:
+    """@class reads
+    This class reads the columns of the events of a converted file,
+    whatever its layout
+
+    Bytables files hold a dataset per column, rows are selected from it.
+    Bygroups files hold a group per event, each event is read on its own.
+    PyTables stores the values in the data field of its tables, which are
+    read whole and sliced afterwards.
+    """
+    def __init__(self, s, hdf5_format, nevents, ext=DEFAULT_EXTENSION):
+        self.s = s
+        self.bygroups = hdf5_format == "bygroups"
+        self.pytables = s.mode == "pytables"
+        self.nevents = nevents
+        self.ext = ext
+
+    def read(self, column, rows=None, inner=()):
+        """Returns the column of the events in rows, an index, a range or
+        None for every event, sliced by inner along the value axes
+        """
+        if self.bygroups:
+            if isinstance(rows, int):
+                return self.__event(column, rows, inner)
+            if rows is None and not inner:
+                return self.s.gather_data(column, self.ext)
+            if rows is None:
+                rows = range(self.nevents)
+            return [self.__event(column, i, inner) for i in rows]
+        if rows is None:
+            rows = slice(None)
+        elif isinstance(rows, range):
+            rows = slice(rows.start, rows.stop, rows.step)
+        path = "/%s/data/%s"%(self.ext, column)
+        if self.pytables or not inner:
+            return self.__values(self.s.read_data(path, rows))[
+                (Ellipsis,) + inner]
+        return self.s.read_data(path, (rows,) + inner)
+
+    def __event(self, column, i, inner):
+        path = "/%s/data/%s_%08d/%s"%(self.ext, self.ext, i, column)
+        if self.pytables:
+            return self.__values(self.s.read_data(path))[0][inner]
+        return self.s.read_data(path, inner if inner else None)
+
+    def __values(self, data):
+        if isinstance(data, (np.ndarray, np.void)) and data.dtype.names:
+            return data['data']
+        return data
+
+    s = None
+    bygroups = False
+    pytables = False
+    nevents = 0
+    ext = DEFAULT_EXTENSION
+
+def scan(r, params):
+    """Reads the waveforms of every event"""
+    return r.read("waveform")
+
+def random_events(r, params):
+    """Reads the waveforms of events picked at random"""
+    rng = np.random.default_rng(params["seed"])
+    ids = rng.integers(0, r.nevents, params["random_events"])
+    return [r.read("waveform", int(i)) for i in ids]
+
+def time_window(r, params):
+    """Reads the waveforms of the events triggered in a time window, in
+    the middle of the run
+    """
+    times = np.ravel(np.asarray(r.read("trigger_time_s"), dtype=np.float64))
+    span = times[-1] - times[0]
+    lo = times[0] + span * (0.5 - params["window"] / 2)
+    hi = times[0] + span * (0.5 + params["window"] / 2)
+    start, stop = np.searchsorted(times, [lo, hi])
+    return times, r.read("waveform", range(int(start), int(stop)))
+
+def pixel_traces(r, params):
+    """Reads the samples of a pixel in every event"""
+    first = params["pixel"] * params["samples"]
+    return r.read("waveform", None,
+                  (slice(first, first + params["samples"]),))
+
+## Patterns measured, by name
+PATTERNS = {"scan": scan,
+            "random": random_events,
+            "window": time_window,
+            "traces": pixel_traces}
+
+def nbytes(data):
+    """Returns the bytes of the arrays read"""
+    if isinstance(data, (list, tuple)):
+        return sum(nbytes(d) for d in data)
+    return np.asarray(data).nbytes
+
+def fresh_copy(fname, dst):
+    """Copies a file and drops the copy from the page cache
+
+    The copy has a path of its own, so none of its chunks are cached by
+    hpy either. Returns True if the pages could be dropped.
+    """
+    shutil.copyfile(fname, dst)
+    fd = os.open(dst, os.O_RDWR)
+    try:
+        os.fsync(fd)
+        if not hasattr(os, "posix_fadvise"):
+            return False
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return True
+    finally:
+        os.close(fd)
+
+def write_layout(case, fdata, fname):
+    """Writes the events in the layout and compression of a case"""
+    s = hpy.session()
+    # Records of an event each, as the protozfits loader builds them
+    s._fdata = fdata
+    mode = case["hpy_mode"]
+    compression, opts = COMPRESSIONS[case["compression"]][mode]
+    return s.create_hdf5(fname, mode, case["hdf5_format"],
+                         compression=compression, compression_opts=opts)
+
+def run_pattern(fname, case, pattern, params, **kwargs):
+    """Returns the seconds and bytes of a read pattern, including the
+    opening of the file
+    """
+    start = time.perf_counter()
+    s = hpy.open_hdf5(fname, case["hpy_mode"], **kwargs)
+    try:
+        data = PATTERNS[pattern](reads(s, case["hdf5_format"],
+                                       params["events"]), params)
+        return time.perf_counter() - start, nbytes(data)
+    finally:
+        s.close()
+
+def measure(fname, case, pattern, params, workdir, repeat, **kwargs):
+    """Measures a pattern over a fresh copy of the file, then over the
+    file once read
+    """
+    ret = {"layout": case["name"], "pattern": pattern}
+    cold = os.path.join(workdir, "cold_%s"%(os.path.basename(fname)))
+    ret["page_cache_dropped"] = fresh_copy(fname, cold)
+    try:
+        ret["cold_seconds"], ret["bytes"] = run_pattern(cold, case, pattern,
+                                                        params, **kwargs)
+    finally:
+        os.remove(cold)
+    run_pattern(fname, case, pattern, params, **kwargs)
+    warm = [run_pattern(fname, case, pattern, params, **kwargs)[0]
+            for _ in range(repeat)]
+    ret["warm_seconds"] = float(np.median(warm))
+    ret["warm_min_seconds"] = min(warm)
+    ret["cold_mb_per_second"] = ret["bytes"] / ret["cold_seconds"] / 1e6
+    ret["warm_mb_per_second"] = ret["bytes"] / ret["warm_seconds"] / 1e6
+    return ret
+
+def format_result(r):
+    """Returns the line printed for a pattern"""
+    return "%-28s %-7s cold %8.4f s %9.2f MB/s  warm %8.4f s %9.2f MB/s"%(
+        r["layout"], r["pattern"], r["cold_seconds"],
+        r["cold_mb_per_second"], r["warm_seconds"], r["warm_mb_per_second"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("---")[-1])
+    parser.add_argument("-n", "--events", type=int, default=100)
+    parser.add_argument("--pixels", type=int, default=DEFAULT_PIXELS)
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument("--modes", nargs="+", default=["h5py", "pytables"])
+    parser.add_argument("--formats", nargs="+",
+                        default=["bygroups", "bytables"])
+    parser.add_argument("--compressions", nargs="+",
+                        default=sorted(COMPRESSIONS),
+                        choices=sorted(COMPRESSIONS))
+    parser.add_argument("--patterns", nargs="+", default=list(PATTERNS),
+                        choices=list(PATTERNS))
+    parser.add_argument("--random-events", type=int,
+                        default=DEFAULT_RANDOM_EVENTS)
+    parser.add_argument("--window", type=float, default=DEFAULT_WINDOW,
+                        help="fraction of the run selected")
+    parser.add_argument("--pixel", type=int, default=0,
+                        help="pixel of the traces read")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="warm runs of each pattern")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="read without the chunk cache of hpy")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("-o", "--output", default="bench_read.json")
+    args = parser.parse_args(argv)
+    hpy.init(None, LOG_CONFIG)
+
+    params = {"events": args.events, "samples": args.samples,
+              "pixel": args.pixel, "random_events": args.random_events,
+              "window": args.window, "seed": args.seed}
+    layouts = []
+    results = []
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        fits_file = os.path.join(workdir, "synthetic.fits")
+        write_fits(fits_file, args.events, args.pixels, args.samples,
+                   seed=args.seed)
+        fdata = load_events(fits_file)
+        for i, case in enumerate(write_cases(args.modes, args.formats,
+                                             args.compressions, False)):
+            fname = os.path.join(workdir, "layout_%d.h5"%(i))
+            layout = dict(case)
+            try:
+                layout["ok"] = bool(write_layout(case, fdata, fname))
+            except Exception as e:
+                layout["ok"] = False
+                layout["error"] = "%s: %s"%(type(e).__name__, e)
+            layouts.append(layout)
+            if not layout["ok"]:
+                print("%-28s failed %s"%(case["name"],
+                                         layout.get("error", "")))
+                continue
+            layout["output_bytes"] = os.path.getsize(fname)
+            for pattern in args.patterns:
+                results.append(measure(fname, case, pattern, params,
+                                       workdir, args.repeat,
+                                       cache=args.cache))
+                print(format_result(results[-1]), flush=True)
+            os.remove(fname)
+    report = {"benchmark": "read",
+              "parameters": dict(params, pixels=args.pixels,
+                                 gains=GAINS, repeat=args.repeat,
+                                 cache=args.cache),
+              "environment": environment(),
+              "layouts": layouts,
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Results written to %s"%(args.output))
+    return 0 if all(l["ok"] for l in layouts) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
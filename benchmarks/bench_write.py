@@ -0,0 +1,226 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package benchmarks.bench_write
+
+--------------------------------------------------------------------------------
+
+Benchmark of the write modes of hpy over synthetic FITS files
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+
+import h5py
+import numpy as np
+import tables
+
+from astropy.io import fits
+
+# The benchmarks run from a checkout of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hpy import hpy
+from hpy.core.h5base import DEFAULT_EXTENSION
+
+from synth_fits import write_fits, ROOT, DEFAULT_PIXELS, DEFAULT_SAMPLES
+
+## Log configuration of the benchmarked processes
+LOG_CONFIG = os.path.join(ROOT, "conf", "log_config.xml")
+## Compression settings, by name, as (compression, compression_opts) of
+# each mode
+COMPRESSIONS = {
+    "none": {"h5py": (None, 0), "pytables": (None, 0)},
+    "deflate": {"h5py": ("gzip", 4), "pytables": ("zlib", 4)},
+    "fast": {"h5py": ("lzf", 0), "pytables": ("blosc", 5)}}
+## Versions of the R1 data model written by create_r1
+R1_VERSIONS = ["v1", "v2"]
+## (mode, format) pairs left out of the cases. The h5py bytables writer
+# appends each event as a row of a 2D dataset, it does not write the
+# multidimensional columns of the synthetic files
+UNSUPPORTED_CASES = [("h5py", "bytables")]
+
+def write_cases(modes, formats, compressions, r1=True):
+    """Returns the cases benchmarked"""
+    ret = []
+    for m in modes:
+        for fmt in formats:
+            if (m, fmt) in UNSUPPORTED_CASES:
+                continue
+            for c in compressions:
+                ret.append({"name": "%s/%s/%s"%(m, fmt, c), "hpy_mode": m,
+                            "hdf5_format": fmt, "compression": c})
+    if r1:
+        for v in R1_VERSIONS:
+            ret.append({"name": "r1/%s"%(v), "r1": v})
+    return ret
+
+def peak_rss():
+    """Returns the peak resident memory of the process, in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def count_objects(fname):
+    """Returns the groups and datasets of an HDF5 file"""
+    ret = {"groups": 0, "datasets": 0}
+    def visit(name, obj):
+        if isinstance(obj, h5py.Group):
+            ret["groups"] += 1
+        else:
+            ret["datasets"] += 1
+    with h5py.File(fname, "r") as f:
+        f.visititems(visit)
+    return ret
+
+def run_case(case, fits_file, fname, fits_mode, config=None):
+    """Runs a case in this process and returns its measures"""
+    hpy.init(config, LOG_CONFIG)
+    ret = dict(case)
+    ret["events"] = fits.getheader(fits_file, DEFAULT_EXTENSION)["NAXIS2"]
+    ret["rss_baseline"] = peak_rss()
+    start = time.perf_counter()
+    if "r1" in case:
+        ok = hpy.create_r1_from_fits(fits_file, fname, case["r1"])
+        ret["load_seconds"] = 0.0
+    else:
+        hpy.load_fits(fits_file, fits_mode)
+        ret["load_seconds"] = time.perf_counter() - start
+        mode = case["hpy_mode"]
+        compression, opts = COMPRESSIONS[case["compression"]][mode]
+        ok = hpy.create_hdf5(fname, mode, case["hdf5_format"],
+                             compression=compression,
+                             compression_opts=opts)
+    ret["seconds"] = time.perf_counter() - start
+    ret["write_seconds"] = ret["seconds"] - ret["load_seconds"]
+    ret["peak_rss"] = peak_rss()
+    ret["ok"] = bool(ok)
+    if ok:
+        ret["input_bytes"] = os.path.getsize(fits_file)
+        ret["output_bytes"] = os.path.getsize(fname)
+        ret.update(count_objects(fname))
+        ret["events_per_second"] = ret["events"] / ret["seconds"]
+        ret["mb_per_second"] = ret["input_bytes"] / ret["seconds"] / 1e6
+    return ret
+
+def spawn_case(case, fits_file, fname, fits_mode, config=None):
+    """Runs a case in a process of its own, so that its peak memory is
+    its own, and returns its measures
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-case",
+           json.dumps(case), "--fits-file", fits_file, "--out", fname,
+           "--fits-mode", fits_mode]
+    if config:
+        cmd += ["--config", config]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    lines = p.stdout.strip().splitlines()
+    if p.returncode or not lines:
+        ret = dict(case, ok=False)
+        ret["error"] = p.stderr.strip().splitlines()[-1:] or \
+            ["exit status %d"%(p.returncode)]
+        ret["error"] = ret["error"][0]
+        return ret
+    return json.loads(lines[-1])
+
+def environment():
+    """Returns the versions of the software benchmarked"""
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "h5py": h5py.__version__,
+            "hdf5": h5py.version.hdf5_version,
+            "tables": tables.__version__}
+
+def format_result(r):
+    """Returns the line printed for a case"""
+    if not r["ok"]:
+        return "%-28s failed %s"%(r["name"], r.get("error", ""))
+    return "%-28s %8.1f ev/s %8.2f MB/s %8.1f MB rss %9.2f MB out %7d obj"%(
+        r["name"], r["events_per_second"], r["mb_per_second"],
+        r["peak_rss"] / 1e6, r["output_bytes"] / 1e6,
+        r["groups"] + r["datasets"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("---")[-1])
+    parser.add_argument("-n", "--events", type=int, default=100)
+    parser.add_argument("--pixels", type=int, default=DEFAULT_PIXELS)
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument("--vlf", action="store_true",
+                        help="write the byte columns as variable length")
+    parser.add_argument("--modes", nargs="+", default=["h5py", "pytables"])
+    parser.add_argument("--formats", nargs="+",
+                        default=["bygroups", "bytables"])
+    parser.add_argument("--compressions", nargs="+",
+                        default=sorted(COMPRESSIONS),
+                        choices=sorted(COMPRESSIONS))
+    parser.add_argument("--no-r1", dest="r1", action="store_false")
+    parser.add_argument("--fits-mode", default="astropy")
+    parser.add_argument("--config", default=None,
+                        help="definition file loaded by hpy, the synthetic "
+                        "extension names only match it in protozfits mode")
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("-o", "--output", default="bench_write.json")
+    # Internal, runs a single case in this process
+    parser.add_argument("--run-case", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--fits-file", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--out", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.fits_file,
+                                  args.out, args.fits_mode, args.config)))
+        return 0
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        fits_file = os.path.join(workdir, "synthetic.fits")
+        size = write_fits(fits_file, args.events, args.pixels, args.samples,
+                          args.vlf)
+        print("%s: %d events, %.2f MB"%(fits_file, args.events, size / 1e6))
+        results = []
+        for i, case in enumerate(write_cases(args.modes, args.formats,
+                                             args.compressions, args.r1)):
+            fname = os.path.join(workdir, "case_%d.h5"%(i))
+            results.append(spawn_case(case, fits_file, fname, args.fits_mode,
+                                      args.config))
+            print(format_result(results[-1]), flush=True)
+            if os.path.exists(fname):
+                os.remove(fname)
+    report = {"benchmark": "write",
+              "parameters": {"events": args.events, "pixels": args.pixels,
+                             "samples": args.samples, "vlf": args.vlf,
+                             "fits_mode": args.fits_mode,
+                             "config": args.config,
+                             "input_bytes": size},
+              "environment": environment(),
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Results written to %s"%(args.output))
+    return 0 if all(r["ok"] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package benchmarks.synth_fits
+
+--------------------------------------------------------------------------------
+
+Generator of synthetic FITS files with the layout of the LST camera R1 data
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+
+from astropy.io import fits
+
+# The benchmarks run from a checkout of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hpy.utils.config_manager import configuration_manager
+from hpy.utils.fits import FData, Extension, record_class
+
+## Root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+## Definition of the extensions and columns generated
+DEFAULT_DEFINITION = os.path.join(ROOT, "conf", "file.xml")
+## Pixels of the LST camera
+DEFAULT_PIXELS = 1855
+## Samples of each waveform
+DEFAULT_SAMPLES = 40
+## Gains of each pixel
+GAINS = 2
+## Pixels per camera module
+MODULE_PIXELS = 7
+## Byte columns written as variable length arrays when asked to
+VLF_COLUMNS = ["lstcam_counters", "lstcam_cdts_data", "lstcam_swat_data",
+               "lstcam_tib_data"]
+
+def event_columns(events, pixels, samples, rng):
+    """Returns the (format, values) of each column of the Events extension"""
+    modules = pixels // MODULE_PIXELS
+    def ints(fmt, dtype, width, high):
+        shape = (events, width) if width > 1 else (events,)
+        return ("%d%s"%(width, fmt) if width > 1 else fmt,
+                rng.integers(0, high, shape).astype(dtype))
+    return {
+        "configuration_id": ("I", np.ones(events, dtype=np.int16)),
+        "event_id": ("K", np.arange(1, events + 1, dtype=np.int64)),
+        "tel_event_id": ("K", np.arange(1, events + 1, dtype=np.int64)),
+        "ped_id": ("K", np.zeros(events, dtype=np.int64)),
+        "trigger_time_s": ("J", np.sort(rng.integers(0, 1 << 30, events))
+                           .astype(np.int32)),
+        "trigger_time_qns": ints("J", np.int32, 1, 1 << 30),
+        "trigger_type": ints("B", np.uint8, 1, 8),
+        "pixel_status": ints("B", np.uint8, pixels, 16),
+        "waveform": ints("I", np.int16, GAINS * pixels * samples, 4096),
+        "lstcam_chips_flags": ints("I", np.int16, modules * 8, 1 << 15),
+        "lstcam_counters": ints("B", np.uint8, modules * 44, 256),
+        "lstcam_drs_tag": ints("I", np.int16, modules * 9, 1 << 12),
+        "lstcam_drs_tag_status": ints("B", np.uint8, 1, 2),
+        "lstcam_extdevices_presence": ints("B", np.uint8, 1, 8),
+        "lstcam_first_capacitor_id": ints("I", np.int16, modules * 8, 1024),
+        "lstcam_module_status": ints("B", np.uint8, modules, 4),
+        "lstcam_cdts_data": ints("B", np.uint8, 36, 256),
+        "lstcam_swat_data": ints("B", np.uint8, 56, 256),
+        "lstcam_tib_data": ints("B", np.uint8, 16, 256)}
+
+def text(value, width, strings):
+    """Returns the (format, values) of a text column, its bytes unless
+    strings are asked for
+    """
+    if strings:
+        return ("%dA"%(width), np.array([value]))
+    values = np.zeros((1, width), dtype=np.uint8)
+    values[0, :len(value)] = np.frombuffer(value.encode(), dtype=np.uint8)
+    return ("%dB"%(width), values)
+
+def camera_columns(pixels, samples, rng, strings=False):
+    """Returns the (format, values) of each column of the CameraConfig
+    extension, a single row
+    """
+    modules = pixels // MODULE_PIXELS
+    return {
+        "configuration_id": ("I", np.ones(1, dtype=np.int16)),
+        "cs_serial": text("synthetic", 16, strings),
+        "data_model_version": text("1.0", 8, strings),
+        "date": ("K", np.array([1546300800], dtype=np.int64)),
+        "expected_pixels_id": ("%dI"%(pixels),
+                               np.arange(pixels, dtype=np.int16)[None]),
+        "num_pixels": ("I", np.array([pixels], dtype=np.int16)),
+        "num_samples": ("I", np.array([samples], dtype=np.int16)),
+        "telescope_id": ("I", np.ones(1, dtype=np.int16)),
+        "lstcam_algorithms": ("J", np.zeros(1, dtype=np.int32)),
+        "lstcam_cdhs_version": ("K", np.ones(1, dtype=np.int64)),
+        "lstcam_expected_modules_id": ("%dI"%(modules),
+                                       np.arange(modules,
+                                                 dtype=np.int16)[None]),
+        "lstcam_idaq_version": ("K", np.ones(1, dtype=np.int64)),
+        "lstcam_num_modules": ("I", np.array([modules], dtype=np.int16)),
+        "lstcam_pre_proc_algorithms": ("J", np.zeros(1, dtype=np.int32))}
+
+def variable_length(values, rng):
+    """Returns the rows of a fixed width column cut to random lengths"""
+    ret = np.empty(len(values), dtype=object)
+    for i, row in enumerate(values):
+        ret[i] = row[:rng.integers(1, len(row) + 1)]
+    return ret
+
+def definition_columns(definition, ext):
+    """Returns the names of the data columns of an extension of the
+    definition file
+    """
+    c = configuration_manager()
+    if not c.load(definition):
+        return None
+    ext_def = c.get(ext)
+    if ext_def is None:
+        return None
+    return [name for name, d in ext_def.items()
+            if d['att'].get('type') == "data"]
+
+def binary_table(name, columns, names, rng, vlf=False):
+    """Builds the table of the columns listed in names
+
+    Columns with no synthetic values are written as a 32 bit integer.
+    """
+    nrows = len(next(iter(columns.values()))[1])
+    cols = []
+    for n in names:
+        fmt, values = columns.get(n, ("J", np.zeros(nrows, dtype=np.int32)))
+        if vlf and n in VLF_COLUMNS:
+            fmt = "P%s()"%(fmt.lstrip("0123456789"))
+            values = variable_length(values, rng)
+        cols.append(fits.Column(name=n, format=fmt, array=values))
+    return fits.BinTableHDU.from_columns(cols, name=name)
+
+def write_fits(fname, events=100, pixels=DEFAULT_PIXELS,
+               samples=DEFAULT_SAMPLES, vlf=False, strings=False, seed=0,
+               definition=DEFAULT_DEFINITION):
+    """Writes a synthetic FITS file with the extensions and columns of the
+    definition file
+
+    Text columns are written as their bytes unless strings is True, the
+    writers of hpy do not convert text columns yet.
+    Returns the size of the file written.
+    """
+    rng = np.random.default_rng(seed)
+    hdus = [fits.PrimaryHDU()]
+    tables = {"CameraConfig": camera_columns(pixels, samples, rng, strings),
+              "Events": event_columns(events, pixels, samples, rng)}
+    for ext, columns in tables.items():
+        names = definition_columns(definition, ext)
+        if names is None:
+            names = list(columns)
+        hdus.append(binary_table(ext, columns, names, rng, vlf))
+    fits.HDUList(hdus).writeto(fname, overwrite=True)
+    return os.path.getsize(fname)
+
+def definition_extensions(definition):
+    """Returns the extension names of the definition file, by their upper
+    case name
+    """
+    c = configuration_manager()
+    if not c.load(definition):
+        return {}
+    return dict((ext.tag.upper(), ext.tag) for ext in c.get_root())
+
+def load_events(fits_file, definition=DEFAULT_DEFINITION):
+    """Returns the data of a FITS file with a record per event, as the
+    protozfits loader builds them
+
+    Extensions are named as in the definition file.
+    """
+    names = definition_extensions(definition)
+    ret = FData()
+    with fits.open(fits_file, memmap=False) as hdul:
+        for hdu in hdul[1:]:
+            ext = names.get(hdu.name, hdu.name)
+            ext_obj = Extension()
+            ext_obj.header = hdu.header.copy()
+            ext_obj.items = []
+            columns = [(n, hdu.data[n]) for n in hdu.columns.names]
+            cls = record_class(ext, (), [n for n, _ in columns])
+            for i in range(len(hdu.data)):
+                item = cls()
+                for n, values in columns:
+                    setattr(item, n, values[i])
+                ext_obj.items.append(item)
+            setattr(ret, ext, ext_obj)
+    return ret
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("---")[-1])
+    parser.add_argument("fname")
+    parser.add_argument("-n", "--events", type=int, default=100)
+    parser.add_argument("--pixels", type=int, default=DEFAULT_PIXELS)
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument("--vlf", action="store_true",
+                        help="write the byte columns as variable length")
+    parser.add_argument("--strings", action="store_true",
+                        help="write the text columns as strings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--definition", default=DEFAULT_DEFINITION)
+    args = parser.parse_args(argv)
+    size = write_fits(args.fname, args.events, args.pixels, args.samples,
+                      args.vlf, args.strings, args.seed, args.definition)
+    print("%s: %d events, %d bytes"%(args.fname, args.events, size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.convert
+
+--------------------------------------------------------------------------------
+
+This module provides the command line converter of FITS files to HDF5
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from astropy.io import fits
+
+from hpy import hpy
+from hpy.log import logger
+from hpy.utils.memory import loaded_events
+
+## Suffix of the files written
+DEFAULT_SUFFIX = ".h5"
+## Suffix of the manifest written next to each complete output
+DONE_SUFFIX = ".done"
+## Bytes read at once when computing the checksum of an input
+CHECKSUM_BLOCK = 1024 * 1024
+## Suffixes stripped from the input names to name the outputs
+FITS_SUFFIXES = (".fits.fz", ".fits.gz", ".fits", ".fz")
+
+# The umask is process wide, read once rather than changed in every thread
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def output_name(fits_file, output_dir=None, suffix=DEFAULT_SUFFIX):
+    """Returns the HDF5 file written for a FITS file"""
+    name = os.path.basename(fits_file)
+    for s in FITS_SUFFIXES:
+        if name.endswith(s):
+            name = name[:-len(s)]
+            break
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(fits_file))
+    return os.path.join(output_dir, name + suffix)
+
+def checksum(fname):
+    """Returns the sha256 of a file"""
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def input_state(fits_file, with_checksum=False):
+    """Returns what identifies the version of an input converted"""
+    st = os.stat(fits_file)
+    ret = {'input': os.path.abspath(fits_file),
+           'size': st.st_size,
+           'mtime': st.st_mtime}
+    if with_checksum:
+        ret['sha256'] = checksum(fits_file)
+    return ret
+
+def is_complete(fits_file, fname, options, with_checksum=False):
+    """Returns True if fname was completely written from this fits_file
+
+    The manifest written along the output must match the size and
+    modification time of the input, its checksum when asked to, the
+    conversion options and the size of the output.
+    """
+    try:
+        with open(fname + DONE_SUFFIX) as f:
+            done = json.load(f)
+        if os.path.getsize(fname) != done['output_size']:
+            return False
+    except (OSError, ValueError, KeyError):
+        return False
+    if done.get('options') != options:
+        return False
+    state = input_state(fits_file)
+    if done['size'] != state['size'] or done['mtime'] != state['mtime']:
+        return False
+    if with_checksum:
+        return done.get('sha256') == checksum(fits_file)
+    return True
+
+def count_events(fdata):
+    """Returns the events loaded from the extensions of a FITS file"""
+    return sum(loaded_events(ext_obj) for ext_obj in fdata.__dict__.values())
+
+def fits_events(fits_file):
+    """Returns the rows of the binary tables of a FITS file"""
+    with fits.open(fits_file, memmap=True) as hdul:
+        return sum(hdu.header.get('NAXIS2', 0) for hdu in hdul
+                   if isinstance(hdu, fits.BinTableHDU))
+
+def _publish(tmp, fname):
+    # mkstemp creates the file readable by its owner only, the output gets
+    # the mode of a file opened normally
+    os.chmod(tmp, 0o666 & ~_UMASK)
+    os.replace(tmp, fname)
+
+def _write_done(fname, state, options, events):
+    done = dict(state, output=os.path.abspath(fname),
+                output_size=os.path.getsize(fname), options=options,
+                events=events)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname),
+                               prefix=".%s."%(os.path.basename(fname)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(done, f, indent=1)
+    _publish(tmp, fname + DONE_SUFFIX)
+
+def _init_worker(file_configuration, log_file):
+    hpy.init(file_configuration, log_file)
+
+def convert_file(fits_file, fname, fits_mode=hpy.DEFAULT_FITS_MODE,
+                 hpy_mode=hpy.DEFAULT_MODE,
+                 hdf5_format=hpy.DEFAULT_HDF5_FORMAT, r1=None,
+                 with_checksum=False, force=False, **kwargs):
+    """Converts a FITS file into fname
+
+    The file is written to a temporary file in the same directory, renamed
+    to fname once complete, and recorded in the fname.done manifest.
+    Returns a dict with the status, events, bytes and seconds of the
+    conversion.
+    """
+    log = logger().get_log("convert")
+    ret = {'input': fits_file, 'output': fname, 'status': "skipped",
+           'events': 0, 'input_bytes': 0, 'output_bytes': 0, 'seconds': 0.0}
+    options = dict(kwargs, fits_mode=fits_mode, hpy_mode=hpy_mode,
+                   hdf5_format=hdf5_format, r1=r1)
+    if not force and is_complete(fits_file, fname, options, with_checksum):
+        return ret
+    start = time.perf_counter()
+    try:
+        state = input_state(fits_file, with_checksum)
+        ret['input_bytes'] = state['size']
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                                   prefix=".%s."%(os.path.basename(fname)),
+                                   suffix=".part")
+        os.close(fd)
+        try:
+            if r1:
+                ok = hpy.session().create_r1_from_fits(fits_file, tmp, r1)
+                events = fits_events(fits_file) if ok else 0
+            else:
+                with hpy.open_fits(fits_file, fits_mode) as src:
+                    ok = src.create_hdf5(tmp, hpy_mode, hdf5_format, **kwargs)
+                    events = count_events(src._fdata)
+            if not ok:
+                raise RuntimeError("conversion failed")
+            _publish(tmp, fname)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        _write_done(fname, state, options, events)
+    except Exception as e:
+        log.error("Error converting %s: %s"%(fits_file, e))
+        ret['status'] = "failed"
+        ret['error'] = str(e)
+        ret['seconds'] = time.perf_counter() - start
+        return ret
+    ret['status'] = "done"
+    ret['events'] = events
+    ret['output_bytes'] = os.path.getsize(fname)
+    ret['seconds'] = time.perf_counter() - start
+    return ret
+
+def _rates(events, nbytes, seconds):
+    if seconds <= 0:
+        return 0.0, 0.0
+    return events / seconds, nbytes / seconds / 1e6
+
+def format_result(r):
+    """Returns the line printed for the conversion of a file"""
+    if r['status'] != "done":
+        return "%-8s %s -> %s%s"%(r['status'], r['input'], r['output'],
+                                  ": " + r['error'] if 'error' in r else "")
+    evs, mbs = _rates(r['events'], r['input_bytes'], r['seconds'])
+    return "%-8s %s -> %s  %d events  %.2f s  %.1f events/s  %.2f MB/s"%(
+        r['status'], r['input'], r['output'], r['events'], r['seconds'],
+        evs, mbs)
+
+def convert(fits_files, output_dir=None, suffix=DEFAULT_SUFFIX, workers=1,
+            file_configuration=None, log_file=hpy.LOG_FILE_STR,
+            out=sys.stdout, **kwargs):
+    """Converts many FITS files, workers at once
+
+    Each worker is a process of its own, the keyword arguments are passed
+    to convert_file. Returns the list of results of convert_file, in the
+    order of fits_files.
+    """
+    jobs = [(f, output_name(f, output_dir, suffix)) for f in fits_files]
+    if len(set(fname for _, fname in jobs)) != len(jobs):
+        raise ValueError("Several inputs are converted to the same output")
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    results = []
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(file_configuration,
+                                           log_file)) as pool:
+            futures = [pool.submit(convert_file, f, fname, **kwargs)
+                       for f, fname in jobs]
+            for fut in futures:
+                results.append(fut.result())
+                print(format_result(results[-1]), file=out, flush=True)
+    else:
+        _init_worker(file_configuration, log_file)
+        for f, fname in jobs:
+            results.append(convert_file(f, fname, **kwargs))
+            print(format_result(results[-1]), file=out, flush=True)
+    wall = time.perf_counter() - start
+    done = [r for r in results if r['status'] == "done"]
+    events = sum(r['events'] for r in done)
+    nbytes = sum(r['input_bytes'] for r in done)
+    evs, mbs = _rates(events, nbytes, wall)
+    print("%d converted, %d skipped, %d failed  %d events  %.2f s  "
+          "%.1f events/s  %.2f MB/s"%(
+              len(done),
+              sum(r['status'] == "skipped" for r in results),
+              sum(r['status'] == "failed" for r in results),
+              events, wall, evs, mbs), file=out)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="hpy-convert",
+        description="Converts FITS files to HDF5")
+    parser.add_argument("inputs", nargs="+", help="FITS files to convert")
+    parser.add_argument("-o", "--output-dir", default=None,
+                        help="directory of the outputs, the one of each "
+                        "input by default")
+    parser.add_argument("--suffix", default=DEFAULT_SUFFIX)
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="files converted at once")
+    parser.add_argument("--fits-mode", default=hpy.DEFAULT_FITS_MODE,
+                        choices=sorted(hpy.FITS_MODE_MAP))
+    parser.add_argument("--hpy-mode", default=hpy.DEFAULT_MODE,
+                        choices=sorted(m for m, v in hpy.HPY_MODE_MAP.items()
+                                       if v))
+    parser.add_argument("--format", dest="hdf5_format",
+                        default=hpy.DEFAULT_HDF5_FORMAT,
+                        choices=sorted(hpy.HDF5_FORMAT))
+    parser.add_argument("--r1", default=None, choices=["v1", "v2"],
+                        help="write the R1 data model of this version "
+                        "instead")
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--compression", default=None,
+                        help="compression of the datasets, e.g. gzip for "
+                        "h5py or blosc for pytables")
+    parser.add_argument("--compression-opts", type=int, default=None,
+                        help="compression level")
+    parser.add_argument("--checksum", dest="with_checksum",
+                        action="store_true",
+                        help="also compare the checksum of the inputs to "
+                        "skip the complete outputs")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="convert the inputs already converted")
+    parser.add_argument("--config", dest="file_configuration", default=None)
+    parser.add_argument("--log-config", dest="log_file",
+                        default=hpy.LOG_FILE_STR)
+    args = vars(parser.parse_args(argv))
+    for k in ('batch_size', 'compression', 'compression_opts'):
+        if args[k] is None:
+            args.pop(k)
+    try:
+        results = convert(args.pop('inputs'), **args)
+    except ValueError as e:
+        parser.error(str(e))
+    return 1 if any(r['status'] == "failed" for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
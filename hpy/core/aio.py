@@ -0,0 +1,140 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.aio
+
+--------------------------------------------------------------------------------
+
+This module provides the asyncio interface of the readers
+"""
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hpy.log import logger
+from hpy.core.cache import assemble_rows
+from hpy.core.h5base import DEFAULT_EXTENSION
+
+## Default number of threads reading for an async_reader
+DEFAULT_ASYNC_WORKERS = 4
+
+class async_reader:
+    """@class async_reader
+    This class provides an asyncio facade over h5_reader and h5table_reader
+
+    Reads run in a dedicated bounded thread pool so that decompression never
+    blocks the event loop, as do the planning of a read, which takes the
+    h5py lock, and the assembly of its rows. The loop only awaits them. Concurrent requests for the same chunk share a
+    single read, and a cancelled request only drops that read when no other
+    request is waiting for it. Sequential reads feed the read ahead of the
+    reader when it was opened with a prefetch depth.
+    """
+    def __init__(self, reader, max_workers=DEFAULT_ASYNC_WORKERS, owner=False):
+        self.log = logger().get_log("async_reader")
+        self._reader = reader
+        self._owner = owner
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix="hpy-read")
+        self._inflight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_event_loop().run_in_executor(None, self.close)
+
+    async def get_dataset(self, dname, parent=None):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._pool, self.__get_dataset,
+                                          dname, parent)
+
+    async def read(self, dname, sel=None, parent=None):
+        dset = await self.get_dataset(dname, parent)
+        if dset is None:
+            self.log.error("Dataset %s not found"%(dname))
+            return None
+        return await self.read_dataset(dset, sel)
+
+    async def read_dataset(self, dset, sel=None):
+        loop = asyncio.get_event_loop()
+        plan = await loop.run_in_executor(self._pool, self._reader._plan_read,
+                                          dset, sel)
+        if plan is None or not plan[5]:
+            return await loop.run_in_executor(self._pool,
+                                              self._reader.read_dataset,
+                                              dset, sel)
+        key, nrows, chunk_rows, rows, rest, ids = plan
+        chunks = await asyncio.gather(*[
+            self.__chunk(loop, dset, key, ci, nrows, chunk_rows)
+            for ci in ids])
+        return await loop.run_in_executor(self._pool, self.__assemble,
+                                          dset, sel, plan, chunks)
+
+    async def gather(self, column, ext=DEFAULT_EXTENSION):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._pool, self._reader.gather,
+                                          column, ext, 1)
+
+    def close(self):
+        if not self._pool:
+            return
+        self._pool.shutdown(wait=True)
+        self._pool = None
+        if self._owner:
+            self._reader.close()
+
+    def __assemble(self, dset, sel, plan, chunks):
+        key, nrows, chunk_rows, rows, rest, ids = plan
+        prefetch = self._reader._prefetch
+        if prefetch and (isinstance(rows, int) or rows.step > 0):
+            prefetch.observe(dset, key, ids, nrows, chunk_rows)
+        data = assemble_rows(dict(zip(ids, chunks)), rows, chunk_rows, rest)
+        return self._reader._transform_rows(dset, data, sel)
+
+    def __get_dataset(self, dname, parent):
+        with self._reader._lock:
+            return self._reader.get_dataset(dname, parent)
+
+    async def __chunk(self, loop, dset, key, ci, nrows, chunk_rows):
+        ckey = key + (ci,)
+        cache = self._reader._cache
+        data = cache.lookup(ckey) if cache else None
+        if data is not None:
+            return data
+        entry = self._inflight.get(ckey)
+        if entry is None or entry[0].cancelled():
+            fut = loop.run_in_executor(self._pool, self._reader._load_chunk,
+                                       dset, key, ci, nrows, chunk_rows)
+            entry = [fut, 0]
+            self._inflight[ckey] = entry
+            fut.add_done_callback(
+                lambda f, k=ckey, e=entry: self.__done(k, e))
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                # Nobody waits for this chunk anymore
+                entry[0].cancel()
+
+    def __done(self, ckey, entry):
+        if self._inflight.get(ckey) is entry:
+            del self._inflight[ckey]
@@ -0,0 +1,221 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.cache
+
+--------------------------------------------------------------------------------
+
+This module provides the cache of decoded chunks shared by the readers
+"""
+import os
+import threading
+import collections
+
+import numpy as np
+
+from hpy.log import logger
+
+## Default byte budget of the chunk cache
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+## Rows per block for datasets stored without chunks
+CONTIGUOUS_CHUNK_BYTES = 1024 * 1024
+
+class chunk_cache:
+    """@class chunk_cache
+    This class keeps the decoded chunks of the datasets read
+
+    Chunks are keyed by (file, dataset, chunk index) and evicted in least
+    recently used order once the byte budget is exceeded. It uses the
+    singleton pattern so that every reader shares the same budget.
+    """
+    class __cache:
+        """Private class to feature the singleton pattern"""
+        def __init__(self, max_bytes):
+            self.log = logger().get_log("chunk_cache")
+            self._lock = threading.Lock()
+            self._entries = collections.OrderedDict()
+            self.max_bytes = max_bytes
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+        def lookup(self, key):
+            """Returns the chunk stored for the key, None if it is missing"""
+            with self._lock:
+                data = self._entries.get(key)
+                if data is None:
+                    self.misses += 1
+                    return None
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        def contains(self, key):
+            """Returns True if the key is cached, without touching the stats"""
+            with self._lock:
+                return key in self._entries
+
+        def store(self, key, data):
+            """Stores a chunk, evicting the least recently used ones"""
+            size = data.nbytes
+            with self._lock:
+                if size > self.max_bytes:
+                    return data
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.nbytes -= old.nbytes
+                self._entries[key] = data
+                self.nbytes += size
+                self.__evict()
+            return data
+
+        def resize(self, max_bytes):
+            """Sets a new byte budget"""
+            with self._lock:
+                self.max_bytes = max_bytes
+                self.__evict()
+
+        def invalidate(self, fname=None):
+            """Drops the chunks of the given file, or every chunk"""
+            with self._lock:
+                if fname is None:
+                    self._entries.clear()
+                    self.nbytes = 0
+                    return
+                fname = os.path.abspath(fname)
+                for key in [k for k in self._entries if k[0][0] == fname]:
+                    self.nbytes -= self._entries.pop(key).nbytes
+
+        def stats(self):
+            """Returns the hit/miss statistics of the cache"""
+            with self._lock:
+                lookups = self.hits + self.misses
+                return {'hits': self.hits,
+                        'misses': self.misses,
+                        'evictions': self.evictions,
+                        'hit_rate': self.hits / lookups if lookups else 0.0,
+                        'entries': len(self._entries),
+                        'nbytes': self.nbytes,
+                        'max_bytes': self.max_bytes}
+
+        def __evict(self):
+            while self.nbytes > self.max_bytes and self._entries:
+                _, data = self._entries.popitem(last=False)
+                self.nbytes -= data.nbytes
+                self.evictions += 1
+        #
+        #
+        #
+    def __init__(self, max_bytes=None):
+        """Constructor
+
+        The constructor will create a new __cache object in case there is
+        none initialized, otherwise it will resize the existing one if a
+        new budget is given
+        """
+        if not chunk_cache.instance:
+            if max_bytes is None:
+                max_bytes = DEFAULT_CACHE_BYTES
+            chunk_cache.instance = chunk_cache.__cache(max_bytes)
+        elif max_bytes is not None:
+            chunk_cache.instance.resize(max_bytes)
+
+    def get(self):
+        """Returns the cache instance"""
+        return chunk_cache.instance
+
+    instance = None
+
+def file_key(fname):
+    """Returns the part of the chunk keys identifying a file version"""
+    fname = os.path.abspath(fname)
+    return (fname, os.path.getmtime(fname))
+
+def contiguous_rows(shape, dtype):
+    """Returns the rows per block of a dataset stored without chunks"""
+    row_bytes = max(1, dtype.itemsize * int(np.prod(shape[1:])))
+    return max(1, CONTIGUOUS_CHUNK_BYTES // row_bytes)
+
+def select_rows(sel, nrows):
+    """Splits a selection into the rows of the leading axis and the rest
+
+    Returns (rows, rest) where rows is an int or a range, or None when the
+    selection can not be served by chunks (fancy indexing, fields...)
+    """
+    rest = ()
+    if isinstance(sel, tuple):
+        if not sel:
+            return None
+        sel, rest = sel[0], sel[1:]
+    if sel is None or sel is Ellipsis:
+        if rest:
+            return None
+        return range(nrows), rest
+    if isinstance(sel, (int, np.integer)) and not isinstance(sel, bool):
+        i = int(sel)
+        if i < 0:
+            i += nrows
+        if not 0 <= i < nrows:
+            raise IndexError("Index %d out of range for %d rows"%(sel, nrows))
+        return i, rest
+    if isinstance(sel, slice):
+        return range(*sel.indices(nrows)), rest
+    return None
+
+def chunk_ids(rows, chunk_rows):
+    """Returns the indexes of the chunks holding the selected rows"""
+    if isinstance(rows, int):
+        return [rows // chunk_rows]
+    if not rows:
+        return []
+    if abs(rows.step) <= chunk_rows:
+        lo = min(rows[0], rows[-1])
+        hi = max(rows[0], rows[-1])
+        return list(range(lo // chunk_rows, hi // chunk_rows + 1))
+    return sorted(set(r // chunk_rows for r in rows))
+
+def assemble_rows(chunks, rows, chunk_rows, rest):
+    """Builds the selection from the chunks holding it"""
+    if isinstance(rows, int):
+        out = chunks[rows // chunk_rows][rows % chunk_rows]
+        if rest:
+            out = out[rest]
+    else:
+        ids = sorted(chunks)
+        if abs(rows.step) <= chunk_rows:
+            base = ids[0] * chunk_rows
+            if len(ids) == 1:
+                block = chunks[ids[0]]
+            else:
+                block = np.concatenate([chunks[i] for i in ids])
+            if rows.step > 0:
+                out = block[rows.start - base:rows.stop - base:rows.step]
+            else:
+                out = block[np.asarray(rows) - base]
+        else:
+            out = np.stack([chunks[r // chunk_rows][r % chunk_rows]
+                            for r in rows])
+        if rest:
+            out = out[(slice(None),) + rest]
+    # Cached chunks are read-only, hand a private copy to the caller
+    if isinstance(out, np.ndarray) and not out.flags.writeable:
+        out = out.copy()
+    return out
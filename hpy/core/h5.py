@@ -25,11 +25,17 @@ along with HPY.  If not, see <http://www.gnu.org/licenses/>.
 This module provides the HDF5 interface
 """
 
+import threading
+
 import h5py
 import numpy as np
 
 from hpy.log import logger
-from hpy.core.h5base import h5writerbase, h5readerbase
+from hpy.core.h5base import h5writerbase, h5readerbase, sort_event_groups, \
+    ragged_arrays, batch_columns, RAGGED_ATTR, RAGGED_VALUES, RAGGED_OFFSETS
+from hpy.utils.container import ContainerBatch
+from hpy.core.cache import chunk_cache, file_key, contiguous_rows
+from hpy.core.prefetch import prefetcher
 
 COMPRESSION_TYPES = ["gzip", "lzf", "szip"]
 
@@ -157,6 +163,83 @@ class h5_writer(h5writerbase):
             dset.resize((dset.shape[0] + 1, len(data)))
         dset[old_len:] = data
         
+    def append_ragged(self, dsname, rows, parent=None):
+        if not parent: parent = self._f
+        if not len(rows):
+            return None
+        try:
+            values, ends = ragged_arrays(rows)
+        except ValueError:
+            self.log.error("Rows of %s with different trailing shapes"%(dsname))
+            return None
+        if values.dtype.kind == 'O':
+            self.log.error("Unsupported ragged type of %s"%(dsname))
+            return None
+        group = parent.get(dsname)
+        if group is None:
+            self.log.info("Creating ragged column %s in %s"%(dsname, parent.name))
+            group = parent.create_group(dsname)
+            group.attrs[RAGGED_ATTR] = True
+            group.create_dataset(RAGGED_VALUES, data=values, chunks=True,
+                                 maxshape=(None,) + values.shape[1:],
+                                 **self.__compression_args())
+            group.create_dataset(RAGGED_OFFSETS,
+                                 data=np.concatenate(([0], ends)), chunks=True,
+                                 maxshape=(None,), **self.__compression_args())
+            return group
+        if not group.attrs.get(RAGGED_ATTR):
+            self.log.error("%s is not a ragged column"%(group.name))
+            return None
+        dvalues = group[RAGGED_VALUES]
+        doffsets = group[RAGGED_OFFSETS]
+        nvalues = dvalues.shape[0]
+        noffsets = doffsets.shape[0]
+        dvalues.resize((nvalues + len(values),) + dvalues.shape[1:])
+        dvalues[nvalues:] = values
+        doffsets.resize((noffsets + len(ends),))
+        doffsets[noffsets:] = ends + doffsets[noffsets - 1]
+        return group
+
+    def append_batch(self, batch, parent=None):
+        if not parent: parent = self._f
+        for name, column, ragged in batch_columns(batch):
+            if isinstance(column, ContainerBatch):
+                self.append_batch(column, self.create_group(name, parent))
+                continue
+            dset = parent.get(name)
+            # A column stays ragged once written so, whatever the batch
+            if dset is None and ragged or \
+               dset is not None and dset.attrs.get(RAGGED_ATTR):
+                self.append_ragged(name, column, parent)
+                continue
+            if column.dtype.kind == 'U':
+                column = column.astype(h5py.string_dtype())
+            elif column.dtype.kind == 'O':
+                self.log.error("Unsupported batch column %s"%(name))
+                continue
+            if dset is None:
+                self.log.info("Creating dataset %s in %s"%(name, parent.name))
+                parent.create_dataset(name, data=column, chunks=True,
+                                      maxshape=(None,) + column.shape[1:],
+                                      **self.__compression_args())
+                continue
+            if not isinstance(dset, h5py.Dataset) or dset.chunks is None or \
+               dset.shape[1:] != column.shape[1:]:
+                self.log.error("Can not append the batch column %s to %s"%(
+                    name, dset.name))
+                continue
+            nrows = dset.shape[0]
+            dset.resize((nrows + len(column),) + dset.shape[1:])
+            dset[nrows:] = column
+
+    def __compression_args(self):
+        if not self._compression:
+            return {}
+        if self._compression == COMPRESSION_TYPES[0]:
+            return {'compression': self._compression,
+                    'compression_opts': self._compression_opts}
+        return {'compression': self._compression}
+        
     def __init__(self, fname=None, mode='w', 
                  compression=None, compression_opts=0, **kwargs):
         super().__init__()
@@ -223,12 +306,59 @@ class h5_reader(h5readerbase):
         if not parent: parent = self._f
         return self.__get_group(gname, parent)
 
-    def __init__(self, fname=None, mode='r'):
+    def _dataset_layout(self, dset):
+        if not dset.shape or dset.dtype.kind == 'O':
+            return None
+        if dset.chunks:
+            chunk_rows = dset.chunks[0]
+        else:
+            chunk_rows = contiguous_rows(dset.shape, dset.dtype)
+        return (self._file_key, dset.name), dset.shape[0], chunk_rows
+
+    def _read_rows(self, dset, start, stop):
+        with self._lock:
+            return dset[start:stop]
+
+    def _read_direct(self, dset, sel):
+        with self._lock:
+            if sel is None:
+                return dset[()]
+            return dset[sel]
+
+    def _list_event_groups(self, ext):
+        data = self._f.get("%s/data"%(ext))
+        if type(data) != h5py._hl.group.Group:
+            return []
+        return [data.name + "/" + n for n in sort_event_groups(data.keys(), ext)]
+
+    def _find_column(self, column, group_path):
+        dset = self.get_dataset(column, self._f[group_path])
+        if dset is None:
+            return None
+        return dset.name[len(group_path) + 1:]
+
+    def _read_event_value(self, path):
+        # h5py serializes the calls to the library on its own
+        dset = self._f.get(path)
+        if type(dset) != h5py._hl.dataset.Dataset:
+            return None
+        return dset[()]
+
+    def __init__(self, fname=None, mode='r', cache=True, prefetch=0):
         
         self.log = logger().get_log("h5")
+        self._lock = threading.RLock()
+        self._event_groups = {}
         self._f = h5py.File(fname, mode)
+        self._file_key = file_key(self._f.filename)
+        if cache:
+            self._cache = chunk_cache().get()
+        if prefetch:
+            self._prefetch = prefetcher(self._read_chunk, self._cache, prefetch)
 
     def close(self):
+        if self._prefetch:
+            self._prefetch.close()
         self._f.close()
         self._f = None
 
@@ -24,7 +24,27 @@ along with HPY.  If not, see <http://www.gnu.org/licenses/>.
 
 This module provides the base interface
 """
+import re
+
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from hpy.core.cache import select_rows, chunk_ids, assemble_rows
+
+## Extension gathered by default
+DEFAULT_EXTENSION = "Events"
+## Threads reading the event groups of a gather
+DEFAULT_GATHER_WORKERS = 4
+## Name of the event groups of the bygroups layout, i.e. Events_00000042
+EVENT_GROUP_RE = re.compile(r"^(?P<ext>.+)_(?P<index>\d{8,})$")
+## Attribute flagging the groups holding a ragged column
+RAGGED_ATTR = "hpy_ragged"
+## Dataset of a ragged column holding the values of every row, one after other
+RAGGED_VALUES = "values"
+## Dataset of a ragged column holding where each row starts, plus the end
+RAGGED_OFFSETS = "offsets"
 
 class h5writerbase(metaclass=ABCMeta):
     @abstractmethod
@@ -39,6 +59,12 @@ class h5writerbase(metaclass=ABCMeta):
     @abstractmethod
     def create_special_dtype(self, vlen):
         pass
+    @abstractmethod
+    def append_ragged(self, dsname, rows, parent=None):
+        pass
+    @abstractmethod
+    def append_batch(self, batch, parent=None):
+        pass
     
 class h5readerbase(metaclass=ABCMeta):
     @abstractmethod
@@ -47,4 +73,235 @@ class h5readerbase(metaclass=ABCMeta):
     @abstractmethod
     def get_group(self, gname, parent):
         pass
+    @abstractmethod
+    def _dataset_layout(self, dset):
+        pass
+    @abstractmethod
+    def _read_rows(self, dset, start, stop):
+        pass
+    @abstractmethod
+    def _read_direct(self, dset, sel):
+        pass
+    @abstractmethod
+    def _list_event_groups(self, ext):
+        pass
+    @abstractmethod
+    def _find_column(self, column, group_path):
+        pass
+    @abstractmethod
+    def _read_event_value(self, path):
+        pass
+
+    def read(self, dname, sel=None, parent=None):
+        dset = self.get_dataset(dname, parent)
+        if dset is None:
+            self.log.error("Dataset %s not found"%(dname))
+            return None
+        return self.read_dataset(dset, sel)
+
+    def read_dataset(self, dset, sel=None):
+        return self._transform_rows(dset, self.__read_selection(dset, sel), sel)
+
+    def __read_selection(self, dset, sel):
+        plan = self._plan_read(dset, sel)
+        if plan is None:
+            return self._read_direct(dset, sel)
+        key, nrows, chunk_rows, rows, rest, ids = plan
+        if not ids:
+            out = self._read_rows(dset, 0, 0)
+            return out[(slice(None),) + rest] if rest else out
+        chunks = {}
+        for ci in ids:
+            chunks[ci] = self._load_chunk(dset, key, ci, nrows, chunk_rows)
+        if self._prefetch and (isinstance(rows, int) or rows.step > 0):
+            self._prefetch.observe(dset, key, ids, nrows, chunk_rows)
+        return assemble_rows(chunks, rows, chunk_rows, rest)
+
+    def iterate(self, dname, rows=None, parent=None):
+        dset = self.get_dataset(dname, parent)
+        if dset is None:
+            self.log.error("Dataset %s not found"%(dname))
+            return
+        layout = self._dataset_layout(dset)
+        if layout is None:
+            yield self.read_dataset(dset)
+            return
+        _, nrows, chunk_rows = layout
+        if not rows: rows = chunk_rows
+        for start in range(0, nrows, rows):
+            yield self.read_dataset(dset, slice(start, start + rows))
+
+    def read_ragged(self, dname, sel=None, parent=None):
+        group = self.get_group(dname, parent)
+        values = offsets = None
+        if group is not None:
+            values = self.get_dataset(RAGGED_VALUES, group)
+            offsets = self.get_dataset(RAGGED_OFFSETS, group)
+        if values is None or offsets is None:
+            self.log.error("Ragged column %s not found"%(dname))
+            return None
+        offsets = self.read_dataset(offsets)
+        nrows = len(offsets) - 1
+        if isinstance(sel, (int, np.integer)):
+            i = range(nrows)[sel]
+            return self.read_dataset(values, slice(offsets[i], offsets[i + 1]))
+        if sel is None:
+            rows = range(nrows)
+        elif isinstance(sel, slice):
+            rows = range(*sel.indices(nrows))
+        else:
+            rows = [range(nrows)[i] for i in sel]
+        if isinstance(rows, range) and rows.step == 1:
+            if not rows:
+                return []
+            # A single read of the values of the whole run of rows
+            start = offsets[rows.start]
+            block = self.read_dataset(values, slice(start, offsets[rows.stop]))
+            bounds = offsets[rows.start + 1:rows.stop] - start
+            return np.split(block, bounds)
+        return [self.read_dataset(values, slice(offsets[i], offsets[i + 1]))
+                for i in rows]
+
+    def prefetch_stats(self):
+        if not self._prefetch:
+            return None
+        return self._prefetch.stats()
+
+    def event_groups(self, ext=DEFAULT_EXTENSION):
+        if ext not in self._event_groups:
+            self._event_groups[ext] = self._list_event_groups(ext)
+        return self._event_groups[ext]
+
+    def gather(self, column, ext=DEFAULT_EXTENSION,
+               workers=DEFAULT_GATHER_WORKERS):
+        groups = self.event_groups(ext)
+        if not groups:
+            self.log.error("No event groups found in %s"%(ext))
+            return None
+        path = column
+        if not "/" in column:
+            path = self._find_column(column, groups[0])
+        if path is None:
+            self.log.error("Column %s not found in %s"%(column, groups[0]))
+            return None
+        paths = [g + "/" + path for g in groups]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                values = list(pool.map(self._read_event_value, paths))
+        else:
+            values = [self._read_event_value(p) for p in paths]
+        found = [v for v in values if v is not None]
+        if len(found) == len(values):
+            return stack_values(found)
+        self.log.warning("%d events without %s"%(len(values) - len(found),
+                                                 column))
+        # Row i stays the value of event i, missing values are masked
+        return mask_missing(values, stack_values(found))
+
+    def _transform_rows(self, dset, data, sel):
+        return data
+
+    def _plan_read(self, dset, sel):
+        if not self._cache and not self._prefetch:
+            return None
+        layout = self._dataset_layout(dset)
+        if layout is None:
+            return None
+        key, nrows, chunk_rows = layout
+        selection = select_rows(sel, nrows)
+        if selection is None:
+            return None
+        rows, rest = selection
+        return key, nrows, chunk_rows, rows, rest, chunk_ids(rows, chunk_rows)
+
+    def _load_chunk(self, dset, key, ci, nrows, chunk_rows):
+        data = None
+        if self._cache:
+            data = self._cache.lookup(key + (ci,))
+        if data is None and self._prefetch:
+            data = self._prefetch.take(key, ci)
+            if data is not None and self._cache:
+                self._cache.store(key + (ci,), data)
+        if data is None:
+            data = self._fetch_chunk(dset, key, ci, nrows, chunk_rows)
+        return data
+
+    def _fetch_chunk(self, dset, key, ci, nrows, chunk_rows):
+        data = self._read_chunk(dset, ci, nrows, chunk_rows)
+        if self._cache:
+            self._cache.store(key + (ci,), data)
+        return data
+
+    def _read_chunk(self, dset, ci, nrows, chunk_rows):
+        start = ci * chunk_rows
+        data = self._read_rows(dset, start, min(start + chunk_rows, nrows))
+        data.flags.writeable = False
+        return data
+
+    _cache = None
+    _prefetch = None
+
+def sort_event_groups(names, ext):
+    """Returns the event group names of an extension sorted by index"""
+    ret = []
+    for name in names:
+        m = EVENT_GROUP_RE.match(name)
+        if m and m.group('ext') == ext:
+            ret.append((int(m.group('index')), name))
+    return [name for _, name in sorted(ret)]
+
+def ragged_arrays(rows):
+    """Returns the values of a list of rows, one after other, and the
+    offset where each row ends
+    """
+    rows = [np.atleast_1d(np.asarray(r)) for r in rows]
+    lengths = np.fromiter((len(r) for r in rows), dtype=np.int64,
+                          count=len(rows))
+    return np.concatenate(rows), np.cumsum(lengths)
+
+def batch_columns(batch):
+    """Yields (name, column, ragged) for the columns of a batch with events
+
+    Sub-batches are yielded as they are, object columns of strings are
+    converted to a string array, object columns holding numeric arrays are
+    stacked, or flagged as ragged when their shapes differ.
+    """
+    if not len(batch):
+        return
+    for name, column in batch.items():
+        if isinstance(column, np.ndarray) and column.dtype.kind == 'O':
+            if all(isinstance(v, str) for v in column):
+                yield name, column.astype(str), False
+                continue
+            if all(isinstance(v, np.ndarray) and v.dtype.kind in 'biufc'
+                   for v in column):
+                column = stack_values(column)
+                yield name, column, column.dtype.kind == 'O'
+                continue
+        yield name, column, False
+
+def mask_missing(values, found):
+    """Returns the values of every event in a masked array, the stacked
+    found ones in place and the missing (None) ones masked
+    """
+    ret = np.ma.masked_all((len(values),) + found.shape[1:], dtype=found.dtype)
+    if len(found):
+        ret[[i for i, v in enumerate(values) if v is not None]] = found
+    return ret
+
+def stack_values(values):
+    """Stacks the per event values along a new leading event axis
+
+    Values with different shapes are returned in an object array
+    """
+    arrays = [np.asarray(v) for v in values]
+    if not arrays:
+        return np.array([])
+    if all(a.shape == arrays[0].shape and a.dtype == arrays[0].dtype
+           for a in arrays):
+        return np.stack(arrays)
+    ret = np.empty(len(arrays), dtype=object)
+    for i, a in enumerate(arrays):
+        ret[i] = a
+    return ret
     
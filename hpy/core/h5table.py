@@ -24,41 +24,131 @@ along with HPY.  If not, see <http://www.gnu.org/licenses/>.
 
 This module provides the pytables interface
 """
+import ast
+import threading
+
 import tables
+import numexpr
 
 import numpy as np
 
 from hpy.log import logger
+from hpy.utils.warehouse import warehouse
 from hpy.core.table import table_writer, table_reader
-from hpy.utils.data_container import data_container
-
-PYTABLES_TYPE_MAP = {
-    'float': tables.Float64Col,
-    'float64': tables.Float64Col,
-    'float32': tables.Float32Col,
-    'int': tables.IntCol,
-    'int8': tables.Int8Col,
-    'int16': tables.Int16Col,
-    'int32': tables.Int32Col,
-    'int64': tables.Int64Col,
-    'uint': tables.UIntCol,
-    'uint8': tables.UInt8Col,
-    'uint16': tables.UInt16Col,
-    'uint32': tables.UInt32Col,
-    'uint64': tables.UInt64Col,
-    'bool': tables.BoolCol,
-    'str': tables.StringCol,
-}
+from hpy.core.cache import chunk_cache, file_key
+from hpy.core.prefetch import prefetcher
+from hpy.core.schema import PYTABLES_TYPE_MAP, schema_registry, column_spec, \
+    merge_specs, compile_description, current_key, cache_dir, definition_spec
+from hpy.core.h5base import sort_event_groups, ragged_arrays, batch_columns, \
+    RAGGED_ATTR, RAGGED_VALUES, RAGGED_OFFSETS
+from hpy.utils.data_container import data_container, field_container
+from hpy.utils.container import ContainerBatch
+
 
 COMPRESSION_FILTERS_TYPES = ['zlib', 'lzo', 'bzip2', 'blosc']
 
+## Rows appended to a table before flushing it, 1 flushes every row
+DEFAULT_FLUSH_EVERY = 1
+## Column of the tables holding a single field
+DATA_COLUMN = "data"
+## Bytes per row from which array fields are stored as EArrays, 0 disables it
+DEFAULT_ARRAY_THRESHOLD = 16 * 1024
+## Compression of the EArrays holding the array fields
+ARRAY_FILTERS = tables.Filters(complevel=5, complib='blosc', shuffle=True)
+
+# PyTables is not thread safe, every threaded access to a file goes through
+# this lock
+PYTABLES_LOCK = threading.RLock()
+
+class node_map:
+    """@class node_map
+    This class maps the names of the nodes of a file to their paths
+
+    Every node is registered under each of its ancestors, so finding the
+    first node with a given name below a group is a dictionary lookup
+    whatever the size of the file.
+    """
+    def __init__(self):
+        self._groups = {}
+        self._leaves = {}
+
+    def add(self, node):
+        """Registers a node under itself and its ancestors"""
+        names = self._leaves if isinstance(node, tables.Leaf) else self._groups
+        name = node._v_name
+        path = ancestor = node._v_pathname
+        names.setdefault((path, name), path)
+        while ancestor != "/":
+            ancestor = ancestor.rsplit("/", 1)[0] or "/"
+            names.setdefault((ancestor, name), path)
+
+    def add_tree(self, group):
+        """Registers every node below a group, depth first"""
+        stack = list(reversed(list(group)))
+        while stack:
+            node = stack.pop()
+            self.add(node)
+            if isinstance(node, tables.group.Group):
+                stack.extend(reversed(list(node)))
+
+    def find(self, name, parent, leaf=True):
+        """Returns the path of the first node named name below parent"""
+        names = self._leaves if leaf else self._groups
+        return names.get((parent._v_pathname, name))
+
+def split_condition(condition):
+    """Splits a condition at its top level & and | operators
+
+    Returns the list of operands and the list of operators joining them
+    """
+    parts, ops = [], []
+    depth, start, quote = 0, 0, None
+    for i, ch in enumerate(condition):
+        if quote:
+            if ch == quote: quote = None
+        elif ch in "'\"":
+            quote = ch
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch in '&|' and depth == 0:
+            parts.append(condition[start:i].strip())
+            ops.append(ch)
+            start = i + 1
+    parts.append(condition[start:].strip())
+    return parts, ops
+
+def normalize_condition(condition):
+    """Parenthesizes the operands of the top level & and | operators
+
+    numexpr binds & and | tighter than comparisons, this allows writing
+    "trigger_type == 1 & event_id > 1000"
+    """
+    parts, ops = split_condition(condition)
+    if not ops:
+        return parts[0]
+    ret = "(%s)"%(parts[0])
+    for op, part in zip(ops, parts[1:]):
+        ret += " %s (%s)"%(op, part)
+    return ret
+
+def condition_names(condition):
+    """Returns the variables used in a condition"""
+    tree = ast.parse(condition, mode='eval')
+    funcs = set(id(n.func) for n in ast.walk(tree) if isinstance(n, ast.Call))
+    return sorted(set(n.id for n in ast.walk(tree)
+                      if isinstance(n, ast.Name) and not id(n) in funcs))
+
 class h5table_writer(table_writer):
 
     def create_group(self, gname, parent = None):
         if not parent: parent = self._f.root
         if not gname in parent:
             self.log.info("Creating group %s in %s"%(gname, parent._v_name))
-            return self._f.create_group(parent, gname)
+            group = self._f.create_group(parent, gname)
+            self._nodes.add(group)
+            return group
         return getattr(parent, gname)
 
     def create_dataset(self, dsname, data, parent=None, dtype=None):
@@ -69,6 +159,12 @@ class h5table_writer(table_writer):
 
         if isinstance(datasets, data_container):
             datasets = (datasets,)
+
+        if len(datasets) == 1 and not datasets[0].meta and \
+           list(datasets[0].keys()) == [DATA_COLUMN]:
+            # A single field is a column of one value
+            return self.append_column(dsname, [datasets[0][DATA_COLUMN]],
+                                      parent)
         
         table = self.__check_table(dsname, parent)
         if not table:
@@ -95,29 +191,168 @@ class h5table_writer(table_writer):
         pass
 
     def check_dataset(self, dname, parent = None):
-        if not parent: return self.check_dataset(dname, self._f.root)
+        if parent is None: parent = self._f.root
         if not isinstance(parent, tables.table.Table) and \
-           not isinstance(parent, tables.group.RootGroup) and \
            not isinstance(parent, tables.group.Group):
             return None
-        if parent._v_name == dname and \
-           (isinstance(parent, tables.table.Table)): 
-            return parent
-        for k in parent:
-            ret = self.check_dataset(dname, k)
-            if ret: return ret
-        return None 
+        path = self._nodes.find(dname, parent)
+        if not path:
+            return None
+        ret = self._f.get_node(path)
+        if not isinstance(ret, tables.table.Table):
+            return None
+        return ret
 
     def append_data(self, datasets, table):
         row = table.row
         for dataset in datasets:
             for colname in filter(lambda c:c in table.colnames,
                                   dataset.keys()):
-                value = self._apply_col_transform(
-                    table._v_name, colname, dataset[colname])
+                value = self._transform_value(
+                    table._v_pathname, colname, dataset[colname])
                 row[colname] = value
         row.append()
-        table.flush()
+        self.__rows_appended(table)
+
+    def append_column(self, dsname, values, parent=None):
+        if not parent: parent = self._f.root
+        if not len(values):
+            return
+        # Transforms run once per batch, before sizing the table or array
+        values = self._transform_column(self.__node_path(dsname, parent),
+                                        DATA_COLUMN, values)
+        array = self.__check_array(dsname, parent, values[0])
+        if array is not None:
+            self.__append_array(array, values)
+            return
+        table_name = self.__check_table(dsname, parent)
+        if not table_name:
+            first = values[0]
+            if isinstance(first, str):
+                first = max(values, key=len)
+            table_name = self.__create_new_table(
+                dsname, parent, (self.__column_container(first),),
+                transformed=True)
+        table = self._tables[table_name]
+        if DATA_COLUMN in table.colnames:
+            rows = np.empty(len(values), dtype=table.dtype)
+            try:
+                rows[DATA_COLUMN] = values
+            except (ValueError, TypeError):
+                rows = None
+            if rows is not None:
+                table.append(rows)
+                self.__rows_appended(table, len(values))
+                return
+        # Values not matching the table description, append them one by one
+        for v in values:
+            self.__append_row(table_name, (self.__column_container(v),),
+                              transformed=True)
+
+    def append_ragged(self, dsname, rows, parent=None):
+        if not parent: parent = self._f.root
+        if not len(rows):
+            return None
+        try:
+            values, ends = ragged_arrays(rows)
+        except ValueError:
+            self.log.error("Rows of %s with different trailing shapes"%(dsname))
+            return None
+        if values.dtype.kind == 'O':
+            self.log.error("Unsupported ragged type of %s"%(dsname))
+            return None
+        group = None
+        if dsname in parent:
+            group = parent._f_get_child(dsname)
+        if group is None:
+            group = self.create_group(dsname, parent)
+            group._v_attrs[RAGGED_ATTR] = True
+            for name, data in ((RAGGED_VALUES, values),
+                               (RAGGED_OFFSETS, np.zeros(1, dtype=np.int64))):
+                hints = self.__node_hints(group._v_pathname, data.shape[1:])
+                if name == RAGGED_VALUES and 'expectedrows' in hints:
+                    # The hint counts rows, each holding len(values)/len(ends)
+                    # values on average
+                    hints['expectedrows'] = max(1, int(
+                        hints['expectedrows'] * len(values) / len(ends)))
+                earray = self._f.create_earray(
+                    group, name, atom=tables.Atom.from_dtype(data.dtype.base),
+                    shape=(0,) + data.shape[1:], **hints)
+                earray.append(data)
+                self._nodes.add(earray)
+            group._f_get_child(RAGGED_OFFSETS).append(ends)
+            return group
+        if not isinstance(group, tables.group.Group) or \
+           not RAGGED_ATTR in group._v_attrs:
+            self.log.error("%s is not a ragged column"%(group._v_pathname))
+            return None
+        offsets = group._f_get_child(RAGGED_OFFSETS)
+        group._f_get_child(RAGGED_VALUES).append(values)
+        offsets.append(ends + offsets[-1])
+        return group
+
+    def append_batch(self, batch, parent=None):
+        if not parent: parent = self._f.root
+        for name, column, ragged in batch_columns(batch):
+            if isinstance(column, ContainerBatch):
+                self.append_batch(column, self.create_group(name, parent))
+                continue
+            node = parent._f_get_child(name) if name in parent else None
+            # A column stays ragged once written so, whatever the batch
+            if node is None and ragged or \
+               node is not None and RAGGED_ATTR in node._v_attrs:
+                self.append_ragged(name, column, parent)
+            else:
+                self.append_column(name, column, parent)
+
+    def __column_container(self, value):
+        return field_container(DATA_COLUMN, value)
+
+    def flush(self):
+        for path, table in self._pending_tables.items():
+            if self._pending[path]:
+                table.flush()
+                self._pending[path] = 0
+        for array in self._arrays.values():
+            array.flush()
+
+    def __node_path(self, dsname, parent):
+        join = ""
+        if parent._v_pathname != "/":
+            join = "/"
+        return parent._v_pathname + join + dsname
+
+    def __check_array(self, dsname, parent, value):
+        path = self.__node_path(dsname, parent)
+        if path in self._arrays:
+            return self._arrays[path]
+        if not self._array_threshold or path in self._schemas:
+            return None
+        if not isinstance(value, np.ndarray) or not value.shape or \
+           value.dtype.kind not in 'biufc' or \
+           value.nbytes < self._array_threshold:
+            return None
+        # Rows of the array are the rows of the scalar tables of the group
+        self.log.info("Creating array %s in %s"%(dsname, parent._v_pathname))
+        array = self._f.create_earray(
+            parent, dsname, atom=tables.Atom.from_dtype(value.dtype),
+            shape=(0,) + value.shape, title="Storage of %s"%(dsname),
+            filters=self._array_filters,
+            **self.__node_hints(path, value.shape))
+        self._arrays[path] = array
+        self._nodes.add(array)
+        return array
+
+    def __append_array(self, array, values):
+        try:
+            if not isinstance(values, np.ndarray) or values.dtype.kind == 'O':
+                values = np.stack(values)
+            array.append(values)
+        except ValueError:
+            self.log.error("Values with shapes other than %s in %s"%(
+                array.shape[1:], array._v_pathname))
+            return None
+        return array
 
     def __create_dataset(self, data):
         # TODO:
@@ -127,20 +362,31 @@ class h5table_writer(table_writer):
         ret.d1 = data
         return ret
 
-    def __append_row(self, table_name, datasets):
+    def __append_row(self, table_name, datasets, transformed=False):
         table = self._tables[table_name]
         row = table.row
         for dataset in datasets:
             for colname in filter(lambda c:c in table.colnames,
                                   dataset.keys()):
-                value = self._apply_col_transform(
-                    table_name, colname, dataset[colname])
+                value = dataset[colname]
+                if not transformed:
+                    value = self._transform_value(table_name, colname, value)
                 row[colname] = value
         row.append()
-        table.flush()
+        self.__rows_appended(table)
         return 
         return row
 
+    def __rows_appended(self, table, nrows=1):
+        path = table._v_pathname
+        pending = self._pending.get(path, 0) + nrows
+        if pending >= self._flush_every or \
+           (self._flush_bytes and pending * table.rowsize >= self._flush_bytes):
+            table.flush()
+            pending = 0
+        self._pending[path] = pending
+        self._pending_tables[path] = table
+
     def __check_table(self, dsname, parent):
         join = ""
         if parent._v_pathname != "/":
@@ -150,12 +396,12 @@ class h5table_writer(table_writer):
             return None
         return table_name
     
-    def __create_new_table(self, dsname, parent, datasets):
+    def __create_new_table(self, dsname, parent, datasets, transformed=False):
         join = ""
         if parent._v_pathname != "/":
             join = "/"
         table_name = parent._v_pathname + join + dsname
-        meta = self.__create_schema(table_name, datasets)
+        meta = self.__create_schema(table_name, datasets, transformed)
 
         for dataset in datasets:
             meta.update(dataset.meta)
@@ -166,60 +412,121 @@ class h5table_writer(table_writer):
         table = self._f.create_table(where=parent,name=dsname,
                                      title="Storage of {}".format(
                                          ",".join(c.__class__.__name__ for c in datasets)),
-                                     description=self._schemas[table_name])
+                                     description=self._schemas[table_name],
+                                     **self.__node_hints(table_name))
         for k, v in meta.items():
             table.attrs[k] = v
         self._tables[table_name] = table
+        self._nodes.add(table)
         
         return table_name
 
-    def __create_schema(self, table_name, datasets):
-        class cschema(tables.IsDescription):
-            pass
-            
+    def __create_schema(self, table_name, datasets, transformed=False):
         meta = {}
+        spec = []
 
         for ds in datasets:
             for col_name, v in ds.items():
-                typename = ""
-                shape = 1
                 if self._is_column_exclude(table_name, col_name):
                     continue
                 if type(v).__name__ == "_VLF":
-                    i = 0
-                    for d in v:
-                        typename = d.dtype.name
-                        coltype = PYTABLES_TYPE_MAP[typename]
-                        shape = d.shape
-                        cschema.columns["%s_%d"%(col_name,i)] = coltype(shape=shape)
-                        i = i + 1
-                elif isinstance(v, np.ndarray):
-                    typename = v.dtype.name
-                    coltype = PYTABLES_TYPE_MAP[typename]
-                    shape = v.shape
-                    cschema.columns[col_name] = coltype(shape=shape)
-                elif isinstance(v, str):
-                    typename = type(v).__name__
-                    coltype = PYTABLES_TYPE_MAP[typename]
-                    size = len(v)
-                    if size == 0: size = 1
-                    cschema.columns[col_name] = coltype(size)
-                elif type(v).__name__ in PYTABLES_TYPE_MAP:
-                    typename = type(v).__name__
-                    coltype = PYTABLES_TYPE_MAP[typename]
-                    cschema.columns[col_name] = coltype()
- 
-        self._schemas[table_name] = cschema
+                    self.log.warning("Variable length column %s of %s "
+                                     "skipped, use append_ragged"%(
+                                         col_name, table_name))
+                    continue
+                if not transformed:
+                    v = self._transform_value(table_name, col_name, v)
+                c = column_spec(v)
+                if c:
+                    spec.append([col_name] + c)
+        spec = definition_spec(warehouse().get().fits_def, table_name, spec)
+
+        if self._registry:
+            cached = self._registry.lookup(self._schema_key, table_name,
+                                           self._schema_dir)
+            merged = merge_specs(cached, spec)
+            if merged is None:
+                self.log.warning("Schema of %s changed, replacing it"%(
+                    table_name))
+                merged = spec
+            self._registry.store(self._schema_key, table_name, merged,
+                                 self._schema_dir)
+            self._schemas[table_name] = self._registry.description(merged)
+        else:
+            self._schemas[table_name] = compile_description(spec)
         return meta
 
+    def expected_rows(self, group, nrows):
+        """Sets the rows expected in the tables created below a group"""
+        self._group_rows[group._v_pathname] = max(1, int(nrows))
+
+    def __node_hints(self, path, shape=None):
+        # Overrides by path or by name, then the closest group hint
+        ret = {}
+        name = path.rsplit("/", 1)[-1]
+        for key, hints in (('expectedrows', self._expectedrows),
+                           ('chunkshape', self._chunkshapes)):
+            for k in (path, name):
+                if k in hints:
+                    ret[key] = hints[k]
+                    break
+        if 'chunkshape' in ret and shape is not None and \
+           isinstance(ret['chunkshape'], int):
+            ret['chunkshape'] = (ret['chunkshape'],) + tuple(shape)
+        if not 'expectedrows' in ret:
+            group = path
+            while group != "/":
+                group = group.rsplit("/", 1)[0] or "/"
+                if group in self._group_rows:
+                    ret['expectedrows'] = self._group_rows[group]
+                    break
+            else:
+                if self._default_rows:
+                    ret['expectedrows'] = self._default_rows
+        return ret
+
     def __create_compression_filter(self, compression, compression_opts):
         return tables.Filters(complib=compression, complevel=compression_opts)
 
     def __init__(self, filename="d.h5", mode='w', 
-                 compression = None, compression_opts=0, **kwargs):
+                 compression = None, compression_opts=0,
+                 flush_every=DEFAULT_FLUSH_EVERY, flush_bytes=None,
+                 schema_cache=True, index=None,
+                 array_threshold=DEFAULT_ARRAY_THRESHOLD, blosc_threads=None,
+                 expectedrows=None, chunkshapes=None, batch_transforms=None,
+                 **kwargs):
         super().__init__()
+        for table_name, transforms in (batch_transforms or {}).items():
+            for col_name, transform in transforms.items():
+                self.add_batch_transform(table_name, col_name, transform)
         self._schemas = {}
+        self._group_rows = {}
+        self._default_rows = None
+        self._expectedrows = {}
+        if isinstance(expectedrows, dict):
+            self._expectedrows = dict(expectedrows)
+        elif expectedrows:
+            self._default_rows = expectedrows
+        self._chunkshapes = dict(chunkshapes or {})
+        self._arrays = {}
+        self._array_threshold = array_threshold
+        self._array_filters = ARRAY_FILTERS
+        if compression and compression.startswith('blosc'):
+            self._array_filters = self.__create_compression_filter(
+                compression, compression_opts)
+        if blosc_threads:
+            kwargs.update(MAX_BLOSC_THREADS=blosc_threads)
+        self._index = list(index or [])
+        if schema_cache:
+            self._registry = schema_registry().get()
+            self._schema_key = current_key()
+            self._schema_dir = cache_dir(schema_cache)
         self._tables = {}
+        self._nodes = node_map()
+        self._pending = {}
+        self._pending_tables = {}
+        self._flush_every = max(1, flush_every)
+        self._flush_bytes = flush_bytes
         
         if not filename: filename = "d.h5"
 
@@ -236,79 +543,280 @@ class h5table_writer(table_writer):
                                        **kwargs)
         else:
             self._f = tables.open_file(filename,**kwargs)
+        self._nodes.add_tree(self._f.root)
 
     def close(self):
+        self.flush()
+        self.__create_indexes()
         self._f.close()
         self._f = None
 
+    def __create_indexes(self):
+        if not self._index:
+            return
+        for table_name, table in self._tables.items():
+            for col in table.colnames:
+                if not col in self._index and \
+                   not (col == DATA_COLUMN and table._v_name in self._index):
+                    continue
+                column = table.cols._f_col(col)
+                if column.is_indexed or table.coldescrs[col].shape != ():
+                    continue
+                if column.dtype == np.uint64:
+                    self.log.warning("PyTables can not index uint64 column "
+                                     "%s in %s"%(col, table_name))
+                    continue
+                self.log.info("Creating index of %s in %s"%(col, table_name))
+                column.create_csindex()
+
     def __del__(self):
         if self._f:
             self.close()
 
     _f = None
+    _registry = None
+    _schema_dir = None
     log = None
 
 class h5table_reader(table_reader):
     def get_dataset(self, dname, parent = None):
         if not parent: parent = self._f.root
-        return self.__get_dataset(dname, parent)
-
-        join = ""
-        if parent._v_pathname != "/":
-            join = "/"
-        table_name = parent._v_pathname + join + dsname
-        
-        ret = None
-
-        if table_name not in self._tables:
-            table = self._setup_table(table_name, ret)
-        else:
-            table = self._table[table_name]
-    
-    def __get_dataset(self, dname, parent):
-        if not isinstance(parent, tables.table.Table) and \
-           not isinstance(parent, tables.group.RootGroup) and \
-           not isinstance(parent, tables.group.Group):
-            return None
-        if parent._v_name == dname and \
-           (isinstance(parent, tables.table.Table)): 
-            return parent
-        for k in parent:
-            ret = self.__get_dataset(dname, k)
-            if ret: return ret
-        return None 
-        
+        return self.__get_node(dname, parent, True)
 
     def get_group(self, gname, parent = None):
         if not parent: parent = self._f.root
-        return self.__get_group(gname, parent)
+        return self.__get_node(gname, parent, False)
 
-    def __get_group(self, gname, parent):
-        if not isinstance(parent, tables.group.RootGroup) and \
-           not isinstance(parent, tables.group.Group):
+    def __get_node(self, name, parent, leaf):
+        if not isinstance(parent, tables.group.Group):
+            if leaf and isinstance(parent, tables.Leaf) and \
+               parent._v_name == name:
+                return parent
             return None
-        if parent._v_name == gname and \
-           (isinstance(parent, tables.group.RootGroup) or \
-            isinstance(parent, tables.group.Group)): 
-            return parent
-        for k in parent:
-            ret = self.__get_group(gname, k)
-            if ret: return ret
+        with self._lock:
+            if "/" in name:
+                try:
+                    ret = self._f.get_node(parent, name)
+                except tables.NoSuchNodeError:
+                    return None
+                return ret if isinstance(ret, tables.Leaf) == leaf else None
+            if self._nodes is None:
+                self._nodes = node_map()
+                self._nodes.add_tree(self._f.root)
+            path = self._nodes.find(name, parent, leaf)
+            if not path:
+                return None
+            return self._f.get_node(path)
+
+    def query(self, ext, condition, columns=None):
+        with self._lock:
+            return self.__query(ext, condition, columns)
+
+    def __query(self, ext, condition, columns):
+        parts, ops = split_condition(condition)
+        names = condition_names(normalize_condition(condition))
+        if not columns: columns = names
+        resolved = {}
+        for name in set(names) | set(columns):
+            resolved[name] = self.__resolve_column(ext, name)
+            if resolved[name] is None:
+                self.log.error("Column %s not found in %s"%(name, ext))
+                return None
+            if name in names and resolved[name][1] is None:
+                self.log.error("Column %s can not be used in a condition"%(
+                    name))
+                return None
+
+        # Only the conjuncts of a condition can be searched table by table
+        if '|' in ops or \
+           len(set(resolved[n][0]._v_pathname for n in names)) == 1:
+            parts = [normalize_condition(condition)]
+        coords = None
+        pending = []
+        for part in parts:
+            part_names = condition_names(part)
+            nodes = set(resolved[n][0]._v_pathname for n in part_names)
+            # PyTables does not support uint64 columns in conditions
+            if len(nodes) != 1 or any(
+                    resolved[n][0].coldtypes[resolved[n][1]] == np.uint64
+                    for n in part_names):
+                pending.append((part, part_names))
+                continue
+            table = resolved[part_names[0]][0]
+            condvars = dict((n, table.cols._f_col(resolved[n][1]))
+                            for n in part_names)
+            found = table.get_where_list(part, condvars=condvars, sort=True)
+            if coords is None:
+                coords = found
+            else:
+                coords = np.intersect1d(coords, found, assume_unique=True)
+        for part, part_names in pending:
+            # Columns of different tables are aligned by row number
+            local = dict((n, self.__read_column(resolved[n], coords))
+                         for n in part_names)
+            for n, v in local.items():
+                if v.dtype == np.uint64: local[n] = v.astype(np.int64)
+            nrows = min(len(v) for v in local.values())
+            if any(len(v) != nrows for v in local.values()):
+                self.log.warning("Columns of %s have different lengths"%(part))
+                local = dict((n, v[:nrows]) for n, v in local.items())
+            mask = numexpr.evaluate(part, local_dict=local)
+            if coords is None:
+                coords = np.nonzero(mask)[0]
+            else:
+                coords = coords[mask]
+        ret = {}
+        for name in columns:
+            node, col = resolved[name]
+            ret[name] = self._transform_column(
+                node._v_pathname, col or DATA_COLUMN,
+                self.__read_column(resolved[name], coords))
+        return ret
+
+    def __resolve_column(self, ext, name):
+        try:
+            data = self._f.get_node("/%s/data"%(ext))
+        except tables.NoSuchNodeError:
+            return None
+        node = None
+        if "/" in name:
+            node = self.get_dataset(name, data)
+        elif name in data:
+            node = data._f_get_child(name)
+        if node is None and not "/" in name:
+            for table in data._f_iter_nodes('Table'):
+                if name in table.colnames:
+                    return table, name
+            node = self.get_dataset(name, data)
+        if isinstance(node, tables.table.Table):
+            if DATA_COLUMN in node.colnames:
+                return node, DATA_COLUMN
+            if len(node.colnames) == 1:
+                return node, node.colnames[0]
+            return None
+        if isinstance(node, tables.Leaf):
+            return node, None
         return None
-                
-            
 
-    def __init__(self, filename, **kwargs):
+    def __read_column(self, resolved, coords):
+        node, col = resolved
+        if col is None:
+            if coords is None:
+                return node.read()
+            if not len(coords):
+                return node.read(0, 0)
+            # Selection of a list of rows, the only fancy one of PyTables
+            return node[(coords.tolist(),) + (slice(None),)*(node.ndim - 1)]
+        if coords is None:
+            return node.col(col)
+        return node.read_coordinates(coords, field=col)
+
+    def _dataset_layout(self, dset):
+        if not isinstance(dset, tables.Leaf) or \
+           isinstance(dset, tables.VLArray) or not dset.shape:
+            return None
+        if dset.chunkshape:
+            chunk_rows = dset.chunkshape[0]
+        else:
+            chunk_rows = dset.nrowsinbuf
+        return (self._file_key, dset._v_pathname), dset.nrows, chunk_rows
+
+    def _transform_rows(self, dset, data, sel):
+        path = dset._v_pathname
+        transforms = self._batch_transforms.get(path)
+        if not transforms:
+            return data
+        if isinstance(sel, str):
+            return self._transform_column(path, sel, data)
+        single = isinstance(sel, (int, np.integer))
+        if single:
+            data = np.asarray(data)[np.newaxis]
+        if data.dtype.names is None:
+            data = self._transform_column(path, DATA_COLUMN, data)
+        else:
+            # Transforms may change the dtype of the columns
+            columns = [(n, self._transform_column(path, n, data[n]))
+                       for n in data.dtype.names]
+            out = np.empty(len(data), dtype=[(n, c.dtype, c.shape[1:])
+                                             for n, c in columns])
+            for n, c in columns:
+                out[n] = c
+            data = out
+        return data[0] if single else data
+
+    def _read_rows(self, dset, start, stop):
+        with self._lock:
+            return dset.read(start, stop)
+
+    def _read_direct(self, dset, sel):
+        with self._lock:
+            if sel is None:
+                return dset.read()
+            return dset[sel]
+
+    def _list_event_groups(self, ext):
+        with self._lock:
+            try:
+                data = self._f.get_node("/%s/data"%(ext))
+            except tables.NoSuchNodeError:
+                return []
+            if not isinstance(data, tables.group.Group):
+                return []
+            names = sort_event_groups(data._v_groups.keys(), ext)
+            return [data._v_pathname + "/" + n for n in names]
+
+    def _find_column(self, column, group_path):
+        with self._lock:
+            dset = self.get_dataset(column, self._f.get_node(group_path))
+            if dset is None:
+                return None
+            return dset._v_pathname[len(group_path) + 1:]
+
+    def _read_event_value(self, path):
+        with self._lock:
+            try:
+                node = self._f.get_node(path)
+            except tables.NoSuchNodeError:
+                return None
+            if isinstance(node, tables.table.Table):
+                if len(node.colnames) == 1:
+                    value = node.read(field=node.colnames[0])
+                else:
+                    value = node.read()
+            elif isinstance(node, tables.Leaf):
+                value = node.read()
+            else:
+                return None
+            if len(value) == 1:
+                return value[0]
+            return value
+
+    def __init__(self, filename, cache=True, prefetch=0,
+                 blosc_threads=None, batch_transforms=None, **kwargs):
         self.log = logger().get_log("table_reader")
         super().__init__()
+        for table_name, transforms in (batch_transforms or {}).items():
+            for col_name, transform in transforms.items():
+                self.add_batch_transform(table_name, col_name, transform)
         self._tables = {}
+        self._event_groups = {}
         kwargs.update(mode='r')
+        if blosc_threads:
+            kwargs.update(MAX_BLOSC_THREADS=blosc_threads)
         self.open(filename, **kwargs)
+        if cache:
+            self._cache = chunk_cache().get()
+        if prefetch:
+            self._prefetch = prefetcher(self._read_chunk, self._cache, prefetch)
 
     def open(self, filename, **kwargs):
         self._f = tables.open_file(filename, **kwargs)
+        self._file_key = file_key(filename)
+        self._nodes = None
 
     def close(self):
+        if self._prefetch:
+            self._prefetch.close()
         self._f.close()
         self._f = None
 
@@ -317,4 +825,6 @@ class h5table_reader(table_reader):
             self.close()
             
     _f = None
+    _nodes = None
+    _lock = PYTABLES_LOCK
     log = None
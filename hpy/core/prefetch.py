@@ -0,0 +1,134 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.prefetch
+
+--------------------------------------------------------------------------------
+
+This module provides the read-ahead of chunks for sequential reads
+"""
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hpy.log import logger
+
+## Default number of chunks read ahead
+DEFAULT_PREFETCH_DEPTH = 2
+
+class prefetcher:
+    """@class prefetcher
+    This class reads ahead the chunks following a sequential read
+
+    When the chunks read from a dataset follow the ones read before, the
+    next chunks are read and decompressed in a background thread into a
+    buffer bounded to depth chunks per dataset. The readers only read ahead
+    when given a depth, e.g. prefetch=DEFAULT_PREFETCH_DEPTH, and forget a
+    dataset once its last chunk was read.
+    """
+    def __init__(self, read_chunk, cache=None, depth=DEFAULT_PREFETCH_DEPTH):
+        self.log = logger().get_log("prefetcher")
+        self.depth = depth
+        self._read_chunk = read_chunk
+        self._cache = cache
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pending = {}
+        self._last = {}
+        self.issued = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted = 0
+
+    def take(self, key, ci):
+        """Returns the chunk if it was read ahead, None otherwise"""
+        with self._lock:
+            pending = self._pending.get(key)
+            fut = pending.pop(ci, None) if pending else None
+            if fut is None:
+                if key in self._last:
+                    self.misses += 1
+                return None
+        try:
+            data = fut.result()
+        except Exception:
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def observe(self, dset, key, ids, nrows, chunk_rows):
+        """Schedules the read ahead after a read of the chunks ids"""
+        with self._lock:
+            nchunks = -(-nrows // chunk_rows)
+            if ids[-1] >= nchunks - 1:
+                self.__forget(key)
+                return
+            last = self._last.get(key)
+            self._last[key] = ids[-1]
+            if last is None or not last <= ids[0] <= last + 1:
+                return
+            pending = self._pending.setdefault(key, collections.OrderedDict())
+            for ci in range(ids[-1] + 1, min(ids[-1] + 1 + self.depth, nchunks)):
+                if ci in pending or \
+                   (self._cache and self._cache.contains(key + (ci,))):
+                    continue
+                if not self._pool:
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="hpy-prefetch")
+                pending[ci] = self._pool.submit(self._read_chunk, dset, ci,
+                                                nrows, chunk_rows)
+                self.issued += 1
+            for ci in [c for c in pending if c <= ids[-1]]:
+                pending.pop(ci).cancel()
+                self.wasted += 1
+            while len(pending) > self.depth:
+                pending.popitem(last=False)[1].cancel()
+                self.wasted += 1
+
+    def __forget(self, key):
+        self._last.pop(key, None)
+        for fut in self._pending.pop(key, {}).values():
+            fut.cancel()
+            self.wasted += 1
+
+    def stats(self):
+        """Returns the read ahead statistics"""
+        with self._lock:
+            served = self.hits + self.misses
+            return {'depth': self.depth,
+                    'issued': self.issued,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'wasted': self.wasted,
+                    'hit_rate': self.hits / served if served else 0.0}
+
+    def close(self):
+        # Executor.shutdown only cancels the queued reads from Python 3.9
+        with self._lock:
+            for pending in self._pending.values():
+                for fut in pending.values():
+                    fut.cancel()
+        if self._pool:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._pending = {}
+        self._last = {}
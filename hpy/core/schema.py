@@ -0,0 +1,245 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.schema
+
+--------------------------------------------------------------------------------
+
+This module provides the compiled pytables schemas and their disk cache
+"""
+import os
+import json
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import tables
+
+import numpy as np
+
+from hpy.log import logger
+from hpy.utils.warehouse import warehouse
+
+PYTABLES_TYPE_MAP = {
+    'float': tables.Float64Col,
+    'float64': tables.Float64Col,
+    'float32': tables.Float32Col,
+    'int': tables.IntCol,
+    'int8': tables.Int8Col,
+    'int16': tables.Int16Col,
+    'int32': tables.Int32Col,
+    'int64': tables.Int64Col,
+    'uint': tables.UIntCol,
+    'uint8': tables.UInt8Col,
+    'uint16': tables.UInt16Col,
+    'uint32': tables.UInt32Col,
+    'uint64': tables.UInt64Col,
+    'bool': tables.BoolCol,
+    'str': tables.StringCol,
+}
+
+## Environment variable setting the schema cache folder, schemas are only
+# saved to disk when it is set or a folder is given to the writer
+SCHEMA_CACHE_ENV = "HPY_SCHEMA_CACHE"
+
+def config_hash(fits_def):
+    """Returns the hash identifying a FITS definition"""
+    text = json.dumps(fits_def, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def column_spec(value):
+    """Returns the [type, shape, itemsize] of the column storing the value
+
+    Returns None if the value can not be stored in a table column
+    """
+    if isinstance(value, np.ndarray):
+        if not value.dtype.name in PYTABLES_TYPE_MAP:
+            return None
+        return [value.dtype.name, list(value.shape), 0]
+    if isinstance(value, str):
+        return ['str', [], max(1, len(value))]
+    if type(value).__name__ in PYTABLES_TYPE_MAP:
+        return [type(value).__name__, [], 0]
+    return None
+
+def definition_spec(fits_def, table_name, spec):
+    """Returns the spec of a table with the type of the FITS definition
+
+    A definition entry may give the dtype of its column, i.e.
+    <event_id type="data" dtype="uint64"/>. It replaces the observed type
+    of the single column of the table named after the entry when the
+    observed values can be cast to it safely.
+    """
+    if not fits_def or len(spec) != 1 or spec[0][1] == 'str':
+        return spec
+    parts = table_name.strip("/").split("/")
+    entry = (fits_def.get(parts[0]) or {}).get(parts[-1])
+    if not entry:
+        return spec
+    dtype = entry.get('att', {}).get('dtype')
+    if not dtype in PYTABLES_TYPE_MAP or dtype == 'str' or \
+       not np.can_cast(spec[0][1], dtype, 'same_kind'):
+        return spec
+    return [[spec[0][0], dtype] + spec[0][2:]]
+
+def merge_specs(cached, observed):
+    """Returns the spec covering both the cached and the observed columns
+
+    Strings are widened to the longest value seen, any other difference
+    makes the observed spec replace the cached one.
+    """
+    if cached is None:
+        return observed
+    if [c[:3] for c in cached] != [c[:3] for c in observed]:
+        return None
+    ret = []
+    for c, o in zip(cached, observed):
+        ret.append(c[:3] + [max(c[3], o[3])])
+    return ret
+
+def compile_description(spec):
+    """Builds the pytables description of a spec"""
+    columns = {}
+    for pos, (name, typename, shape, itemsize) in enumerate(spec):
+        coltype = PYTABLES_TYPE_MAP[typename]
+        if typename == 'str':
+            columns[name] = coltype(itemsize, pos=pos)
+        else:
+            columns[name] = coltype(shape=tuple(shape), pos=pos)
+    return type("cschema", (tables.IsDescription,), columns)
+
+class schema_registry:
+    """@class schema_registry
+    This class keeps the table schemas of the FITS definition in use
+
+    Schemas are stored as specs (column, type, shape, string size) keyed by
+    the hash of the FITS definition and the table name, and compiled once
+    into pytables descriptions per process. When a cache folder is given
+    they are also saved to a JSON file per definition, so that writers in
+    other processes reuse them. It uses the singleton pattern.
+    """
+    class __registry:
+        """Private class to feature the singleton pattern"""
+        def __init__(self):
+            self.log = logger().get_log("schema_registry")
+            self._lock = threading.Lock()
+            self._specs = {}
+            self._loaded = set()
+            self._compiled = {}
+
+        def lookup(self, key, table_name, cache_dir=None):
+            """Returns the spec of the table, None if it is unknown"""
+            with self._lock:
+                if cache_dir:
+                    self.__load(key, cache_dir)
+                return self._specs.get(key, {}).get(table_name)
+
+        def store(self, key, table_name, spec, cache_dir=None):
+            """Stores the spec of the table, and saves it to the cache file
+            of the folder if one is given
+            """
+            with self._lock:
+                specs = self._specs.setdefault(key, {})
+                if specs.get(table_name) == spec:
+                    return
+                specs[table_name] = spec
+                if cache_dir:
+                    self.__save(key, cache_dir, table_name, spec)
+
+        def description(self, spec):
+            """Returns the compiled description of a spec"""
+            k = json.dumps(spec)
+            with self._lock:
+                if not k in self._compiled:
+                    self._compiled[k] = compile_description(spec)
+                return self._compiled[k]
+
+        def __path(self, key, cache_dir):
+            return os.path.join(cache_dir, "schemas-%s.json"%(key))
+
+        def __read(self, path):
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return {}
+
+        def __load(self, key, cache_dir):
+            path = self.__path(key, cache_dir)
+            if path in self._loaded:
+                return
+            self._loaded.add(path)
+            specs = self._specs.setdefault(key, {})
+            for table_name, spec in self.__read(path).items():
+                specs.setdefault(table_name, spec)
+
+        def __save(self, key, cache_dir, table_name, spec):
+            # Other processes may save the same file, the specs are merged
+            # with the saved ones under a lock
+            path = self.__path(key, cache_dir)
+            tmp = "%s.%d"%(path, os.getpid())
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(path + ".lock", 'w') as lock:
+                    if fcntl:
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                    specs = self.__read(path)
+                    specs[table_name] = spec
+                    with open(tmp, 'w') as f:
+                        json.dump(specs, f, sort_keys=True)
+                    os.replace(tmp, path)
+            except OSError as e:
+                self.log.warning("Schema cache %s not saved: %s", path, e)
+        #
+        #
+        #
+    def __init__(self):
+        """Constructor
+
+        The constructor will create a new __registry object in case there
+        is none initialized, otherwise it will not do anything
+        """
+        if not schema_registry.instance:
+            schema_registry.instance = schema_registry.__registry()
+
+    def get(self):
+        """Returns the registry instance"""
+        return schema_registry.instance
+
+    instance = None
+
+def current_key():
+    """Returns the key of the FITS definition loaded in the warehouse"""
+    return config_hash(warehouse().get().fits_def)
+
+def cache_dir(schema_cache):
+    """Returns the folder where the schemas are saved, None if they are
+    only kept in memory
+
+    schema_cache is the folder, or True to use the one of the
+    HPY_SCHEMA_CACHE environment variable.
+    """
+    if isinstance(schema_cache, str):
+        return schema_cache
+    return os.environ.get(SCHEMA_CACHE_ENV) or None
@@ -29,6 +29,9 @@ import re
 import collections
 
 from abc import ABCMeta, abstractmethod
+
+import numpy as np
+
 from hpy.log import logger
 from hpy.core.h5base import h5writerbase, h5readerbase
 from hpy.utils.data_container import data_container
@@ -50,6 +53,7 @@ class table_writer(h5writerbase, metaclass=ABCMeta):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._transforms = collections.defaultdict(dict)
+        self._batch_transforms = collections.defaultdict(dict)
         self._exclusions = collections.defaultdict(list)
 
     def __enter__(self):
@@ -67,7 +71,16 @@ class table_writer(h5writerbase, metaclass=ABCMeta):
         return False
 
     def add_column_transform(self, table_name, col_name, transform):
-        self._transform[table_name][col_name] = transform
+        self._transforms[table_name][col_name] = transform
+
+    def add_batch_transform(self, table_name, col_name, transform):
+        """Registers a transform of the values of a column
+
+        The transform receives the values of a batch of rows as a NumPy
+        array, with the rows along the first axis, and returns the array
+        to write
+        """
+        self._batch_transforms[table_name][col_name] = transform
 
     @abstractmethod
     def open(self, filename, **kwargs):
@@ -78,10 +91,31 @@ class table_writer(h5writerbase, metaclass=ABCMeta):
 
     def _apply_col_transform(self, table_name, col_name, value):
         if col_name in self._transforms[table_name]:
-            tr = self._transform[table_name][col_name]
+            tr = self._transforms[table_name][col_name]
             value = tr(value)
         return value
 
+    def _transform_value(self, table_name, col_name, value):
+        value = self._apply_col_transform(table_name, col_name, value)
+        tr = self._batch_transforms[table_name].get(col_name)
+        if tr is not None:
+            value = tr(np.asarray(value)[np.newaxis])[0]
+        return value
+
+    def _transform_column(self, table_name, col_name, values):
+        """Applies the transforms of a column to the values of a batch
+
+        Returns an array when there is a batch transform, the values
+        otherwise
+        """
+        if col_name in self._transforms[table_name]:
+            tr = self._transforms[table_name][col_name]
+            values = [tr(v) for v in values]
+        tr = self._batch_transforms[table_name].get(col_name)
+        if tr is not None:
+            values = tr(np.asarray(values))
+        return values
+
 class table_reader(h5readerbase, metaclass=ABCMeta):
     @abstractmethod
     def get_dataset(self, dname, parent):
@@ -94,6 +128,7 @@ class table_reader(h5readerbase, metaclass=ABCMeta):
         super().__init__()
         self._cols_to_read = collections.defaultdict(list)
         self._transforms = collections.defaultdict(dict)
+        self._batch_transforms = collections.defaultdict(dict)
 
     def __enter__(self):
         return self
@@ -104,8 +139,22 @@ class table_reader(h5readerbase, metaclass=ABCMeta):
     def add_column_transform(self, table_name, col_name, transform):
         self._transforms[table_name][col_name] = transform
 
+    def add_batch_transform(self, table_name, col_name, transform):
+        """Registers a transform of the values of a column
+
+        The transform receives the values of the rows read at once as a
+        NumPy array, with the rows along the first axis
+        """
+        self._batch_transforms[table_name][col_name] = transform
+
     def _apply_col_transform(self, table_name, col_name, value):
         if col_name in self._transforms[table_name]:
             tr = self._transforms[table_name][col_name]
             value = tr(value)
         return value
+
+    def _transform_column(self, table_name, col_name, values):
+        tr = self._batch_transforms[table_name].get(col_name)
+        if tr is None:
+            return values
+        return tr(values)
@@ -0,0 +1,191 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.vds
+
+--------------------------------------------------------------------------------
+
+This module provides the HDF5 virtual datasets joining several files
+"""
+import os
+
+import h5py
+import numpy as np
+
+from hpy.log import logger
+from hpy.core.h5base import DEFAULT_EXTENSION, sort_event_groups, \
+    RAGGED_ATTR, RAGGED_OFFSETS
+
+## Attribute marking the master files built by vds_builder
+VDS_ATTR = "hpy_vds"
+## Attribute listing the source files of a master file
+VDS_SOURCES_ATTR = "hpy_sources"
+## Attribute listing the rows taken from each source file
+VDS_ROWS_ATTR = "hpy_rows"
+
+def is_vds(fname):
+    """Returns True if the file is a master file built by vds_builder"""
+    if not h5py.is_hdf5(fname):
+        return False
+    with h5py.File(fname, 'r') as f:
+        return VDS_ATTR in f.attrs
+
+class vds_builder:
+    """@class vds_builder
+    This class builds master files joining the bytables layout of several
+    files with HDF5 virtual datasets
+
+    Every dataset found under /<ext>/data becomes a virtual dataset
+    concatenating that dataset of every file along the event axis. No data
+    is copied, the master file only references the sources. Every file
+    must hold every dataset with the same dtype and rank, so that the rows
+    of the virtual datasets stay aligned. The offsets of ragged columns
+    point into the values of their own file, they are the only data copied,
+    rebased to the concatenated values.
+    """
+    def __init__(self):
+        self.log = logger().get_log("vds")
+
+    def create(self, fnames, fname=None, ext=DEFAULT_EXTENSION):
+        if not fnames:
+            self.log.error("No files provided")
+            return False
+        if not fname: fname = "vds.h5"
+        exts = [ext] if isinstance(ext, str) else list(ext)
+        root = os.path.dirname(os.path.abspath(fname))
+        sources = [os.path.abspath(f) for f in fnames]
+        for f in sources:
+            if not h5py.is_hdf5(f):
+                self.log.error("Bad file provided %s"%(f))
+                return False
+
+        ok = True
+        with h5py.File(fname, 'w') as out:
+            out.attrs[VDS_ATTR] = 1
+            out.attrs[VDS_SOURCES_ATTR] = np.array(
+                [os.path.relpath(f, root) for f in sources],
+                dtype=h5py.string_dtype())
+            for e in exts:
+                if not self.__create_extension(out, e, sources, root):
+                    ok = False
+                    break
+        if not ok:
+            os.remove(fname)
+        return ok
+
+    def __create_extension(self, out, ext, sources, root):
+        # The datasets of every file, in the order they are found
+        names = {}
+        ragged = {}
+        for f in sources:
+            with h5py.File(f, 'r') as src:
+                data = src.get("%s/data"%(ext))
+                if type(data) != h5py._hl.group.Group:
+                    self.log.error("Extension %s not found in %s"%(ext, f))
+                    return False
+                if sort_event_groups(data.keys(), ext):
+                    self.log.error("%s uses the bygroups layout, use gather"%(
+                        f))
+                    return False
+                data.visititems(
+                    lambda n, o: names.setdefault(data.name + "/" + n)
+                    if type(o) == h5py._hl.dataset.Dataset else None)
+                data.visititems(
+                    lambda n, o: ragged.setdefault(data.name + "/" + n)
+                    if type(o) == h5py._hl.group.Group and
+                    o.attrs.get(RAGGED_ATTR) else None)
+                if f == sources[0] and "%s/header"%(ext) in src:
+                    gext = out.require_group(ext)
+                    src.copy(src["%s/header"%(ext)], gext, "header")
+
+        for name in ragged:
+            out.require_group(name).attrs[RAGGED_ATTR] = True
+        for name in names:
+            group, leaf = name.rsplit("/", 1)
+            if group in ragged and leaf == RAGGED_OFFSETS:
+                dset = self.__create_offsets(out, name, sources)
+            else:
+                dset = self.__create_dataset(out, name, sources, root)
+            if dset is None:
+                return False
+        return True
+
+    def __create_offsets(self, out, name, sources):
+        parts = []
+        rows = []
+        base = 0
+        for f in sources:
+            with h5py.File(f, 'r') as src:
+                dset = src.get(name)
+                group = src.get(name.rsplit("/", 1)[0])
+                if type(dset) != h5py._hl.dataset.Dataset or \
+                   not group.attrs.get(RAGGED_ATTR) or \
+                   len(dset.shape) != 1 or not len(dset):
+                    self.log.error("Ragged column %s not found in %s"%(
+                        group.name if group else name, f))
+                    return None
+                offsets = dset[()].astype(np.int64) + base
+            # The leading 0 of each file but the first is the end of the
+            # previous one
+            parts.append(offsets[1:] if parts else offsets)
+            rows.append(len(offsets) - 1)
+            base = offsets[-1]
+        self.log.info("Creating rebased offsets %s with %d rows"%(
+            name, sum(rows)))
+        dset = out.create_dataset(name, data=np.concatenate(parts),
+                                  chunks=True, maxshape=(None,))
+        dset.attrs[VDS_ROWS_ATTR] = np.array(rows, dtype=np.int64)
+        return dset
+
+    def __create_dataset(self, out, name, sources, root):
+        found = []
+        dtype = None
+        for f in sources:
+            with h5py.File(f, 'r') as src:
+                dset = src.get(name)
+                # A file left out would misalign the rows of the datasets
+                if type(dset) != h5py._hl.dataset.Dataset or not dset.shape:
+                    self.log.error("Dataset %s not found in %s"%(name, f))
+                    return None
+                if dtype is None:
+                    dtype = dset.dtype
+                if dset.dtype != dtype or \
+                   (found and len(dset.shape) != len(found[0][1])):
+                    self.log.error("Dataset %s in %s does not match: %s %s"%(
+                        name, f, dset.dtype, dset.shape))
+                    return None
+                found.append((f, dset.shape))
+
+        tail = tuple(max(s[i] for _, s in found)
+                     for i in range(1, len(found[0][1])))
+        rows = [s[0] for _, s in found]
+        layout = h5py.VirtualLayout(shape=(sum(rows),) + tail, dtype=dtype)
+        offset = 0
+        for f, shape in found:
+            vsource = h5py.VirtualSource(os.path.relpath(f, root), name,
+                                         shape=shape, dtype=dtype)
+            target = (slice(offset, offset + shape[0]),) + \
+                     tuple(slice(0, d) for d in shape[1:])
+            layout[target] = vsource
+            offset += shape[0]
+        self.log.info("Creating virtual dataset %s with %d rows"%(name, offset))
+        dset = out.create_virtual_dataset(name, layout)
+        dset.attrs[VDS_ROWS_ATTR] = np.array(rows, dtype=np.int64)
+        return dset
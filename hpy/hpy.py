@@ -25,6 +25,8 @@ along with HPY.  If not, see <http://www.gnu.org/licenses/>.
 This module provides the API for the library
 """
 
+import os
+import tempfile
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -32,11 +34,18 @@ import numpy as np
 
 from astropy.io import fits
 
-from hpy.utils.fits import from_fits
+from hpy.utils.fits import from_fits, variable_length_columns
 from hpy.utils.warehouse import warehouse
-from hpy.utils.data_container import data_container, Field
-from hpy.core.h5table import h5table_writer, h5table_reader
+from hpy.utils.data_container import field_container, record
+from hpy.utils.arrow import write_arrow, read_arrow, record_batches, \
+    ARROW_SUFFIX, DEFAULT_ARROW_BATCH
+from hpy.utils.memory import memory_report as mem_report
+from hpy.core.h5table import h5table_writer, h5table_reader, PYTABLES_LOCK
 from hpy.core.h5 import h5_writer, h5_reader
+from hpy.core.cache import chunk_cache
+from hpy.core.aio import async_reader, DEFAULT_ASYNC_WORKERS
+from hpy.core.h5base import DEFAULT_EXTENSION
+from hpy.core.vds import vds_builder, is_vds, VDS_SOURCES_ATTR
 
 from hpy.log import logger
 from hpy.log import logger_configuration
@@ -62,6 +71,17 @@ FITS_MODE_MAP = {
     "protozfits": 1
 }
 
+# Options of create_hdf5 only understood by the pytables backend
+PYTABLES_OPTIONS = ["flush_every", "flush_bytes", "batch_size",
+                    "schema_cache", "index", "array_threshold",
+                    "blosc_threads", "expectedrows", "chunkshapes",
+                    "batch_transforms"]
+# Options of create_hdf5 only understood by the bytables format
+BYTABLES_OPTIONS = ["batch_size", "array_threshold"]
+
+## Events written at once by the pytables bytables format
+DEFAULT_BATCH_SIZE = 1000
+
 DEFAULT_MODE = "h5py"
 DEFAULT_FITS_MODE = "protozfits"
 DEFAULT_HDF5_FORMAT = "bytables"
@@ -71,37 +91,75 @@ def init(file_configuration = None, log_file=LOG_FILE_STR,
 global_configuration=DEFAULT_GLOBAL_CONFIG):
     return hpy(file_configuration, log_file, global_configuration)
 
-def load_fits(fits_file, fits_mode=DEFAULT_FITS_MODE, test=False):
-    if not fits_mode in FITS_MODE_MAP:
-        log.error("Unkown mode")
-        return
-    return hpy().get().load_fits(fits_file, FITS_MODE_MAP[fits_mode],test)
+def load_fits(fits_file, fits_mode=DEFAULT_FITS_MODE, test=False,
+              max_memory=None, spill=False, spill_dir=None):
+    return hpy().get().load_fits(fits_file, fits_mode, test, max_memory,
+                                 spill, spill_dir)
+
+def memory_report():
+    return hpy().get().memory_report()
+
+def spill_file():
+    return hpy().get().spill_file()
 
 def create_hdf5(fname = None, hpy_mode=DEFAULT_MODE, 
                 hdf5_format=DEFAULT_HDF5_FORMAT, **kwargs):
-    if not hpy_mode in HPY_MODE_MAP:
+    return hpy().get().create_hdf5(fname, hpy_mode, hdf5_format, **kwargs)
+
+def open_fits(fits_file, fits_mode=DEFAULT_FITS_MODE, test=False,
+              max_memory=None, spill=False, spill_dir=None):
+    s = session()
+    if not s.load_fits(fits_file, fits_mode, test, max_memory, spill,
+                       spill_dir):
+        s.close()
+        raise IOError("Can not open %s"%(fits_file))
+    return s
+
+def open_hdf5(fname, hpy_mode=DEFAULT_MODE, **kwargs):
+    s = session()
+    s.load_hdf5(fname, hpy_mode, **kwargs)
+    if not s.is_open:
+        raise IOError("Can not open %s"%(fname))
+    return s
+
+def create_output(fname=None, hpy_mode=DEFAULT_MODE,
+                  hdf5_format=DEFAULT_HDF5_FORMAT, **kwargs):
+    return output(fname, hpy_mode, hdf5_format, **kwargs)
+
+def to_arrow(ext=None):
+    return hpy().get().to_arrow(ext)
+
+def iterate_arrow(fits_file, ext=DEFAULT_EXTENSION,
+                  fits_mode=DEFAULT_FITS_MODE, batch_size=DEFAULT_ARROW_BATCH):
+    if not fits_mode in FITS_MODE_MAP:
         log.error("Unkown mode")
         return
-    if not hdf5_format in HDF5_FORMAT:
-        log.error("Unknown format")
-        return
+    return hpy().get().iterate_arrow(fits_file, ext, FITS_MODE_MAP[fits_mode],
+                                     batch_size)
 
-    m = HPY_MODE_MAP[hpy_mode]
-    h5_fmt = HDF5_FORMAT[hdf5_format]
+def create_arrow(fname=None, ext=None, compression=None):
+    return hpy().get().create_arrow(fname, ext, compression)
 
-    if m == 0:
-        return
-    if m == 1 and h5_fmt == 0:
-        return hpy().get().create_h5(fname, **kwargs)
-    if m == 2 and h5_fmt == 0:
-        return hpy().get().create_h5table(fname, **kwargs)
+def create_arrow_from_fits(fits_file, fname=None, ext=DEFAULT_EXTENSION,
+                           fits_mode=DEFAULT_FITS_MODE,
+                           batch_size=DEFAULT_ARROW_BATCH, compression=None):
+    batches = iterate_arrow(fits_file, ext, fits_mode, batch_size)
+    if batches is None:
+        return False
+    if not fname: fname = "d" + ARROW_SUFFIX
+    return write_arrow(fname, batches, compression) is not None
+
+def load_arrow(fname):
+    return read_arrow(fname)
+
+def create_vds(fnames, fname=None, ext=DEFAULT_EXTENSION):
+    return vds_builder().create(fnames, fname, ext)
 
-    if m == 1 and h5_fmt == 1:
-        return hpy().get().create_h5_tables(fname, **kwargs)
-    if m == 2 and h5_fmt == 1:
-        return hpy().get().create_h5table_tables(fname, **kwargs)
+def load_hdf5(fname, hpy_mode=DEFAULT_MODE, **kwargs):
+    return hpy().get().load_hdf5(fname, hpy_mode, **kwargs)
 
-def load_hdf5(fname, hpy_mode=DEFAULT_MODE):
+def load_hdf5_async(fname, hpy_mode=DEFAULT_MODE,
+                    max_workers=DEFAULT_ASYNC_WORKERS, **kwargs):
     if not hpy_mode in HPY_MODE_MAP:
         log.error("Unkown mode")
         return
@@ -109,47 +167,41 @@ def load_hdf5(fname, hpy_mode=DEFAULT_MODE):
     if m == 0:
         return
     if m == 1:
-        return hpy().get().load_h5(fname)
+        return async_reader(h5_reader(fname, **kwargs), max_workers,
+                            owner=True)
     if m == 2:
-        return hpy().get().load_h5table(fname)
+        return async_reader(h5table_reader(fname, **kwargs), max_workers,
+                            owner=True)
 
 def close_hdf5(hpy_mode=DEFAULT_MODE):
-    if hpy().get().is_open:
-        hpy_mode = hpy().get().mode
-    if not hpy_mode in HPY_MODE_MAP:
-        log.error("Unkown mode")
-        return
-    m = HPY_MODE_MAP[hpy_mode]
-    if m == 0:
-        return 
-    if m == 1:
-        return hpy().get().close_h5()
-    if m == 2:
-        return hpy().get().close_h5table()
+    return hpy().get().close_hdf5(hpy_mode)
 
 def get_group(gname, hpy_mode=DEFAULT_MODE):
-    if not hpy_mode in HPY_MODE_MAP:
-        log.error("Unkown mode")
-        return
-    m = HPY_MODE_MAP[hpy_mode]
-    if m == 0:
-        return
-    if m == 1:
-        return hpy().get().get_group_h5(gname)
-    if m == 2:
-        return hpy().get().get_group_h5table(gname)
+    return hpy().get().get_group(gname, hpy_mode)
 
 def get_data(dname, hpy_mode=DEFAULT_MODE):
-    if not hpy_mode in HPY_MODE_MAP:
-        log.error("Unkown mode")
-        return
-    m = HPY_MODE_MAP[hpy_mode]
-    if m == 0:
-        return
-    if m == 1:
-        return hpy().get().get_data_h5(dname)
-    if m == 2:
-        return hpy().get().get_data_h5table(dname)
+    return hpy().get().get_data(dname, hpy_mode)
+
+def read_data(dname, sel=None, hpy_mode=DEFAULT_MODE):
+    return hpy().get().read_data(dname, sel, hpy_mode)
+
+def iterate_data(dname, rows=None, hpy_mode=DEFAULT_MODE):
+    return hpy().get().iterate_data(dname, rows, hpy_mode)
+
+def prefetch_stats(hpy_mode=DEFAULT_MODE):
+    return hpy().get().prefetch_stats(hpy_mode)
+
+def gather_data(column, ext=DEFAULT_EXTENSION, hpy_mode=DEFAULT_MODE):
+    return hpy().get().gather_data(column, ext, hpy_mode)
+
+def query(ext, condition, columns=None):
+    return hpy().get().query(ext, condition, columns)
+
+def set_cache_size(max_bytes):
+    chunk_cache(max_bytes)
+
+def cache_stats():
+    return chunk_cache().get().stats()
 
 def create_r1_from_fits(fits_file, fname = None, v = 'v1'):
     h = hpy().get()
@@ -162,307 +214,729 @@ def create_r1_from_fits(fits_file, fname = None, v = 'v1'):
     except:
         return False
 
-class hpy:
-    class __hpy:
-        def __init__(self, file_configuration = None, log_file=LOG_FILE_STR,
-                     global_configuration=DEFAULT_GLOBAL_CONFIG):
-            logger_configuration().load(log_file)
-            if file_configuration:
-                warehouse(global_configuration).get().load(file_configuration)
-
-        def load_fits(self, fits_file, fits_mode,test=False):
-            self._fdata = from_fits().load_r1(fits_file, fits_mode, test)
-            return self._fdata
-            
-        def load_h5(self, fname):
-            self._h5 = h5_reader(fname)
-            self.is_open = True
-            self.mode = "h5py"
-
-        def load_h5table(self, fname):
-            self._h5table = h5table_reader(fname)
-            self.is_open = True
-            self.mode = "pytables"
-
-        def close_h5(self):
-            if self._h5:
-                self._h5.close()
-                self._h5 = None
-                self.is_open = False
-
-        def close_h5table(self):
-            if self._h5table:
-                self._h5table.close()
-                self._h5table = None
-                self.is_open = False
-            
-        def get_group_h5(self, gname):
-            return self._h5.get_group(gname)
-
-        def get_group_h5table(self, gname):
-            return self._h5table.get_group(gname)
+class session:
+    """@class session
+    This class holds the state of a conversion or a read: the loaded FITS
+    data, the opened HDF5 reader and its mode
+
+    Sessions do not share state, different threads may use different
+    sessions at once. The module functions use the hpy singleton session.
+    """
+    def load_fits(self, fits_file, fits_mode=DEFAULT_FITS_MODE, test=False,
+                  max_memory=None, spill=False, spill_dir=None):
+        if not fits_mode in FITS_MODE_MAP:
+            log.error("Unkown mode")
+            return
+        self._max_memory = max_memory
+        self._spill_dir = spill_dir
+        # The file of a previous load stays with the caller
+        self._spill_file = None
+        self._fdata = from_fits().load_r1(fits_file, FITS_MODE_MAP[fits_mode],
+                                          test, max_memory,
+                                          self.__spill if spill else None)
+        if self._spill:
+            with PYTABLES_LOCK:
+                self._spill.close()
+            self._spill = None
+        return self._fdata
+
+    def create_hdf5(self, fname = None, hpy_mode=DEFAULT_MODE,
+                    hdf5_format=DEFAULT_HDF5_FORMAT, **kwargs):
+        if not hpy_mode in HPY_MODE_MAP:
+            log.error("Unkown mode")
+            return
+        if not hdf5_format in HDF5_FORMAT:
+            log.error("Unknown format")
+            return
+
+        m = HPY_MODE_MAP[hpy_mode]
+        h5_fmt = HDF5_FORMAT[hdf5_format]
+
+        if m == 0:
+            return
+        if not self.check_spilled():
+            return False
+        if m == 1:
+            for k in [k for k in kwargs if k in PYTABLES_OPTIONS]:
+                log.warning("Option %s ignored in mode %s", k, hpy_mode)
+                kwargs.pop(k)
+        if h5_fmt == 0:
+            for k in [k for k in kwargs if k in BYTABLES_OPTIONS]:
+                log.warning("Option %s ignored in format %s", k, hdf5_format)
+                kwargs.pop(k)
+        if m == 1 and h5_fmt == 0:
+            return self.create_h5(fname, **kwargs)
+        if m == 2 and h5_fmt == 0:
+            return self.create_h5table(fname, **kwargs)
+
+        if m == 1 and h5_fmt == 1:
+            return self.create_h5_tables(fname, **kwargs)
+        if m == 2 and h5_fmt == 1:
+            return self.create_h5table_tables(fname, **kwargs)
+
+    def load_hdf5(self, fname, hpy_mode=DEFAULT_MODE, **kwargs):
+        m = self.__mode(hpy_mode)
+        if not m:
+            return
+        if is_vds(fname):
+            # Virtual datasets are only readable through h5py
+            if m != 1:
+                log.error("%s holds virtual datasets, open it in h5py mode",
+                          fname)
+                return
+            return self.load_vds(fname, **kwargs)
+        if m == 1:
+            return self.load_h5(fname, **kwargs)
+        if m == 2:
+            return self.load_h5table(fname, **kwargs)
+
+    def close_hdf5(self, hpy_mode=None):
+        if self.is_open:
+            hpy_mode = self.mode
+        m = self.__mode(hpy_mode)
+        if m == 1:
+            return self.close_h5()
+        if m == 2:
+            return self.close_h5table()
+
+    def get_group(self, gname, hpy_mode=None):
+        m = self.__mode(hpy_mode)
+        if m == 1:
+            return self.get_group_h5(gname)
+        if m == 2:
+            return self.get_group_h5table(gname)
+
+    def get_data(self, dname, hpy_mode=None):
+        m = self.__mode(hpy_mode)
+        if m == 1:
+            return self.get_data_h5(dname)
+        if m == 2:
+            return self.get_data_h5table(dname)
+
+    def read_data(self, dname, sel=None, hpy_mode=None):
+        m = self.__mode(hpy_mode)
+        if m == 1:
+            return self.read_data_h5(dname, sel)
+        if m == 2:
+            return self.read_data_h5table(dname, sel)
+
+    def iterate_data(self, dname, rows=None, hpy_mode=None):
+        m = self.__mode(hpy_mode)
+        if m == 1:
+            return self.iterate_data_h5(dname, rows)
+        if m == 2:
+            return self.iterate_data_h5table(dname, rows)
+
+    def prefetch_stats(self, hpy_mode=None):
+        if self.is_open:
+            hpy_mode = self.mode
+        m = self.__mode(hpy_mode)
+        if m == 1:
+            return self._h5.prefetch_stats()
+        if m == 2:
+            return self._h5table.prefetch_stats()
+
+    def gather_data(self, column, ext=DEFAULT_EXTENSION, hpy_mode=None):
+        m = self.__mode(hpy_mode)
+        if m == 1:
+            return self.gather_data_h5(column, ext)
+        if m == 2:
+            return self.gather_data_h5table(column, ext)
+
+    def query(self, ext, condition, columns=None):
+        if not self.is_open or HPY_MODE_MAP[self.mode] != 2:
+            log.error("Queries need a file opened in pytables mode")
+            return
+        return self.query_h5table(ext, condition, columns)
+
+    def close(self):
+        """Closes the opened file and drops the loaded data"""
+        self.close_h5()
+        self.close_h5table()
+        self._fdata = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __mode(self, hpy_mode):
+        # The mode of the opened file, unless another is given
+        if hpy_mode is None:
+            hpy_mode = self.mode
+        if not hpy_mode in HPY_MODE_MAP:
+            log.error("Unkown mode")
+            return None
+        return HPY_MODE_MAP[hpy_mode]
+
+    def __spill(self, ext, items, header=None):
+        # Spilled events are written as create_hdf5 pytables bytables does
+        if not self._spill:
+            fd, fname = tempfile.mkstemp(prefix="hpy_spill_", suffix=".h5",
+                                         dir=self._spill_dir)
+            os.close(fd)
+            log.warning("Memory budget exceeded, spilling events to %s",
+                        fname)
+            with PYTABLES_LOCK:
+                self._spill = h5table_writer(fname)
+            self._spill_groups = {}
+            self._spill_ragged = {}
+            self._spill_file = fname
+        h = self._spill
+        data = self._spill_groups.get(ext)
+        if data is None:
+            with PYTABLES_LOCK:
+                data = h.create_group("data", h.create_group(ext))
+            self._spill_groups[ext] = data
+            self._spill_ragged[ext] = variable_length_columns(header or {})
+        self.__write_table_batch(items, data, h, self._spill_ragged[ext])
+        with PYTABLES_LOCK:
+            h.flush()
+        return h._f.filename
+
+    def check_spilled(self):
+        # Spilled events are not in the loaded data, a file written from
+        # it would miss them
+        ret = True
+        if not self._fdata:
+            return ret
+        for ext, ext_obj in self._fdata.__dict__.items():
+            if ext_obj.spilled_events:
+                log.error("%d events of %s were spilled to %s, they can not "
+                          "be written, open_hdf5 reads them in pytables mode",
+                          ext_obj.spilled_events, ext, ext_obj.spill_file)
+                ret = False
+        return ret
+
+    def spill_file(self):
+        """Returns the file of the events spilled by the last load, None if
+        none were
+
+        The first spilled_events events of each extension are in /<ext>/data
+        of the file, in the pytables bytables layout, i.e. read with
+        open_hdf5(path, "pytables"), and the loaded items follow them. The
+        file is kept when the session is closed, the caller removes it.
+        """
+        return self._spill_file
+
+    def memory_report(self):
+        if not self._fdata:
+            log.error("No data provided")
+            return None
+        return mem_report(self._fdata, self._max_memory)
         
-        def get_data_h5(self, dname):
-            return self._h5.get_dataset(dname)
+    def to_arrow(self, ext=None):
+        if not self._fdata:
+            log.error("No data provided")
+            return None
+        return self._fdata.to_arrow(ext)
+
+    def iterate_arrow(self, fits_file, ext, fits_mode, batch_size):
+        records = from_fits().iterate_r1(fits_file, ext, fits_mode,
+                                         batch_size)
+        # astropy reads blocks of rows as columns
+        return record_batches(records, fits_mode == 0, batch_size)
+
+    def create_arrow(self, fname=None, ext=None, compression=None):
+        if not fname: fname = "d" + ARROW_SUFFIX
+        if not self.check_spilled():
+            return False
+        tables = self.to_arrow(ext)
+        if tables is None:
+            return False
+        if ext is not None:
+            return write_arrow(fname, tables, compression) is not None
+        # A file per extension, fname_<ext>
+        root, suffix = os.path.splitext(fname)
+        for k, table in tables.items():
+            if write_arrow("%s_%s%s"%(root, k, suffix or ARROW_SUFFIX),
+                           table, compression) is None:
+                return False
+        return True
+
+    def load_h5(self, fname, **kwargs):
+        self._h5 = h5_reader(fname, **kwargs)
+        self.is_open = True
+        self.mode = "h5py"
+
+    def load_vds(self, fname, **kwargs):
+        self.load_h5(fname, **kwargs)
+        root = os.path.dirname(os.path.abspath(fname))
+        for f in self._h5._f.attrs[VDS_SOURCES_ATTR]:
+            if isinstance(f, bytes): f = f.decode()
+            if not os.path.isfile(os.path.join(root, f)):
+                log.warning("Missing source file %s, its rows read as fill values", f)
+
+    def load_h5table(self, fname, **kwargs):
+        self._h5table = h5table_reader(fname, **kwargs)
+        self.is_open = True
+        self.mode = "pytables"
+
+    def close_h5(self):
+        if self._h5:
+            self._h5.close()
+            self._h5 = None
+            self.is_open = False
+
+    def close_h5table(self):
+        if self._h5table:
+            self._h5table.close()
+            self._h5table = None
+            self.is_open = False
+        
+    def get_group_h5(self, gname):
+        return self._h5.get_group(gname)
+
+    def get_group_h5table(self, gname):
+        return self._h5table.get_group(gname)
     
-        def get_data_h5table(self, dname):
-            return self._h5table.get_dataset(dname)
+    def get_data_h5(self, dname):
+        return self._h5.get_dataset(dname)
 
-        def create_h5_tables(self, fname, **kwargs):
-            if not self._fdata:
-                log.error("No data provided")
-                return False
-            
-            h = h5_writer(fname, **kwargs)
+    def get_data_h5table(self, dname):
+        return self._h5table.get_dataset(dname)
 
-            for ext in self._fdata.__dict__:
-                gext = h.create_group(ext)
-                extfunc = getattr(self._fdata, ext)
-                header = h.create_group("header", gext)
-                for k in extfunc.header:
-                    hg = h.create_group(k, header)
-                    h.create_dataset("comment", extfunc.header.comments[k], hg)
-                    h.create_dataset("value", extfunc.header[k], hg)
+    def read_data_h5(self, dname, sel=None):
+        return self._h5.read(dname, sel)
 
-                data = h.create_group("data", gext)
-                for col in extfunc.items:
-                    self.__create_h5_tables(col, data, h)
-            h.close()
+    def read_data_h5table(self, dname, sel=None):
+        return self._h5table.read(dname, sel)
 
-            return True
+    def iterate_data_h5(self, dname, rows=None):
+        return self._h5.iterate(dname, rows)
+
+    def iterate_data_h5table(self, dname, rows=None):
+        return self._h5table.iterate(dname, rows)
+
+    def gather_data_h5(self, column, ext):
+        return self._h5.gather(column, ext)
+
+    def gather_data_h5table(self, column, ext):
+        return self._h5table.gather(column, ext)
 
-        def __create_h5_tables(self, items, group2fill, h5):
-            for k in items.__dict__:
-                if 'hpy.utils.fits.ExtensionItem' in \
-                   str(type(getattr(items, k))):
-                    g = h5.create_group(k, group2fill)
-                    self.__create_h5_tables(getattr(items,k),g,h5)
-                    continue
-                if not isinstance(getattr(items, k), np.ndarray) and \
-                   getattr(items, k) == None:
-                    continue
-                if isinstance(getattr(items, k), np.ndarray) and \
-                   getattr(items, k).size == 0:
-                    continue
-                if isinstance(getattr(items, k), str) and \
-                   len(getattr(items, k)) == 0:
-                    continue
-                
-                data = getattr(items, k)
-                
-                dset = h5.check_dataset(k,group2fill)
-                if not dset: 
-                
-                    if type(data) is fits.column._VLF:
-                        log.warning("fits.column._VLF type detected...")
-                        log.warning("The table format does not support this type of data...")
-                        log.warning("Skipping this data...")
-                        continue
-                    else:
-                        if isinstance(data, np.ndarray):
-                            shape = (1,) + data.shape
-                            tdata = np.ndarray(shape=shape,dtype=data.dtype)
-                            tdata[0] = data
-
-                            h5.create_dataset(k, tdata, group2fill,
-                                              chunks=(100,100))
-                        elif isinstance(data, str):
-                            tdata = np.array([data],dtype=object)
-                            
-                            dt = h5.create_special_dtype(bytes)
-                            dset = h5.create_dataset(k, [tdata], group2fill, 
-                                                     dtype=dt,
-                                                     chunks=(100,100))
-                        else:
-                            tdata = np.ndarray(dtype=type(data), shape=(1,))
-                            tdata[0] = data
-                            
-                            h5.create_dataset(k, [tdata], group2fill,
-                                              chunks=(100,100))
+    def query_h5table(self, ext, condition, columns=None):
+        return self._h5table.query(ext, condition, columns)
+
+    def create_h5_tables(self, fname, **kwargs):
+        if not self._fdata:
+            log.error("No data provided")
+            return False
+        
+        h = h5_writer(fname, **kwargs)
+
+        for ext in self._fdata.__dict__:
+            gext = h.create_group(ext)
+            extfunc = getattr(self._fdata, ext)
+            header = h.create_group("header", gext)
+            for k in extfunc.header:
+                hg = h.create_group(k, header)
+                h.create_dataset("comment", extfunc.header.comments[k], hg)
+                h.create_dataset("value", extfunc.header[k], hg)
+
+            data = h.create_group("data", gext)
+            for col in extfunc.items:
+                self.__create_h5_tables(col, data, h)
+        h.close()
+
+        return True
+
+    def __create_h5_tables(self, items, group2fill, h5):
+        for k in items._fields:
+            if isinstance(getattr(items, k), record):
+                g = h5.create_group(k, group2fill)
+                self.__create_h5_tables(getattr(items,k),g,h5)
+                continue
+            if not isinstance(getattr(items, k), np.ndarray) and \
+               getattr(items, k) == None:
+                continue
+            if isinstance(getattr(items, k), np.ndarray) and \
+               getattr(items, k).size == 0:
+                continue
+            if isinstance(getattr(items, k), str) and \
+               len(getattr(items, k)) == 0:
+                continue
+            
+            data = getattr(items, k)
+            
+            if type(data) is fits.column._VLF:
+                h5.append_ragged(k, data, group2fill)
+                continue
+
+            dset = h5.check_dataset(k,group2fill)
+            if not dset: 
+                if isinstance(data, np.ndarray):
+                    shape = (1,) + data.shape
+                    tdata = np.ndarray(shape=shape,dtype=data.dtype)
+                    tdata[0] = data
+
+                    h5.create_dataset(k, tdata, group2fill,
+                                      chunks=(100,100))
+                elif isinstance(data, str):
+                    tdata = np.array([data],dtype=object)
+                    
+                    dt = h5.create_special_dtype(bytes)
+                    dset = h5.create_dataset(k, [tdata], group2fill, 
+                                             dtype=dt,
+                                             chunks=(100,100))
                 else:
-                    if isinstance(data, np.ndarray):
-                        h5.append_data(data, dset)
-                    elif isinstance(data, str):
-                        h5.append_data(data, dset)
-                    else:
-                        h5.append_data([data],dset)
-
-        def __create_table_tables(self, items, group2fill, h5):
-            for k in items.__dict__:
-                if 'hpy.utils.fits.ExtensionItem' in \
-                   str(type(getattr(items, k))):
-                    g = h5.create_group(k, group2fill)
-                    self.__create_table_groups(getattr(items, k), g, h5)
-                    continue
-                #log.info("Create dataset %s - %s", k, getattr(items, k))
-                if not isinstance(getattr(items, k), np.ndarray) and \
-                   getattr(items, k) == None:
-                    continue
-                if isinstance(getattr(items, k), np.ndarray) and \
-                   getattr(items, k).size == 0:
-                    continue
-                if isinstance(getattr(items, k), str) and \
-                   len(getattr(items, k)) == 0:
-                    continue
-                dclass = type("DClass", (data_container,),{"data": Field(getattr(items,k))})
-                dataset = dclass()
-                
-                dset = h5.check_dataset(k, group2fill)
-                if not dset:
-                    h5.create_dataset(k, dataset, group2fill)
+                    tdata = np.ndarray(dtype=type(data), shape=(1,))
+                    tdata[0] = data
+                    
+                    h5.create_dataset(k, [tdata], group2fill,
+                                      chunks=(100,100))
+            else:
+                if isinstance(data, np.ndarray):
+                    h5.append_data(data, dset)
+                elif isinstance(data, str):
+                    h5.append_data(data, dset)
                 else:
-                    h5.append_data((dataset, ), dset)
-
-        def create_h5table_tables(self, fname, **kwargs):
-            if not self._fdata:
-                log.error("No data provided")
-                return False
+                    h5.append_data([data],dset)
+
+    def __create_table_tables(self, items, group2fill, h5):
+        for k in items._fields:
+            if isinstance(getattr(items, k), record):
+                g = h5.create_group(k, group2fill)
+                self.__create_table_groups(getattr(items, k), g, h5)
+                continue
+            #log.info("Create dataset %s - %s", k, getattr(items, k))
+            if not isinstance(getattr(items, k), np.ndarray) and \
+               getattr(items, k) == None:
+                continue
+            if isinstance(getattr(items, k), np.ndarray) and \
+               getattr(items, k).size == 0:
+                continue
+            if isinstance(getattr(items, k), str) and \
+               len(getattr(items, k)) == 0:
+                continue
+            if type(getattr(items, k)) is fits.column._VLF:
+                h5.append_ragged(k, getattr(items, k), group2fill)
+                continue
+            dataset = field_container("data", getattr(items, k))
             
+            dset = h5.check_dataset(k, group2fill)
+            if not dset:
+                h5.create_dataset(k, dataset, group2fill)
+            else:
+                h5.append_data((dataset, ), dset)
+
+    def create_h5table_tables(self, fname, batch_size=DEFAULT_BATCH_SIZE,
+                              **kwargs):
+        if not self._fdata:
+            log.error("No data provided")
+            return False
+        
+        # PyTables is not thread safe, other sessions may be using it
+        with PYTABLES_LOCK:
             h = h5table_writer(fname, **kwargs)
 
-            for ext in self._fdata.__dict__:
-                #log.info(ext)
+        for ext in self._fdata.__dict__:
+            extfunc = getattr(self._fdata, ext)
+            with PYTABLES_LOCK:
                 gext = h.create_group(ext)
-                extfunc = getattr(self._fdata, ext)
-                #log.info(extfunc.header)
                 header = h.create_group("header", gext)
+                # Each header keyword is a single row
+                h.expected_rows(header, 1)
                 for k in extfunc.header:
                     hg = h.create_group(k, header)
-                    dclass = type("DClass", (data_container,),{"data": Field(extfunc.header.comments[k])})
-                    dataset = dclass()
+                    dataset = field_container("data", extfunc.header.comments[k])
                     h.create_dataset("comment", dataset, hg)
-                    dclass = type("DClass", (data_container,),{"data": Field(extfunc.header[k])})
-                    dataset = dclass()
+                    dataset = field_container("data", extfunc.header[k])
                     h.create_dataset("value", dataset, hg)
-                    
+
                 data = h.create_group("data", gext)
+                h.expected_rows(data, self.__expected_rows(extfunc))
+            if batch_size > 1:
+                # Columns written ragged by a batch stay ragged in the next
+                ragged = variable_length_columns(extfunc.header)
+                for i in range(0, len(extfunc.items), batch_size):
+                    self.__write_table_batch(
+                        extfunc.items[i:i + batch_size], data, h, ragged)
+                continue
+            with PYTABLES_LOCK:
                 for col in extfunc.items:
                     self.__create_table_tables(col, data, h)
+        with PYTABLES_LOCK:
             h.close()
+        return True
+
+    def __expected_rows(self, extfunc):
+        # NAXIS2, unless the extension was loaded as whole columns or
+        # only partially
+        nrows = extfunc.header.get('NAXIS2')
+        if nrows is None or len(extfunc.items) < nrows:
+            nrows = len(extfunc.items)
+        return nrows
+
+    def __write_table_batch(self, batch, group2fill, h5, ragged_columns):
+        # ragged_columns holds the names (TTYPE) of the variable length
+        # columns of the extension and gets the paths found ragged
+        columns = {}
+        ragged = {}
+        for items in batch:
+            self.__collect_columns(items, (), columns, ragged)
+        for path in list(columns):
+            values = columns[path]
+            if self.__is_ragged(path, values, ragged_columns):
+                ragged[path] = ragged.get(path, []) + columns.pop(path)
+            elif all(isinstance(v, np.ndarray) and v.size == 0
+                     for v in values):
+                del columns[path]
+        ragged_columns.update(ragged)
+        with PYTABLES_LOCK:
+            self.__write_columns(columns, ragged, group2fill, h5)
+
+    def __write_columns(self, columns, ragged, group2fill, h5):
+        groups = {(): group2fill}
+        for path in list(columns) + list(ragged):
+            parent = groups.get(path[:-1])
+            if parent is None:
+                parent = group2fill
+                for i in range(len(path) - 1):
+                    parent = h5.create_group(path[i], parent)
+                    groups[path[:i + 1]] = parent
+            if path in ragged:
+                h5.append_ragged(path[-1], ragged[path], parent)
+                continue
+            h5.append_column(path[-1], columns[path], parent)
+
+    def __is_ragged(self, path, values, ragged_columns):
+        # Variable length arrays of protozfits or of per event records are
+        # plain arrays, told by the header or by their shapes
+        if path in ragged_columns or path[-1] in ragged_columns:
             return True
-
-        def create_h5table(self, fname = None, **kwargs):
-
-            if not self._fdata:
-                log.error("No data provided")
-                return False
-
+        return all(isinstance(v, np.ndarray) and v.ndim for v in values) and \
+            len(set(v.shape for v in values)) > 1
+
+    def __collect_columns(self, items, prefix, columns, ragged):
+        for k in items._fields:
+            v = getattr(items, k)
+            if isinstance(v, record):
+                self.__collect_columns(v, prefix + (k,), columns, ragged)
+                continue
+            if type(v) is fits.column._VLF:
+                # Every element of a variable length column is a row
+                ragged.setdefault(prefix + (k,), []).extend(v)
+                continue
+            if not isinstance(v, np.ndarray) and v == None:
+                continue
+            # Empty arrays are kept, they can be rows of a ragged column
+            if isinstance(v, str) and len(v) == 0:
+                continue
+            columns.setdefault(prefix + (k,), []).append(v)
+
+    def create_h5table(self, fname = None, **kwargs):
+
+        if not self._fdata:
+            log.error("No data provided")
+            return False
+
+        # PyTables is not thread safe, other sessions may be using it, the
+        # lock is only held while writing
+        kwargs.setdefault('array_threshold', 0)
+        with PYTABLES_LOCK:
             h = h5table_writer(fname, **kwargs)
 
-            for ext in self._fdata.__dict__:
-                #log.info(ext)
-                gext = h.create_group(ext)
-                extfunc = getattr(self._fdata, ext)
-                #log.info(extfunc.header)
-                header = h.create_group("header", gext)
-                for k in extfunc.header:
-                    hg = h.create_group(k, header)
-                    dclass = type("DClass", (data_container,),{"data": Field(extfunc.header.comments[k])})
-                    dataset = dclass()
-                    h.create_dataset("comment", dataset, hg)
-                    dclass = type("DClass", (data_container,),{"data": Field(extfunc.header[k])})
-                    dataset = dclass()
-                    h.create_dataset("value", dataset, hg)
-                    
-                data = h.create_group("data", gext)
-                i = 0
-                for col in extfunc.items:
-                    #log.info(col)
-                    g = h.create_group("%s_%s"%(ext, '{:>08d}'.format(i)), data)
-                    self.__create_table_groups(col, g, h)
-                    i = i + 1
-            h.close()
-            return True
-
-        def create_h5(self, fname = None, **kwargs):
-            
-            if not self._fdata:
-                log.error("No data provided")
-                return False
-            
-            h = h5_writer(fname, **kwargs)
-            
-            for ext in self._fdata.__dict__:
+        for ext in self._fdata.__dict__:
+            #log.info(ext)
+            extfunc = getattr(self._fdata, ext)
+            #log.info(extfunc.header)
+            keywords = [(k, field_container("data", extfunc.header.comments[k]),
+                         field_container("data", extfunc.header[k]))
+                        for k in extfunc.header]
+            with PYTABLES_LOCK:
                 gext = h.create_group(ext)
-                extfunc = getattr(self._fdata, ext)
                 header = h.create_group("header", gext)
-                for k in extfunc.header:
+                # Each header keyword is a single row
+                h.expected_rows(header, 1)
+                for k, comment, value in keywords:
                     hg = h.create_group(k, header)
-                    h.create_dataset("comment", extfunc.header.comments[k], hg)
-                    h.create_dataset("value", extfunc.header[k], hg)
+                    h.create_dataset("comment", comment, hg)
+                    h.create_dataset("value", value, hg)
 
                 data = h.create_group("data", gext)
-                i = 0
-                for col in extfunc.items:
+                # Each event group holds a single row
+                h.expected_rows(data, 1)
+            i = 0
+            for col in extfunc.items:
+                #log.info(col)
+                entries = self.__collect_table_groups(col, (), [])
+                with PYTABLES_LOCK:
                     g = h.create_group("%s_%s"%(ext, '{:>08d}'.format(i)), data)
-                    self.__create_h5_groups(col, g, h)
-                    i = i + 1
+                    self.__write_table_groups(entries, g, h)
+                i = i + 1
+        with PYTABLES_LOCK:
             h.close()
-            return True
-                        
-            
-        def create_r1_from_fits(self, fits_file, fname = None, v = 'v1'):
-            if not fits_file:
-                log.error("No FITS file provided")
-                return False
-
-            try:
-                return from_fits().create_r1(fits_file, fname, v=v)
-            except:
-                return False
+        return True
 
-        def __create_table_groups(self, items, group2fill, h5):
-            for k in items.__dict__:
-                if 'hpy.utils.fits.ExtensionItem' in \
-                   str(type(getattr(items, k))):
-                    g = h5.create_group(k, group2fill)
-                    self.__create_table_groups(getattr(items, k), g, h5)
-                    continue
-                #log.info("Create dataset %s - %s", k, getattr(items, k))
-                if not isinstance(getattr(items, k), np.ndarray) and getattr(items, k) == None:
-                    continue
-                if isinstance(getattr(items, k), np.ndarray) and getattr(items, k).size == 0:
-                    continue
-                if isinstance(getattr(items, k), str) and len(getattr(items, k)) == 0:
-                    continue
-                dclass = type("DClass", (data_container,),{"data": Field(getattr(items,k))})
-                dataset = dclass()
-                h5.create_dataset(k, dataset, group2fill)
-
-        def __create_h5_groups(self, items, group2fill, h5):
-            for k in items.__dict__:
-                if 'hpy.utils.fits.ExtensionItem' in \
-                   str(type(getattr(items, k))):
-                    g = h5.create_group(k, group2fill)
-                    self.__create_h5_groups(getattr(items, k), g, h5)
-                    continue
-                #log.info("Create dataset %s - %s", k, getattr(items, k))
-                if not isinstance(getattr(items, k), np.ndarray) and \
-                   getattr(items, k) == None:
-                    continue
-                if isinstance(getattr(items, k), np.ndarray) and \
-                   getattr(items, k).size == 0:
-                    continue
-                if isinstance(getattr(items, k), str) and \
-                   len(getattr(items, k)) == 0:
-                    continue
-                data = getattr(items, k)
-                if type(data) is fits.column._VLF:
-                    if data.size > 1:
-                        dt = h5.create_special_dtype(np.dtype(data[0].dtype))
-                        ds = h5.create_multidataset(k, (data.size,), dt, group2fill)
-                        i = 0
-                        for d in data:
-                            ds[i] = d
-                            i = i + 1
-                    else:
-                        if type(data[0]) is np.ndarray:
-                            h5.create_dataset(k, data[0], group2fill, data[0].dtype)
-                else:
-                    h5.create_dataset(k, getattr(items, k), group2fill)
+    def create_h5(self, fname = None, **kwargs):
+        
+        if not self._fdata:
+            log.error("No data provided")
+            return False
         
-        mode = "h5py"
-        is_open = False
+        h = h5_writer(fname, **kwargs)
+        
+        for ext in self._fdata.__dict__:
+            gext = h.create_group(ext)
+            extfunc = getattr(self._fdata, ext)
+            header = h.create_group("header", gext)
+            for k in extfunc.header:
+                hg = h.create_group(k, header)
+                h.create_dataset("comment", extfunc.header.comments[k], hg)
+                h.create_dataset("value", extfunc.header[k], hg)
+
+            data = h.create_group("data", gext)
+            i = 0
+            for col in extfunc.items:
+                g = h.create_group("%s_%s"%(ext, '{:>08d}'.format(i)), data)
+                self.__create_h5_groups(col, g, h)
+                i = i + 1
+        h.close()
+        return True
+                    
+        
+    def create_r1_from_fits(self, fits_file, fname = None, v = 'v1'):
+        if not fits_file:
+            log.error("No FITS file provided")
+            return False
+
+        try:
+            return from_fits().create_r1(fits_file, fname, v=v)
+        except:
+            return False
+
+    def __create_table_groups(self, items, group2fill, h5):
+        for k in items._fields:
+            if isinstance(getattr(items, k), record):
+                g = h5.create_group(k, group2fill)
+                self.__create_table_groups(getattr(items, k), g, h5)
+                continue
+            #log.info("Create dataset %s - %s", k, getattr(items, k))
+            if not isinstance(getattr(items, k), np.ndarray) and getattr(items, k) == None:
+                continue
+            if isinstance(getattr(items, k), np.ndarray) and getattr(items, k).size == 0:
+                continue
+            if isinstance(getattr(items, k), str) and len(getattr(items, k)) == 0:
+                continue
+            if type(getattr(items, k)) is fits.column._VLF:
+                h5.append_ragged(k, getattr(items, k), group2fill)
+                continue
+            dataset = field_container("data", getattr(items, k))
+            h5.create_dataset(k, dataset, group2fill)
+
+    def __collect_table_groups(self, items, prefix, entries):
+        # The datasets of an event, converted before taking PYTABLES_LOCK
+        for k in items._fields:
+            v = getattr(items, k)
+            if isinstance(v, record):
+                entries.append((prefix + (k,), None))
+                self.__collect_table_groups(v, prefix + (k,), entries)
+                continue
+            if not isinstance(v, np.ndarray) and v == None:
+                continue
+            if isinstance(v, np.ndarray) and v.size == 0:
+                continue
+            if isinstance(v, str) and len(v) == 0:
+                continue
+            if type(v) is fits.column._VLF:
+                entries.append((prefix + (k,), v))
+                continue
+            entries.append((prefix + (k,), field_container("data", v)))
+        return entries
+
+    def __write_table_groups(self, entries, group2fill, h5):
+        groups = {(): group2fill}
+        for path, v in entries:
+            parent = groups[path[:-1]]
+            if v is None:
+                groups[path] = h5.create_group(path[-1], parent)
+            elif type(v) is fits.column._VLF:
+                h5.append_ragged(path[-1], v, parent)
+            else:
+                h5.create_dataset(path[-1], v, parent)
+
+    def __create_h5_groups(self, items, group2fill, h5):
+        for k in items._fields:
+            if isinstance(getattr(items, k), record):
+                g = h5.create_group(k, group2fill)
+                self.__create_h5_groups(getattr(items, k), g, h5)
+                continue
+            #log.info("Create dataset %s - %s", k, getattr(items, k))
+            if not isinstance(getattr(items, k), np.ndarray) and \
+               getattr(items, k) == None:
+                continue
+            if isinstance(getattr(items, k), np.ndarray) and \
+               getattr(items, k).size == 0:
+                continue
+            if isinstance(getattr(items, k), str) and \
+               len(getattr(items, k)) == 0:
+                continue
+            data = getattr(items, k)
+            if type(data) is fits.column._VLF:
+                if data.size > 1:
+                    dt = h5.create_special_dtype(np.dtype(data[0].dtype))
+                    ds = h5.create_multidataset(k, (data.size,), dt, group2fill)
+                    i = 0
+                    for d in data:
+                        ds[i] = d
+                        i = i + 1
+                else:
+                    if type(data[0]) is np.ndarray:
+                        h5.create_dataset(k, data[0], group2fill, data[0].dtype)
+            else:
+                h5.create_dataset(k, getattr(items, k), group2fill)
+    
+    mode = "h5py"
+    is_open = False
+    _fdata = None
+    _h5 = None
+    _h5table = None
+    _max_memory = None
+    _spill = None
+    _spill_dir = None
+    _spill_file = None
+
+class output:
+    """@class output
+    This class is an HDF5 file to be written from the data of a session
+
+    >>>    with hpy.open_fits(fits_file) as src, \\
+    >>>         hpy.create_output(h5_file, hpy_mode="pytables") as dst:
+    >>>        dst.write(src)
+    """
+    def __init__(self, fname=None, hpy_mode=DEFAULT_MODE,
+                 hdf5_format=DEFAULT_HDF5_FORMAT, **kwargs):
+        self.fname = fname
+        self.hpy_mode = hpy_mode
+        self.hdf5_format = hdf5_format
+        self._kwargs = kwargs
+
+    def write(self, src):
+        """Writes the FITS data loaded by the src session"""
+        self.written = src.create_hdf5(self.fname, self.hpy_mode,
+                                       self.hdf5_format, **dict(self._kwargs))
+        return self.written
+
+    def open(self, **kwargs):
+        """Returns a session reading the file written"""
+        return open_hdf5(self.fname, self.hpy_mode, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    written = None
+
+class hpy:
+    class __hpy(session):
+        def __init__(self, file_configuration = None, log_file=LOG_FILE_STR,
+                     global_configuration=DEFAULT_GLOBAL_CONFIG):
+            logger_configuration().load(log_file)
+            if file_configuration:
+                warehouse(global_configuration).get().load(file_configuration)
         #
         #
         #
@@ -0,0 +1,290 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.arrow
+
+--------------------------------------------------------------------------------
+
+This module provides the Apache Arrow export of the FITS data
+"""
+import itertools
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+from hpy.log import logger
+from hpy.core.h5base import ragged_arrays, stack_values
+from hpy.utils.data_container import record
+
+## Events of the record batches streamed from a FITS file
+DEFAULT_ARROW_BATCH = 1000
+## Suffix of the Arrow IPC files
+ARROW_SUFFIX = ".arrow"
+
+log = logger().get_log("arrow")
+
+def available():
+    """Returns True if pyarrow can be imported, logs an error otherwise"""
+    if pa is None:
+        log.error("pyarrow is not installed")
+        return False
+    return True
+
+def column_array(values):
+    """Wraps the values of a column, with a leading row axis, as an array
+
+    Contiguous numeric columns in native byte order share their buffer
+    with the Arrow array. Trailing axes become fixed size lists and
+    object columns of arrays (variable length fields) become lists. None
+    values are nulls. Returns None for values Arrow can not hold, raises
+    TypeError for object values that can not be converted
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'O':
+        if values.ndim == 1 and any(np.ndim(v) for v in values):
+            return list_array(values)
+        ret = object_array(values.reshape(-1))
+    elif values.dtype.kind not in 'biufSU':
+        return None
+    else:
+        if not values.dtype.isnative:
+            # FITS stores big endian values, Arrow only takes native ones
+            values = values.astype(values.dtype.newbyteorder('='))
+        ret = pa.array(np.ascontiguousarray(values).reshape(-1))
+        if values.dtype.kind == 'S':
+            ret = ret.cast(pa.string())
+    for dim in reversed(values.shape[1:]):
+        ret = pa.FixedSizeListArray.from_arrays(ret, dim)
+    return ret
+
+def object_array(values):
+    """Returns the array of a flat sequence of scalars, None are nulls
+
+    Raises TypeError for values Arrow can not convert
+    """
+    values = [v[()] if isinstance(v, np.ndarray) and not v.ndim else v
+              for v in values]
+    try:
+        return pa.array(values, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) \
+           as e:
+        types = sorted(set(type(v).__name__ for v in values))
+        raise TypeError("Values of type %s can not be converted to Arrow: "
+                        "%s"%(", ".join(types), e))
+
+def list_array(rows):
+    """Returns a list array with a row per array of rows, None rows are
+    nulls
+    """
+    if not len(rows) or all(isinstance(r, str) for r in rows):
+        return pa.array(list(rows))
+    missing = np.array([r is None for r in rows], dtype=bool)
+    if missing.all():
+        return pa.array([None] * len(rows))
+    try:
+        values, ends = ragged_arrays([r for r in rows if r is not None])
+    except ValueError:
+        return None
+    if values.dtype.kind == 'O':
+        # Never back to column_array, the elements would be rows again
+        child = object_array(values.reshape(-1)) if values.ndim == 1 else None
+    else:
+        child = column_array(values)
+    if child is None:
+        return None
+    lengths = np.zeros(len(rows), dtype=np.int64)
+    lengths[~missing] = np.diff(ends, prepend=0)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    # The offset starting a null row makes it null
+    mask = np.append(missing, False) if missing.any() else None
+    if offsets[-1] < 2**31:
+        return pa.ListArray.from_arrays(
+            pa.array(offsets.astype(np.int32), mask=mask), child)
+    return pa.LargeListArray.from_arrays(pa.array(offsets, mask=mask), child)
+
+def record_arrays(item):
+    """Returns the names and arrays of a record holding whole columns,
+    the missing columns are nulls
+    """
+    names = []
+    arrays = []
+    missing = []
+    for k in item._fields:
+        v = getattr(item, k, None)
+        if v is None:
+            missing.append(len(arrays))
+            names.append(k)
+            arrays.append(None)
+            continue
+        if isinstance(v, record):
+            ret = struct_array(*record_arrays(v))
+        else:
+            ret = column_array(v)
+        _append_array(names, arrays, k, ret)
+    rows = next((len(a) for a in arrays if a is not None), 0)
+    for i in missing:
+        arrays[i] = pa.array([None] * rows)
+    return names, arrays
+
+def event_arrays(items):
+    """Returns the names and arrays of a list of records, one per event"""
+    names = []
+    arrays = []
+    for k in items[0]._fields:
+        values = [getattr(item, k, None) for item in items]
+        if isinstance(values[0], record):
+            ret = None
+            if all(isinstance(v, record) for v in values):
+                ret = struct_array(*event_arrays(values))
+        else:
+            ret = event_column(values)
+        _append_array(names, arrays, k, ret)
+    return names, arrays
+
+def event_column(values):
+    """Returns the array of the values of a field, one per event, the
+    events without the field are nulls
+    """
+    missing = np.array([v is None for v in values], dtype=bool)
+    if not missing.any():
+        return column_array(stack_values(values))
+    if missing.all():
+        return pa.array([None] * len(values))
+    ret = column_array(stack_values([v for v in values if v is not None]))
+    if ret is None:
+        return None
+    # A null index takes a null
+    index = np.cumsum(~missing) - 1
+    return ret.take(pa.array(index, mask=missing))
+
+def _append_array(names, arrays, name, array):
+    if array is None:
+        log.warning("Column %s not supported by Arrow, skipped"%(name))
+        return
+    names.append(name)
+    arrays.append(array)
+
+def struct_array(names, arrays):
+    """Returns a struct array with a child per nested column"""
+    return pa.StructArray.from_arrays(arrays, names=names)
+
+def extension_table(ext_obj):
+    """Returns the table of an extension of the loaded data"""
+    if not ext_obj.items:
+        return pa.table({})
+    if ext_obj.columnar:
+        batches = [pa.RecordBatch.from_arrays(arrays, names=names)
+                   for names, arrays in map(record_arrays, ext_obj.items)]
+        return pa.Table.from_batches(batches)
+    names, arrays = event_arrays(ext_obj.items)
+    return pa.Table.from_arrays(arrays, names=names)
+
+def fdata_to_arrow(fdata, ext=None):
+    """Returns the table of an extension, or a dict with every table"""
+    if not available():
+        return None
+    if ext is not None:
+        if not ext in fdata.__dict__:
+            log.error("Extension %s not found"%(ext))
+            return None
+        return extension_table(getattr(fdata, ext))
+    return dict((k, extension_table(v)) for k, v in fdata.__dict__.items())
+
+def record_batches(records, columnar=False, batch_size=DEFAULT_ARROW_BATCH):
+    """Yields the record batches of a stream of records
+
+    Columnar records hold whole columns and are a batch each, otherwise
+    every batch_size records, one per event, make a batch. Every batch
+    is cast to the schema of the first one
+    """
+    if not available():
+        return
+    schema = None
+    pending = []
+    for item in records:
+        if not columnar:
+            pending.append(item)
+            if len(pending) < batch_size:
+                continue
+        names, arrays = event_arrays(pending) if pending else \
+            record_arrays(item)
+        pending = []
+        batch = _record_batch(names, arrays, schema)
+        if batch is None:
+            return
+        schema = batch.schema
+        yield batch
+    if pending:
+        batch = _record_batch(*event_arrays(pending), schema)
+        if batch is not None:
+            yield batch
+
+def _record_batch(names, arrays, schema):
+    if schema is None:
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+    if names != schema.names:
+        log.error("Columns %s do not match the stream %s"%(names, schema.names))
+        return None
+    try:
+        arrays = [a if a.type == f.type else a.cast(f.type)
+                  for a, f in zip(arrays, schema)]
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        log.error("Batch not matching the stream schema: %s"%(e))
+        return None
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def write_arrow(fname, data, compression=None):
+    """Writes a table, or an iterable of record batches, to an Arrow IPC
+    (Feather v2) file
+
+    Files written without compression are reloaded without copies by
+    read_arrow. Returns the number of rows written, None on error
+    """
+    if not available() or data is None:
+        return None
+    if isinstance(data, pa.Table):
+        batches = iter(data.to_batches())
+        first = next(batches, None)
+        if first is None:
+            first = pa.RecordBatch.from_pylist([], schema=data.schema)
+    else:
+        batches = iter(data)
+        first = next(batches, None)
+        if first is None:
+            log.error("No record batches to write in %s"%(fname))
+            return None
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    nrows = 0
+    with pa.ipc.new_file(fname, first.schema, options=options) as writer:
+        for batch in itertools.chain((first,), batches):
+            writer.write_batch(batch)
+            nrows += batch.num_rows
+    return nrows
+
+def read_arrow(fname):
+    """Returns the table of an Arrow IPC file, memory mapped"""
+    if not available():
+        return None
+    return pa.ipc.open_file(pa.memory_map(fname, 'r')).read_all()
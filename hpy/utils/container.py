@@ -26,9 +26,154 @@ This module features the configuration_manager class
 """
 from collections import defaultdict
 from copy import deepcopy
+from functools import lru_cache
+from operator import attrgetter
 from pprint import pformat
 from textwrap import wrap
+import weakref
+
+import numpy as np
+
+# How the default of a field is given to a new instance
+_SHARED, _FACTORY, _COPY = range(3)
+# Events a ContainerBatch makes room for at first
+DEFAULT_BATCH_CAPACITY = 1024
+# Key prefixes whose keys a flatten plan keeps, others are built per call
+MAX_FLATTEN_PREFIXES = 256
+# Ids of the classes flattened into sub-keys, filled as Containers and Maps
+# are defined, without keeping them alive
+_NESTED_IDS = set()
+
+def _add_nested_type(cls):
+    """Registers a class flattened into sub-keys"""
+    _NESTED_IDS.add(id(cls))
+    weakref.finalize(cls, _NESTED_IDS.discard, id(cls))
+
+def _is_immutable(value):
+    """Returns True if the value can be shared by every instance"""
+    if isinstance(value, tuple):
+        return all(_is_immutable(v) for v in value)
+    if isinstance(value, np.generic):
+        return not isinstance(value, np.void)
+    return value is None or \
+        isinstance(value, (bool, int, float, complex, str, bytes, frozenset))
+
+def _default_plan(name, field):
+    """Returns (name, kind, default, fast default) for a field"""
+    if field.default_factory is not None:
+        return (name, _FACTORY, field.default_factory, field.default_factory)
+    default = field.default
+    if _is_immutable(default):
+        return (name, _SHARED, default, default)
+    fast = default
+    if isinstance(default, np.ndarray):
+        # Shared arrays are read only, values must be replaced, not updated
+        fast = default.view()
+        fast.flags.writeable = False
+    return (name, _COPY, default, fast)
+
+def _getter(paths):
+    """Returns a function giving the tuple of the attributes at paths"""
+    if len(paths) == 1:
+        get = attrgetter(paths[0])
+        return lambda obj: (get(obj),)
+    return attrgetter(*paths)
+
+@lru_cache(maxsize=4096)
+def _map_key(prefix, key):
+    """Returns the flat key of an item of a Map"""
+    return "{}{}".format(prefix, key)
+
+def _flatten_value(d, key, value):
+    """Stores a value in a flat dictionary, flattening Containers and Maps"""
+    if id(type(value)) in _NESTED_IDS:
+        value._flatten_into(d, key + "_")
+    else:
+        d[key] = value
+
+class _FlattenPlan:
+    """
+    The flat keys and attribute paths of the fields of a Container class,
+    following the nested Containers of the field defaults.
+
+    Values are gathered with a single getter for every run of fields
+    not holding a Map. Instances whose nested Containers differ from
+    the defaults are not covered by the plan.
+    """
+    def __init__(self, cls):
+        self._segments = []
+        self._keys = []
+        self._paths = []
+        self._nested_paths = []
+        self._nested_types = []
+        self.__walk(cls, "", "")
+        self.__close()
+        self._nested = None
+        if self._nested_paths:
+            self._nested = _getter(self._nested_paths)
+        self._nested_types = tuple(self._nested_types)
+        # Segments with the keys of each prefix
+        self._prefixed = {"": self._segments}
+
+    def __walk(self, cls, path, key):
+        for name, field in cls.fields.items():
+            if name.startswith("_"):
+                continue
+            default = field.default
+            if isinstance(default, Container):
+                self._nested_paths.append(path + name)
+                self._nested_types.append(type(default))
+                self.__walk(type(default), path + name + ".", key + name + "_")
+            elif isinstance(default, Map):
+                self.__close()
+                self._segments.append(((key + name,),
+                                       attrgetter(path + name), True))
+            else:
+                self._keys.append(key + name)
+                self._paths.append(path + name)
+
+    def __close(self):
+        if self._keys:
+            self._segments.append((tuple(self._keys), _getter(self._paths),
+                                   False))
+        self._keys = []
+        self._paths = []
+
+    def flatten(self, obj, d, prefix=""):
+        """
+        Stores the flattened fields of obj in d
 
+        Returns False, leaving d untouched, when obj does not follow
+        the layout of the plan
+        """
+        if self._nested is not None:
+            try:
+                nested = self._nested(obj)
+            except AttributeError:
+                return False
+            if tuple(map(type, nested)) != self._nested_types:
+                return False
+        segments = self._prefixed.get(prefix)
+        if segments is None:
+            segments = [(tuple(prefix + k for k in keys), get, dynamic)
+                        for keys, get, dynamic in self._segments]
+            if len(self._prefixed) < MAX_FLATTEN_PREFIXES:
+                self._prefixed[prefix] = segments
+        values = []
+        for keys, get, dynamic in segments:
+            if dynamic:
+                values.append(get(obj))
+                continue
+            row = get(obj)
+            if not _NESTED_IDS.isdisjoint(map(id, map(type, row))):
+                return False
+            values.append(row)
+        for (keys, get, dynamic), row in zip(segments, values):
+            if dynamic:
+                _flatten_value(d, keys[0], row)
+            else:
+                d.update(zip(keys, row))
+        return True
 
 class Field:
     """
@@ -45,13 +190,18 @@ class Field:
         unit to convert to when writing output, or None for no conversion
     ucd: str
         universal content descriptor (see Virtual Observatory standards)
+    default_factory: callable
+        called without arguments to produce the default value of each
+        instance, instead of copying `default`
     """
 
-    def __init__(self, default, description="", unit=None, ucd=None):
+    def __init__(self, default=None, description="", unit=None, ucd=None,
+                 default_factory=None):
         self.default = default
         self.description = description
         self.unit = unit
         self.ucd = ucd
+        self.default_factory = default_factory
 
     def __repr__(self):
         desc = '{}'.format(self.description)
@@ -88,7 +238,14 @@ class ContainerMeta(type):
         for k in items:
             dct['fields'][k] = dct.pop(k)
 
-        return type.__new__(cls, name, bases, dct)
+        dct['_default_plan'] = tuple(_default_plan(k, v)
+                                     for k, v in dct['fields'].items())
+        # Compiled on the first flattening
+        dct['_flatten_plan'] = None
+
+        ret = type.__new__(cls, name, bases, dct)
+        _add_nested_type(ret)
+        return ret
 
 
 class Container(metaclass=ContainerMeta):
@@ -142,12 +299,25 @@ class Container(metaclass=ContainerMeta):
     def __init__(self, **fields):
 
         self.meta = {}
-        for k, v in self.fields.items():
-            setattr(self, k, deepcopy(v.default))
+        self.__set_defaults(fields)
 
         for k, v in fields.items():
             setattr(self, k, v)
 
+    def __set_defaults(self, skip=()):
+        fast = self._fast_defaults
+        for name, kind, default, shared in self._default_plan:
+            if name in skip:
+                continue
+            if kind == _SHARED:
+                setattr(self, name, default)
+            elif kind == _FACTORY:
+                setattr(self, name, default())
+            elif fast:
+                setattr(self, name, shared)
+            else:
+                setattr(self, name, deepcopy(default))
+
     def __getitem__(self, key):
         return getattr(self, key)
 
@@ -180,22 +350,53 @@ class Container(metaclass=ContainerMeta):
         """
         if not recursive:
             return dict(self.items())
+        elif flatten:
+            d = dict()
+            self._flatten_into(d, "")
+            return d
         else:
             d = dict()
             for key, val in self.items():
                 if key.startswith("_"):
                     continue
                 if isinstance(val, Container) or isinstance(val, Map):
-                    if flatten:
-                        d.update({"{}_{}".format(key, k): v
-                                  for k, v in val.as_dict(recursive).items()})
-                    else:
-                        d[key] = val.as_dict(recursive=recursive,
-                                             flatten=flatten)
+                    d[key] = val.as_dict(recursive=recursive)
                     continue
                 d[key] = val
             return d
 
+    def fill(self, buffers, i):
+        """
+        Stores the flattened fields at row i of preallocated columns
+
+        Parameters
+        ----------
+        buffers: dict
+            arrays keyed as in `as_dict(recursive=True, flatten=True)`,
+            fields without a buffer are skipped
+        i: int
+            row of the buffers
+        """
+        d = dict()
+        self._flatten_into(d, "")
+        for key, value in d.items():
+            buffer = buffers.get(key)
+            if buffer is not None:
+                buffer[i] = value
+
+    def _flatten_into(self, d, prefix):
+        cls = type(self)
+        plan = cls._flatten_plan
+        if plan is None:
+            plan = cls._flatten_plan = _FlattenPlan(cls)
+        if plan.flatten(self, d, prefix):
+            return
+        # Nested values other than the defaults, walk them one by one
+        for key, val in self.items():
+            if key.startswith("_"):
+                continue
+            _flatten_value(d, prefix + key, val)
+
     @classmethod
     def disable_attribute_check(cls):
         """
@@ -205,14 +406,25 @@ class Container(metaclass=ContainerMeta):
         """
         cls.__setattr__ = object.__setattr__
 
+    @classmethod
+    def enable_fast_defaults(cls):
+        """
+        Share the mutable defaults of the fields between the instances
+        instead of deep-copying them on construction and `reset()`.
+        Shared NumPy arrays are read only, so values must be replaced
+        rather than updated in place; defaults produced by a
+        `default_factory` are not affected.
+        """
+        cls._fast_defaults = True
+
+    @classmethod
+    def batch(cls, capacity=DEFAULT_BATCH_CAPACITY):
+        """Returns an empty `ContainerBatch` of this class"""
+        return ContainerBatch(cls, capacity)
+
     def reset(self, recursive=True):
         """ set all values back to their default values"""
-        for name, value in self.fields.items():
-            if isinstance(value, Container):
-                if recursive:
-                    getattr(self, name).reset()
-            else:
-                setattr(self, name, deepcopy(self.fields[name].default))
+        self.__set_defaults()
 
     def update(self, **values):
         """
@@ -238,6 +450,8 @@ class Container(metaclass=ContainerMeta):
             text.extend(lines)
         return "\n".join(text)
 
+    _fast_defaults = False
+
 
 class Map(defaultdict):
     """A dictionary of sub-containers that can be added to a Container. This
@@ -248,16 +462,15 @@ class Map(defaultdict):
     def as_dict(self, recursive=False, flatten=False):
         if not recursive:
             return dict(self.items())
+        elif flatten:
+            d = dict()
+            self._flatten_into(d, "")
+            return d
         else:
             d = dict()
             for key, val in self.items():
                 if isinstance(val, Container) or isinstance(val, Map):
-                    if flatten:
-                        d.update({"{}_{}".format(key, k): v
-                                  for k, v in val.as_dict(recursive).items()})
-                    else:
-                        d[key] = val.as_dict(recursive=recursive,
-                                             flatten=flatten)
+                    d[key] = val.as_dict(recursive=recursive)
                     continue
                 d[key] = val
             return d
@@ -266,3 +479,188 @@ class Map(defaultdict):
         for val in self.values():
             if isinstance(val, Container):
                 val.reset(recursive=recursive)
+
+    def _flatten_into(self, d, prefix):
+        for key, val in self.items():
+            _flatten_value(d, _map_key(prefix, key), val)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _add_nested_type(cls)
+
+_add_nested_type(Map)
+
+
+class ContainerBatch:
+    """
+    A batch of events of a `Container` class, holding each field as an
+    array with a leading event axis.
+
+    Fields holding a `Container` are batches of their own. Values that
+    can not share the dtype and shape of the previous events (strings,
+    ragged arrays, `Map`s...) are kept in object arrays. Events are
+    copied into the arrays as they are appended, which grow as needed.
+
+    >>>    batch = MyContainer.batch()
+    >>>    batch.append(cont)
+    >>>    batch.append(x=3)
+    >>>    batch["x"]      # the x of every event
+    >>>    batch[10:20]    # a batch viewing 10 events
+    """
+    def __init__(self, container_class, capacity=DEFAULT_BATCH_CAPACITY):
+        self.container_class = container_class
+        self._capacity = max(1, capacity)
+        self._size = 0
+        self._columns = {}
+        for name, field in container_class.fields.items():
+            if isinstance(field.default, Container):
+                self._columns[name] = ContainerBatch(type(field.default),
+                                                     capacity)
+            else:
+                # Allocated from the first value
+                self._columns[name] = None
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.column(key)
+        if isinstance(key, slice):
+            return self.__slice(key)
+        i = range(self._size)[key]
+        values = {}
+        for name, column in self._columns.items():
+            if column is not None:
+                values[name] = column[i]
+        return self.container_class(**values)
+
+    def append(self, container=None, **values):
+        """Appends an event given as a container, field values, or both"""
+        if self._size == self._capacity:
+            self.__grow()
+        i = self._size
+        fields = self.container_class.fields
+        for name, column in self._columns.items():
+            if name in values:
+                value = values[name]
+            elif container is not None:
+                value = getattr(container, name)
+            else:
+                value = None
+            if isinstance(column, ContainerBatch):
+                column.append(value)
+                continue
+            if value is None and not name in values:
+                value = fields[name].default
+                factory = getattr(fields[name], 'default_factory', None)
+                if factory is not None:
+                    value = factory()
+            self.__store(name, i, value)
+        self._size += 1
+
+    def extend(self, containers):
+        """Appends every container of an iterable"""
+        for container in containers:
+            self.append(container)
+
+    def column(self, name):
+        """Returns the values of a field for every event"""
+        column = self._columns[name]
+        if isinstance(column, ContainerBatch):
+            return column
+        if column is None:
+            return np.empty(0, dtype=object)
+        return column[:self._size]
+
+    def keys(self):
+        """Get the keys of the batch"""
+        return self._columns.keys()
+
+    def items(self):
+        """Generator over (key, column) pairs"""
+        return ((k, self.column(k)) for k in self._columns)
+
+    def as_dict(self, recursive=False, flatten=False):
+        """
+        convert the batch into a dictionary of columns
+
+        Parameters
+        ----------
+        recursive: bool
+            sub-batches should also be converted to dicts
+        flatten: bool
+            return a flat dictionary of column arrays, with the keys of
+            the sub-batches prefixed by their field name
+        """
+        if not recursive and not flatten:
+            return dict(self.items())
+        d = dict()
+        for key, val in self.items():
+            if isinstance(val, ContainerBatch):
+                if flatten:
+                    d.update({"{}_{}".format(key, k): v
+                              for k, v in val.as_dict(flatten=True).items()})
+                else:
+                    d[key] = val.as_dict(recursive=True)
+                continue
+            d[key] = val
+        return d
+
+    def reset(self):
+        """Removes every event, keeping the allocated arrays"""
+        self._size = 0
+        for column in self._columns.values():
+            if isinstance(column, ContainerBatch):
+                column.reset()
+
+    def __store(self, name, i, value):
+        column = self._columns[name]
+        if column is None:
+            column = self._columns[name] = self.__allocate(value)
+        if column.dtype != object:
+            array = np.asarray(value)
+            if array.dtype.kind in 'biufc' and \
+               array.shape == column.shape[1:]:
+                if not np.can_cast(array.dtype, column.dtype):
+                    column = self._columns[name] = column.astype(
+                        np.promote_types(column.dtype, array.dtype))
+                column[i] = array
+                return
+            # Strings, ragged or missing values from now on
+            rows = column
+            column = self._columns[name] = np.empty(len(rows), dtype=object)
+            for j in range(i):
+                column[j] = rows[j]
+        column[i] = value
+
+    def __allocate(self, value):
+        array = np.asarray(value) if value is not None else None
+        if array is None or array.dtype.kind not in 'biufc':
+            return np.empty(self._capacity, dtype=object)
+        return np.empty((self._capacity,) + array.shape, dtype=array.dtype)
+
+    def __grow(self):
+        self._capacity = max(1, 2 * self._capacity)
+        for name, column in self._columns.items():
+            if column is None or isinstance(column, ContainerBatch):
+                continue
+            rows = np.empty((self._capacity,) + column.shape[1:],
+                            dtype=column.dtype)
+            rows[:self._size] = column[:self._size]
+            self._columns[name] = rows
+
+    def __slice(self, key):
+        ret = ContainerBatch.__new__(ContainerBatch)
+        ret.container_class = self.container_class
+        ret._size = len(range(self._size)[key])
+        # Appending to the slice reallocates, the arrays stay shared
+        ret._capacity = ret._size
+        ret._columns = {}
+        for name, column in self._columns.items():
+            if isinstance(column, ContainerBatch):
+                column = column[key]
+            elif column is not None:
+                column = column[:self._size][key]
+            ret._columns[name] = column
+        return ret
@@ -31,10 +31,47 @@ except ImportError:
     from hpy.utils.container import Container as Cnt
     from hpy.utils.container import Field as Field
 
+# Container classes of a single field, keyed by the field name
+_classes = {}
+
+def container_class(field):
+    """Returns the cached container class with a single field
+
+    The class is created once per field name, so that the ContainerMeta
+    metaclass does not run per event
+    """
+    ret = _classes.get(field)
+    if ret is None:
+        ret = type("DClass", (data_container,), {field: Field(None)})
+        _classes[field] = ret
+    return ret
+
+def field_container(field, value):
+    """Returns a container of the cached class of field holding value"""
+    ret = container_class(field)()
+    ret[field] = value
+    return ret
+
 class schema:
     def __str__(self):
         return str(self.__dict__)
 
+class record:
+    """Base of the event records of the FITS extensions
+
+    Subclasses hold their fields in __slots__, listed in order in
+    _fields. Fields never set are missing, getattr(r, k, None) gives None
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def _asdict(self):
+        return dict((k, getattr(self, k)) for k in self._fields
+                    if hasattr(self, k))
+
+    def __str__(self):
+        return str(self._asdict())
+
 class data_container(Cnt):
     pass
 """
@@ -37,15 +37,81 @@ from protozfits import File
 
 from hpy.utils.data_container import data_container as Cnt
 from hpy.utils.data_container import schema as Sc
+from hpy.utils.data_container import record
+from hpy.utils.arrow import fdata_to_arrow, DEFAULT_ARROW_BATCH
+from hpy.utils.memory import record_nbytes
 
 PROTOZFITS_STR = "protozfits."
 
 TEST_EVENTS_NUMBER = 100
 TEST_EXTENSION = 'CameraConfig'
 
+# Record classes, keyed by (extension, group path, field names)
+_record_classes = {}
+
+class FData(Sc):
+    """Extensions of a FITS file, one attribute each"""
+    def to_arrow(self, ext=None):
+        """Returns the Arrow table of an extension, or a dict of them"""
+        return fdata_to_arrow(self, ext)
+
+class Extension(Sc):
+    """Header and records (items) of a FITS extension
+
+    Records hold an event each, or whole columns when columnar. Events
+    spilled while loading are in the pytables bytables layout of
+    spill_file, which is kept for the caller to read and remove, truncated
+    extensions stopped at the memory budget
+    """
+    columnar = False
+    spill_file = None
+    spilled_events = 0
+    truncated = False
+
+def variable_length_columns(header):
+    """Returns the names of the variable length columns (TFORM P or Q) of
+    a binary table header
+    """
+    ret = set()
+    for i in range(1, (header.get('TFIELDS') or 0) + 1):
+        tform = str(header.get('TFORM%d'%(i), '')).lstrip('0123456789')
+        if tform[:1] in ('P', 'Q') and 'TTYPE%d'%(i) in header:
+            ret.add(header['TTYPE%d'%(i)])
+    return ret
+
+def record_class(ext, path, fields):
+    """Returns the record class of a group of an extension
+
+    The class is created once per extension, group and fields, so that
+    every event reuses it
+    """
+    fields = tuple(fields)
+    key = (ext, path, fields)
+    ret = _record_classes.get(key)
+    if ret is None:
+        slots = tuple(k for k in fields if k.isidentifier())
+        if len(slots) != len(fields):
+            # Column names that are not identifiers need a __dict__
+            slots += ("__dict__",)
+        ret = type("ExtensionItem", (record,), {"__slots__": slots,
+                                                "_fields": fields})
+        _record_classes[key] = ret
+    return ret
+
 class from_fits:
 
-    def load_r1(self, fits_file, fits_mode=1, test=False):
+    def load_r1(self, fits_file, fits_mode=1, test=False, max_memory=None,
+                spill=None):
+        """Loads the extensions of a FITS file
+
+        Once the loaded records exceed max_memory bytes the loading stops,
+        or, if a spill function is given, the events loaded of the
+        extension are handed to spill(ext, items), which returns the file
+        they are written to, and dropped
+        """
+        self._max_memory = max_memory
+        self._spill = spill
+        self._nbytes = 0
         if not fits_file:
             self.log.error("No FITS file provided")
             return False
@@ -73,7 +139,7 @@ class from_fits:
             return sc
 
     def __load_schema_from_protozfits(self, fits_file, test=False):
-        ret = type("FData", (Sc,),{})()
+        ret = FData()
 
         for ext in fits_file.__dict__:
             self.log.info(ext)
@@ -83,49 +149,57 @@ class from_fits:
             # FIXME: Remove this if
             #if ext == 'Events':
             #    continue
-            ext_obj = type("Extension", (Sc,),{})()
+            ext_obj = Extension()
             setattr(ret, ext, ext_obj)
             setattr(ext_obj, "header", extfunc.header)
             setattr(ext_obj, "items", [])
-            if test:
-                i = 0
-                for col in extfunc:
-                    if i == TEST_EVENTS_NUMBER: 
-                        break
-                    i = i + 1
-                    ext_item = type("ExtensionItem", (Sc,),{})()
-                    ext_obj.items.append(ext_item)
-                    for k in col._asdict():
-                        self.__load_subdata_from_protozfits(k, getattr(col, k), ext_item)
-                continue
-            #i = 0
-            for col in extfunc:
-                #if i == 10: 
-                #    return ret
-                #i = i + 1
-                #self.log.info(col)
-                ext_item = type("ExtensionItem", (Sc,),{})()
-                ext_obj.items.append(ext_item)
-                for k in col._asdict():
-                    self.__load_subdata_from_protozfits(k, getattr(col, k), ext_item)
+            # Bytes of the events of the extension held in memory
+            nbytes = 0
+            for i, col in enumerate(extfunc):
+                if test and i == TEST_EVENTS_NUMBER:
+                    break
+                item = self.__load_record_from_protozfits(ext, (), col)
+                ext_obj.items.append(item)
+                if not self._max_memory:
+                    continue
+                n = record_nbytes(item)
+                nbytes += n
+                self._nbytes += n
+                if self._nbytes <= self._max_memory:
+                    continue
+                if not self._spill:
+                    self.log.warning("Memory budget of %d bytes exceeded "
+                                     "in %s, loading stopped at event %d"%(
+                                         self._max_memory, ext, i))
+                    ext_obj.truncated = True
+                    return ret
+                ext_obj.spill_file = self._spill(ext, ext_obj.items,
+                                                 ext_obj.header)
+                ext_obj.spilled_events += len(ext_obj.items)
+                ext_obj.items = []
+                self._nbytes -= nbytes
+                nbytes = 0
         return ret
     
-    def __load_subdata_from_protozfits(self, name, data, obj):
-        if PROTOZFITS_STR not in str(type(data)):
-            self.log.info("%s - %s", name, data)
-            setattr(obj, name, data)
-            return 
-        item = type("ExtensionItem", (Sc,),{})()
-        setattr(obj, name, item)
-        for k in data._asdict():
-            self.__load_subdata_from_protozfits(k, getattr(data, k),item)
+    def __load_record_from_protozfits(self, ext, path, data):
+        names = data._asdict()
+        item = record_class(ext, path, names)()
+        for k in names:
+            value = getattr(data, k)
+            if PROTOZFITS_STR in str(type(value)):
+                value = self.__load_record_from_protozfits(ext, path + (k,),
+                                                           value)
+            else:
+                self.log.info("%s - %s", k, value)
+            setattr(item, k, value)
+        return item
 
     def __load_schema_from_astropy(self, fits_file, test=False):
         #self.log.info(self._def)
         if self._def:
             return self.__filter_schema_from_astropy(fits_file, test)
 
-        ret = type("FData", (Sc,),{})()
+        ret = FData()
 
         for ext in fits_file:
 
@@ -133,83 +207,138 @@ class from_fits:
                 continue
             if test:
                 if ext.name == TEST_EXTENSION:
-                    ext_obj = type("Extension", (Sc,),{})()
+                    ext_obj = Extension()
                     setattr(ret, ext.name, ext_obj)
                     setattr(ext_obj, "header", fits_file[ext.name].header)
                     setattr(ext_obj, "items", [])
-                    item = type("ExtensionItem", (Sc,),{})()
-                    ext_obj.items.append(item)
-                    for name in fits_file[ext.name].columns.names:
-                        setattr(item, name, fits_file[ext.name].data[name])
+                    ext_obj.columnar = True
+                    ext_obj.items.append(
+                        self.__load_record_from_astropy(fits_file[ext.name]))
                     break
-            ext_obj = type("Extension", (Sc,),{})()
+            ext_obj = Extension()
             setattr(ret, ext.name, ext_obj)
             setattr(ext_obj, "header", fits_file[ext.name].header)
             setattr(ext_obj, "items", [])
-            item = type("ExtensionItem", (Sc,),{})()
-            ext_obj.items.append(item)
-            for name in fits_file[ext.name].columns.names:
-                setattr(item, name, fits_file[ext.name].data[name])
+            ext_obj.columnar = True
+            ext_obj.items.append(
+                self.__load_record_from_astropy(fits_file[ext.name]))
+            if not self.__within_budget(ext_obj, ext.name):
+                return ret
 
         return ret
+
+    def __within_budget(self, ext_obj, ext):
+        """Drops the columns of an extension exceeding the memory budget"""
+        if not self._max_memory:
+            return True
+        nbytes = record_nbytes(ext_obj.items[0])
+        if self._nbytes + nbytes <= self._max_memory:
+            self._nbytes += nbytes
+            return True
+        if self._spill:
+            self.log.warning("Columns of %s can not be spilled"%(ext))
+        self.log.warning("Memory budget of %d bytes exceeded by %s, "
+                         "loading stopped"%(self._max_memory, ext))
+        ext_obj.items = []
+        ext_obj.truncated = True
+        return False
+
+    def __load_record_from_astropy(self, hdu, data=None):
+        if data is None: data = hdu.data
+        names = hdu.columns.names
+        if self._def and hdu.name in self._def:
+            return self.__build_record(hdu.name, (),
+                                       self.__group_columns(hdu.name, names,
+                                                            data))
+        item = record_class(hdu.name, (), names)()
+        for name in names:
+            setattr(item, name, data[name])
+        return item
         
     def __filter_schema_from_astropy(self, f, test):
-        ret = type("FData", (Sc,), {})()
+        ret = FData()
 
         for ext in f:
             if not ext.name in self._def:
                 continue
             if f[ext.name].size <= 0:
                 continue
-            ext_obj = type("Extension", (Sc,),{})()
+            ext_obj = Extension()
             setattr(ret, ext.name, ext_obj)
             setattr(ext_obj, "header", f[ext.name].header)
             setattr(ext_obj, "items", [])
-            item = type("ExtensionItem", (Sc,), {})()
-            ext_obj.items.append(item)
-            for name in f[ext.name].columns.names:
-                item2fill = item
-                self.log.info(name)
-                if not name in self._def[ext.name]:
-                    self.log.info("Key not found in the definition file")
-                else:
-                    if 'att' in self._def[ext.name][name] and \
-                       'group' in self._def[ext.name][name]['att']:
-                        g = self._def[ext.name][name]['att']['group']
-                        item2fill = self.__load_subdata_filter_astropy(ext.name,
-                                                                       name,
-                                                                       item2fill)
-                #self.log.info("%s - %s"%(name, item2fill))
-                setattr(item2fill, name, f[ext.name].data[name])
-        #self.log.info(ret)
+            ext_obj.columnar = True
+            ext_obj.items.append(self.__load_record_from_astropy(f[ext.name]))
+            if not self.__within_budget(ext_obj, ext.name):
+                return ret
         return ret
-    
 
-    def __load_subdata_filter_astropy(self, ext, name, parent):
-        self.log.info("%s - %s"%(ext, name))
+    def __group_columns(self, ext, names, data):
+        """Returns the columns nested by the groups of the definition file"""
+        tree = {}
+        for name in names:
+            node = tree
+            self.log.info(name)
+            if not name in self._def[ext]:
+                self.log.info("Key not found in the definition file")
+            else:
+                for g in self.__group_path(ext, name):
+                    node = node.setdefault(g, {})
+            node[name] = data[name]
+        return tree
+
+    def __build_record(self, ext, path, tree):
+        item = record_class(ext, path, tree)()
+        for k, v in tree.items():
+            if isinstance(v, dict):
+                v = self.__build_record(ext, path + (k,), v)
+            setattr(item, k, v)
+        return item
+
+    def __group_path(self, ext, name):
+        """Returns the groups holding a column, outermost first"""
         if not 'att' in self._def[ext][name] or \
            not 'group' in self._def[ext][name]['att']:
-            return parent
+            return ()
         group = self._def[ext][name]['att']['group']
         self.log.info("Key %s is in the group %s"%(name, group))
         if group == ext:
             self.log.info("Group %s in %s"%(name, ext))
-            if hasattr(parent, name):
-                return getattr(parent, name)
-            it = type("ExtensionItem", (Sc,),{})()
-            setattr(parent, name, it)
-            return it
+            return (name,)
         if group in self._def[ext]:
-            gg = self._def[ext][group]
-            if 'att' in gg and 'group' in gg['att']:
-                parent = self.__load_subdata_filter_astropy(ext, group, parent)
             self.log.info("Creating group %s in %s"%(name, group))
-            if hasattr(parent, name):
-                return getattr(parent, name)
-            it = type("ExtensionItem", (Sc,),{})()
-            setattr(parent, name, it)
-            return it
-        return parent
+            return self.__group_path(ext, group) + (name,)
+        return ()
+
+    def iterate_r1(self, fits_file, ext, fits_mode=1, rows=DEFAULT_ARROW_BATCH):
+        """Yields the records of an extension as they are read
+
+        protozfits yields a record per event, astropy a record with the
+        columns of each block of rows
+        """
+        if not fits_file or not os.path.isfile(fits_file):
+            self.log.error("Bad file provided")
+            return
+        if fits_mode == 0:
+            with fits.open(fits_file, memmap=True) as f:
+                if not ext in f:
+                    self.log.error("Extension %s not found"%(ext))
+                    return
+                hdu = f[ext]
+                nrows = hdu.header.get('NAXIS2', 0)
+                for start in range(0, nrows, rows):
+                    yield self.__load_record_from_astropy(
+                        hdu, hdu.data[start:start + rows])
+            return
+        f = File(fits_file)
+        try:
+            if not ext in f.__dict__:
+                self.log.error("Extension %s not found"%(ext))
+                return
+            for col in getattr(f, ext):
+                yield self.__load_record_from_protozfits(ext, (), col)
+        finally:
+            f.close()
 
     def create_r1(self, fits_file, fname = None,v='v1'):
         if not fits_file and not self._f:
@@ -311,4 +440,7 @@ class from_fits:
     _h = None
     _def = None
     _fdata = None # Fits data
+    _max_memory = None
+    _spill = None
+    _nbytes = 0
     log = None
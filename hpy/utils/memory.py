@@ -0,0 +1,137 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package hpy.memory
+
+--------------------------------------------------------------------------------
+
+This module provides the memory accounting of the loaded FITS data
+"""
+import sys
+
+import numpy as np
+
+from hpy.utils.data_container import record
+
+## Bytes of a NumPy array object besides its data
+ARRAY_OVERHEAD = sys.getsizeof(np.empty(0))
+
+def value_nbytes(value):
+    """Returns the bytes held by a value, its data plus the object overhead
+
+    The data of memory mapped columns is counted as well
+    """
+    if isinstance(value, np.ndarray):
+        ret = ARRAY_OVERHEAD + value.nbytes
+        if value.dtype.kind == 'O':
+            # Variable length fields, an object per row
+            ret += sum(value_nbytes(v) for v in value.flat)
+        return ret
+    return sys.getsizeof(value)
+
+def record_nbytes(item, columns=None, prefix=""):
+    """Returns the bytes held by a record and its nested records
+
+    The bytes of each column are added to the columns dict if given,
+    keyed by their path, i.e. lstcamevent/first_capacitor_id
+    """
+    ret = sys.getsizeof(item)
+    for k in item._fields:
+        v = getattr(item, k, None)
+        if isinstance(v, record):
+            ret += record_nbytes(v, columns, prefix + k + "/")
+            continue
+        n = value_nbytes(v)
+        ret += n
+        if columns is not None:
+            columns[prefix + k] = columns.get(prefix + k, 0) + n
+    return ret
+
+def record_rows(item):
+    """Returns the rows of a record holding whole columns, the length of
+    its first column, None if it has none
+    """
+    for k in item._fields:
+        v = getattr(item, k, None)
+        if isinstance(v, record):
+            ret = record_rows(v)
+            if ret is not None:
+                return ret
+        elif np.ndim(v):
+            return len(v)
+    return None
+
+def loaded_events(ext_obj):
+    """Returns the events held by the records of an extension"""
+    if not ext_obj.columnar:
+        return len(ext_obj.items)
+    # A record holds the whole columns, as loaded
+    return sum(record_rows(item) or 0 for item in ext_obj.items)
+
+class memory_report:
+    """@class memory_report
+    This class accounts the memory held by the loaded data, per extension
+    and per column
+
+    Events spilled to a temporary file while loading, or never loaded
+    because the budget was exceeded, are reported along.
+    """
+    def __init__(self, fdata, max_memory=None):
+        self.max_memory = max_memory
+        self.extensions = {}
+        for ext, ext_obj in fdata.__dict__.items():
+            columns = {}
+            nbytes = sys.getsizeof(ext_obj.items)
+            for item in ext_obj.items:
+                nbytes += record_nbytes(item, columns)
+            self.extensions[ext] = {
+                'events': loaded_events(ext_obj),
+                'nbytes': nbytes,
+                'columns': columns,
+                'spilled_events': ext_obj.spilled_events,
+                'spill_file': ext_obj.spill_file,
+                'truncated': ext_obj.truncated}
+        self.nbytes = sum(e['nbytes'] for e in self.extensions.values())
+
+    def summary(self):
+        """Returns the report as a dict"""
+        return {'nbytes': self.nbytes,
+                'max_memory': self.max_memory,
+                'extensions': self.extensions}
+
+    def __str__(self):
+        lines = ["%-40s %12s %14s"%("extension/column", "events", "bytes")]
+        for ext, e in self.extensions.items():
+            lines.append("%-40s %12d %14d"%(ext, e['events'], e['nbytes']))
+            for name, nbytes in sorted(e['columns'].items(),
+                                       key=lambda c: -c[1]):
+                lines.append("  %-38s %12s %14d"%(name, "", nbytes))
+            if e['spilled_events']:
+                lines.append("  %d events spilled to %s"%(
+                    e['spilled_events'], e['spill_file']))
+            if e['truncated']:
+                lines.append("  truncated, memory budget exceeded")
+        lines.append("%-40s %12s %14d"%("total", "", self.nbytes))
+        if self.max_memory:
+            lines.append("%-40s %12s %14d"%("budget", "", self.max_memory))
+        return "\n".join(lines)
+
+    max_memory = None
+    nbytes = 0
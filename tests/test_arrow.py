@@ -0,0 +1,78 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package tests.test_arrow
+
+--------------------------------------------------------------------------------
+
+Tests of the export of the loaded events to Arrow
+"""
+import numpy as np
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+from hpy.utils import arrow
+from hpy.utils.fits import record_class
+
+def make_records(path, fields, events):
+    cls = record_class("TEST", path, fields)
+    ret = []
+    for values in events:
+        r = cls()
+        for k, v in values.items():
+            setattr(r, k, v)
+        ret.append(r)
+    return ret
+
+def test_missing_and_none_fields_are_nulls():
+    items = make_records("events", ["a", "b", "c", "d"], [
+        {"a": np.int32(1), "b": None, "c": np.arange(2)},
+        {"a": np.int32(2), "b": None, "c": np.arange(3), "d": 1.5},
+        {"a": np.int32(3), "b": None}])
+    names, arrays = arrow.event_arrays(items)
+    assert names == ["a", "b", "c", "d"]
+    assert [a.to_pylist() for a in arrays] == [
+        [1, 2, 3], [None, None, None], [[0, 1], [0, 1, 2], None],
+        [None, 1.5, None]]
+
+def test_missing_fixed_shape_field_keeps_its_type():
+    items = make_records("fixed", ["w"], [
+        {"w": np.ones((2, 2), dtype=np.int16)}, {}])
+    names, arrays = arrow.event_arrays(items)
+    assert arrays[0].type == pa.list_(pa.list_(pa.int16(), 2), 2)
+    assert arrays[0].to_pylist() == [[[1, 1], [1, 1]], None]
+
+def test_none_rows_of_variable_length_column():
+    rows = np.empty(3, dtype=object)
+    rows[0] = np.arange(2)
+    rows[2] = np.arange(1)
+    assert arrow.column_array(rows).to_pylist() == [[0, 1], None, [0]]
+
+def test_missing_column_of_columnar_record():
+    item = make_records("columns", ["a", "b"], [{"a": np.arange(3)}])[0]
+    names, arrays = arrow.record_arrays(item)
+    assert names == ["a", "b"]
+    assert arrays[1].to_pylist() == [None, None, None]
+
+def test_unconvertible_objects_raise_type_error():
+    items = make_records("objects", ["a"], [{"a": object()}, {"a": object()}])
+    with pytest.raises(TypeError):
+        arrow.event_arrays(items)
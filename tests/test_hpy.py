@@ -0,0 +1,88 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package tests.test_hpy
+
+--------------------------------------------------------------------------------
+
+Tests of the HDF5 files written from the loaded FITS data
+"""
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from hpy import hpy
+from hpy.core.h5table import h5table_reader
+from hpy.utils.fits import FData, Extension, record_class
+
+def events_data(ext, rows, header=None):
+    """Returns the data of an extension with a record per event holding
+    plain arrays, as the protozfits loader builds them
+    """
+    cls = record_class(ext, (), ["event_id", "counters"])
+    ext_obj = Extension()
+    ext_obj.header = header if header is not None else fits.Header()
+    ext_obj.items = []
+    for i, row in enumerate(rows):
+        item = cls()
+        item.event_id = np.int64(i)
+        item.counters = row
+        ext_obj.items.append(item)
+    ret = FData()
+    setattr(ret, ext, ext_obj)
+    return ret
+
+def write_bytables(tmp_path, fdata, batch_size):
+    fname = str(tmp_path / "events.h5")
+    s = hpy.session()
+    s._fdata = fdata
+    assert s.create_hdf5(fname, "pytables", "bytables", batch_size=batch_size)
+    return fname
+
+def read_counters(fname, ext):
+    r = h5table_reader(fname)
+    try:
+        return r.read_ragged("/%s/data/counters"%(ext))
+    finally:
+        r.close()
+
+@pytest.mark.parametrize("batch_size", [4, 100])
+def test_variable_length_columns_of_the_header(tmp_path, batch_size):
+    # The first batch has rows of a single length
+    rows = [np.arange(3, dtype=np.uint8)] * 4 + \
+        [np.arange(n, dtype=np.uint8) for n in (1, 5, 0, 2, 7)]
+    header = fits.Header([("TFIELDS", 2), ("TTYPE1", "event_id"),
+                          ("TFORM1", "K"), ("TTYPE2", "counters"),
+                          ("TFORM2", "1PB(7)")])
+    fname = write_bytables(tmp_path, events_data("VLF", rows, header),
+                           batch_size)
+    got = read_counters(fname, "VLF")
+    assert len(got) == len(rows)
+    assert all(np.array_equal(a, b) for a, b in zip(got, rows))
+
+def test_variable_length_columns_of_their_shapes(tmp_path):
+    # Later batches have rows of a single length
+    rows = [np.arange(n, dtype=np.int16) for n in (2, 3, 1, 4)] + \
+        [np.arange(2, dtype=np.int16)] * 8
+    fname = write_bytables(tmp_path, events_data("SHAPES", rows), 4)
+    got = read_counters(fname, "SHAPES")
+    assert len(got) == len(rows)
+    assert all(np.array_equal(a, b) for a, b in zip(got, rows))
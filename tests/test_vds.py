@@ -0,0 +1,79 @@
+"""
+Copyright (C) 2018-2019 Quasar Science Resources, S.L.
+Copyright (C) 2018-2019 Universidad Complutense de Madrid.
+Copyright (C) 2018-2019 H2020 ASTERICS
+
+This file is part of HPY.
+
+HPY is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HPY is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HPY.  If not, see <http://www.gnu.org/licenses/>.
+
+@package tests.test_vds
+
+--------------------------------------------------------------------------------
+
+Tests of the master files joining several HDF5 files
+"""
+import numpy as np
+import pytest
+
+from hpy.core.h5 import h5_writer, h5_reader
+from hpy.core.h5table import h5table_writer
+from hpy.core.vds import vds_builder
+
+def ragged_column(rows):
+    ret = np.empty(len(rows), dtype=object)
+    for i, r in enumerate(rows):
+        ret[i] = r
+    return ret
+
+def write_events(writer, fname, first, rows):
+    w = writer(fname)
+    data = w.create_group("data", w.create_group("Events"))
+    w.append_batch({"event_id": np.arange(first, first + len(rows)),
+                    "counters": ragged_column(rows)}, data)
+    w.close()
+
+@pytest.mark.parametrize("writer", [h5_writer, h5table_writer])
+def test_ragged_columns_are_rebased(tmp_path, writer):
+    files = [[np.arange(1), np.arange(2), np.arange(3)],
+             [np.arange(4) + 10, np.arange(0) + 10]]
+    fnames = []
+    first = 0
+    for i, rows in enumerate(files):
+        fnames.append(str(tmp_path / ("run%d.h5"%(i))))
+        write_events(writer, fnames[-1], first, rows)
+        first += len(rows)
+    master = str(tmp_path / "master.h5")
+    assert vds_builder().create(fnames, master, "Events")
+
+    rows = files[0] + files[1]
+    r = h5_reader(master)
+    try:
+        offsets = r.read("/Events/data/counters/offsets")
+        assert offsets.tolist() == [0, 1, 3, 6, 10, 10]
+        got = r.read_ragged("/Events/data/counters")
+        assert len(got) == len(rows)
+        assert all(np.array_equal(a, b) for a, b in zip(got, rows))
+        assert [a.tolist() for a in r.read_ragged("/Events/data/counters",
+                                                  slice(2, 4))] == \
+            [[0, 1, 2], [10, 11, 12, 13]]
+    finally:
+        r.close()
+
+def test_ragged_column_missing_in_a_file(tmp_path):
+    fnames = [str(tmp_path / "ragged.h5"), str(tmp_path / "fixed.h5")]
+    write_events(h5_writer, fnames[0], 0, [np.arange(1), np.arange(2)])
+    write_events(h5_writer, fnames[1], 2, [np.arange(2), np.arange(2)])
+    master = str(tmp_path / "master.h5")
+    assert not vds_builder().create(fnames, master, "Events")